@@ -1,22 +1,24 @@
 #!/usr/bin/env python2
 
 import argparse
-import BaseHTTPServer
-import copy
+import atexit
 from datetime import datetime
+import functools
 import logging
 import os
-import SocketServer
 import sys
-import threading
 import time
-import urllib2
+
+# Time to first frame is measured from here, before the heavy imports
+started = time.time()
 
 import cv2
-import numpy as np
 
 import sharkcv
 
+# Startup stages and when they finished, reported with the first frame
+startup = [('imports', time.time())]
+
 # Parse arguments
 parser = argparse.ArgumentParser(prog=__file__)
 group_input = parser.add_argument_group('Input source')
@@ -24,6 +26,10 @@ group_input = group_input.add_mutually_exclusive_group()
 group_input.add_argument('-iv', metavar='N', dest='input_video', help='input video/webcam (default: -1)', default=-1)
 group_input.add_argument('-ii', metavar='file', nargs='+', dest='input_image', help='input image')
 group_input.add_argument('-im', metavar='url', dest='input_mjpg', help='input mjpg stream')
+group_input.add_argument('-ib', metavar='path', nargs='+', dest='input_batch',
+                         help='batch process image/video files, directories and globs on all cores')
+group_input.add_argument('-ic', metavar='name', nargs='+', dest='input_cameras',
+                         help='cameras from the module registry\'s [camera name] sections, sharing the module workers')
 group_video = parser.add_argument_group('Input video options')
 group_video.add_argument('-vw', metavar='N', dest='video_width', help='video width', type=int)
 group_video.add_argument('-vh', metavar='N', dest='video_height', help='video height', type=int)
@@ -36,25 +42,92 @@ group_webcam.add_argument('-we', metavar='[0-255]', dest='webcam_exposure', help
 group_webcam.add_argument('-wg', metavar='[0-255]', dest='webcam_gain', help='webcam gain', type=float)
 group_webcam.add_argument('-wh', metavar='[0-255]', dest='webcam_hue', help='webcam hue', type=float)
 group_webcam.add_argument('-ws', metavar='[0-255]', dest='webcam_saturation', help='webcam saturation', type=float)
+group_capture = parser.add_argument_group('Capture options')
+group_capture.add_argument('-ct', dest='capture_thread', help='read video/webcam on a background thread',
+                           action='store_true', default=False)
+group_capture.add_argument('-cb', metavar='N', dest='capture_buffers', help='capture ring buffer size (default: 3)',
+                           type=int, default=3)
+group_capture.add_argument('-cw', dest='capture_watchdog', action='store_true', default=False,
+                           help='reopen a webcam/mjpg stream that fails or stalls without restarting anything else, '
+                                'the MJPG stream shows the last frame marked stale meanwhile (implies -ct)')
+group_capture.add_argument('-cs', metavar='N', dest='capture_stale', type=float, default=1.0,
+                           help='seconds without a new frame before the watchdog shows the last one stale '
+                                '(default: 1.0)')
+group_capture.add_argument('-cl', dest='capture_latest', help='drop frames the module could not keep up with',
+                           action='store_true', default=False)
+group_batch = parser.add_argument_group('Batch options')
+group_batch.add_argument('-bo', metavar='file', dest='batch_output', action='append', default=[],
+                         help='write results returned by the module to a .csv or .npz file (repeatable)')
+group_batch.add_argument('-bc', metavar='N', dest='batch_chunk', help='frames per video segment (default: 300)',
+                         type=int, default=300)
+group_batch.add_argument('-sw', dest='sweep', action='store_true', default=False,
+                         help='the module is a parameter sweep (pipeline and score), rank every combination')
+group_batch.add_argument('-st', metavar='N', dest='sweep_top', help='best sweep combinations to log (default: 10)',
+                         type=int, default=10)
 group_output = parser.add_argument_group('Output file(s)')
 group_output.add_argument('-ov', metavar='file', dest='output_video', help='output video')
 group_output.add_argument('-oi', metavar='file', dest='output_image', help='output image')
+group_output.add_argument('-oq', metavar='N', dest='output_queue', help='frames queued per output file (default: 4)',
+                          type=int, default=4)
+group_output.add_argument('-op', dest='output_policy', choices=sharkcv.POLICIES, default='drop',
+                          help='when an output queue is full: drop the oldest frame, block, or sample every Nth '
+                               'frame (default: drop)')
+group_output.add_argument('-oe', metavar='N', dest='output_every', help='frames to sample from with -op sample '
+                          '(default: 2)', type=int, default=2)
 group_mjpg = parser.add_argument_group('Output MJPG stream')
 group_mjpg.add_argument('-oj', dest='mjpg', help='Enable MJPG stream', action='store_true', default=False)
 group_mjpg.add_argument('-jp', metavar='N', dest='mjpg_port', help='MJPG stream port (default: 5800)', type=int,
                         default=5800)
+group_mjpg.add_argument('-js', dest='mjpg_subsampling', choices=sharkcv.SUBSAMPLING, default='420',
+                        help='MJPG stream chroma subsampling (default: 420)')
+group_mjpg.add_argument('-jf', dest='mjpg_fast', help='MJPG stream fast DCT (libjpeg-turbo only)',
+                        action='store_true', default=False)
+group_mjpg.add_argument('-je', dest='mjpg_encoder', choices=sharkcv.BACKENDS, default='auto',
+                        help='MJPG stream JPEG encoder, libjpeg-turbo (PyTurboJPEG) when installed or OpenCV '
+                             '(default: auto)')
+group_publish = parser.add_argument_group('Publish module results')
+group_publish.add_argument('-pn', metavar='table', dest='publish_table',
+                           help='NetworkTable to publish to like a GRIP ContoursReport')
+group_publish.add_argument('-pa', metavar='address', dest='publish_address',
+                           help='NetworkTables server address (default: 127.0.0.1)', default='127.0.0.1')
+group_publish.add_argument('-pu', metavar='host:port', dest='publish_udp', help='UDP address to publish records to')
+group_publish.add_argument('-pk', metavar='N', dest='publish_keyframe',
+                           help='records between UDP keyframes (default: 30)', type=int, default=30)
+group_module = parser.add_argument_group('Module execution')
+group_module.add_argument('-mw', '--workers', metavar='N', dest='workers',
+                          help='run the module in N worker processes (default: 0, main process)', type=int, default=0)
+group_module.add_argument('-mr', metavar='file', dest='registry',
+                          help='module registry of named entry points (default: %s next to %s, if it exists)' %
+                               (sharkcv.module.REGISTRY, os.path.basename(__file__)))
+group_module.add_argument('-mh', dest='module_reload', action='store_true', default=False,
+                          help='reload the module when its file changes, rolling back to the last good version if '
+                               'the new one fails')
+group_module.add_argument('-ml', dest='lazy', help='record Frame operations and fuse them before running',
+                          action='store_true', default=False)
+parser.add_argument('--profile', dest='profile', help='time Frame operations and each stage, report on exit',
+                    action='store_true', default=False)
 parser.add_argument('-v', dest='verbose_debug', help='logging level DEBUG', action='store_true', default=False)
-parser.add_argument('module', nargs='?', help='python module file')
+parser.add_argument('module', nargs='?', help='python module file, file.py:function, package.module:function or '
+                                             'registry name (default: the registry\'s default)')
 args = parser.parse_args()
 
 # Massage arguments
-if type(args.input_image) is list and len(args.input_image) > 1 and args.module is None:
+# The last input image is the module unless it's an image (the registry's default module is used)
+if type(args.input_image) is list and len(args.input_image) > 1 and args.module is None and \
+        (args.input_image[-1].endswith('.py') or not os.path.isfile(args.input_image[-1])):
     args.module = args.input_image[-1]
     args.input_image = args.input_image[:-1]
-if type(args.input_image) is list or args.input_mjpg is not None:
+if type(args.input_batch) is list and len(args.input_batch) > 1 and args.module is None and \
+        args.input_batch[-1].endswith('.py'):
+    args.module = args.input_batch[-1]
+    args.input_batch = args.input_batch[:-1]
+if type(args.input_image) is list or args.input_mjpg is not None or args.input_batch is not None or \
+        args.input_cameras is not None:
     args.input_video = None
 if str(args.input_video).lstrip('-').isdigit():
     args.input_video = int(args.input_video)
+if args.capture_watchdog:
+    args.capture_thread = True
 
 # Start logging
 logging.basicConfig(
@@ -64,155 +137,383 @@ logging.basicConfig(
 )
 logging.debug('Starting %s', os.path.splitext(__file__)[0])
 
-# Dynamic import a Python algorithm file
-modfile = None
-
-# Look through command line arguments
-if modfile is None and args.module is not None:
-    if os.path.exists(args.module):
-        modfile = args.module
-    elif os.path.exists(args.module + '.py'):
-        modfile = args.module + '.py'
-
-# Look through current folder and all subfolders
-if modfile is None:
-    for root, dirs, files in os.walk(os.path.dirname(os.path.realpath(__file__))):
-        for file in files:
-            file = os.path.join(root, file)
-            if file.endswith('.py') and not os.path.samefile(file, __file__):
-                modfile = file
-                break
-        if modfile is not None:
-            break
-
-    dir = os.path.dirname(os.path.realpath(__file__))
-    for file in os.listdir(dir):
-        if file.endswith('.py') and not os.path.samefile(file, __file__):
-            modfile = file
-            break
+# Start profiling, report on exit
+if args.profile:
+    sharkcv.Profiler.enable()
+    atexit.register(lambda: logging.info('Profile:\n%s', sharkcv.Profiler.report()))
+
+# Frames created from here on (including in workers) are lazy
+sharkcv.Frame.lazy = args.lazy
+
+# Find the module's entry point, only ever what was asked for or registered
+registry = args.registry
+if registry is None:
+    registry = os.path.join(os.path.dirname(os.path.realpath(__file__)), sharkcv.module.REGISTRY)
+    if not os.path.exists(registry):
+        registry = None
+try:
+    entries = sharkcv.module.registry(registry) if registry is not None else {}
+    # Cameras name their own modules
+    modfile = sharkcv.module.resolve(args.module, entries) if args.input_cameras is None else None
+except Exception, e:
+    logging.error('No module to load: %s', str(e))
+    sys.exit(1)
 
 # Import the Python file
-if modfile is not None:
-    logging.debug('Found module: %s', os.path.relpath(modfile))
-    modfile = os.path.relpath(modfile)
+# Workers each import their own copy
+if args.input_cameras is not None:
+    pass
+elif args.input_batch is not None:
+    logging.info('Importing module in batch workers: %s', modfile)
+elif args.workers > 0:
+    logging.info('Importing module in %d workers: %s', args.workers, modfile)
+else:
     logging.info('Importing module: %s', modfile)
-    # Add module's directory to Python's path
-    moddir = os.path.dirname(os.path.abspath(modfile))
-    if moddir not in sys.path:
-        sys.path.insert(0, moddir)
-    # Import the module's basename
-    modname = os.path.splitext(os.path.basename(modfile))[0]
     try:
-        module = __import__(modname)
-        module = getattr(module, modname)
+        if args.module_reload:
+            module = sharkcv.module.Reloader(modfile)
+            logging.info('Reloading module when %s changes', module.filename)
+        else:
+            module = sharkcv.module.load(modfile)
     except Exception, e:
         logging.error('Import failed: %s', str(e))
         sys.exit(1)
-else:
-    logging.error('No module to load')
-    sys.exit(1)
+startup.append(('module', time.time()))
+
+# Sweep parameters over files and exit
+if args.input_batch is not None and args.sweep:
+    try:
+        ranking = sharkcv.sweep.run(modfile, args.input_batch, workers=args.workers, chunk=args.batch_chunk)
+    except Exception, e:
+        logging.error('Sweep failed: %s', str(e))
+        sys.exit(1)
+    for row in ranking[:args.sweep_top]:
+        logging.info('#%d score %.4f: %s', row['rank'], row['score'],
+                     ', '.join('%s=%s' % (key, row[key]) for key in sorted(row.keys())
+                               if key not in ('rank', 'score', 'frames')))
+    for output in args.batch_output:
+        sharkcv.batch.save(ranking, output, ('rank', 'score', 'frames'))
+    sys.exit(0)
+
+# Batch process files and exit
+if args.input_batch is not None:
+    try:
+        results = sharkcv.batch.run(modfile, args.input_batch, workers=args.workers, chunk=args.batch_chunk,
+                                    lazy=args.lazy)
+    except Exception, e:
+        logging.error('Batch failed: %s', str(e))
+        sys.exit(1)
+    for output in args.batch_output:
+        sharkcv.batch.save(results, output)
+    sys.exit(0)
+
+# Video/webcam options from the command line, webcam options in [0-255]
+video_options = {'width': args.video_width, 'height': args.video_height, 'fps': args.video_fps,
+                 'brightness': args.webcam_brightness, 'contrast': args.webcam_contrast,
+                 'exposure': args.webcam_exposure, 'gain': args.webcam_gain, 'hue': args.webcam_hue,
+                 'saturation': args.webcam_saturation}
+
+# Webcam option to OpenCV property
+webcam_properties = [('brightness', cv2.cv.CV_CAP_PROP_BRIGHTNESS), ('contrast', cv2.cv.CV_CAP_PROP_CONTRAST),
+                     ('exposure', cv2.cv.CV_CAP_PROP_EXPOSURE), ('gain', cv2.cv.CV_CAP_PROP_GAIN),
+                     ('hue', cv2.cv.CV_CAP_PROP_HUE), ('saturation', cv2.cv.CV_CAP_PROP_SATURATION)]
+
+
+# Open a video file/webcam and set its options, a video file's FPS is put in options
+def open_video(source, options):
+    logging.debug('Opening video: ' + str(source))
+    in_video = cv2.VideoCapture(source)
+    if in_video.isOpened():
+        # Get FPS from video file
+        if type(source) is not int:
+            options['fps'] = in_video.get(cv2.cv.CV_CAP_PROP_FPS)
+
+        # Set video options
+        if options.get('width') is not None:
+            in_video.set(cv2.cv.CV_CAP_PROP_FRAME_WIDTH, options['width'])
+        if options.get('height') is not None:
+            in_video.set(cv2.cv.CV_CAP_PROP_FRAME_HEIGHT, options['height'])
+        if options.get('fps') is not None:
+            in_video.set(cv2.cv.CV_CAP_PROP_FPS, options['fps'])
+
+        # Set webcam options
+        if type(source) is int:
+            for option, prop in webcam_properties:
+                if options.get(option) is not None:
+                    in_video.set(prop, options[option] / 255.0)
+
+        logging.info('Opened video: %.fx%.f @ %.1f FPS', in_video.get(cv2.cv.CV_CAP_PROP_FRAME_WIDTH),
+                     in_video.get(cv2.cv.CV_CAP_PROP_FRAME_HEIGHT), options.get('fps') or 0)
+    return in_video
+
+
+# Open an MJPG stream, None if it failed
+def open_mjpg(url):
+    logging.debug('Opening mjpg stream: ' + url)
+    mjpg = sharkcv.MJPGReader(url)
+    try:
+        mjpg.start()
+    except Exception, e:
+        logging.warning('Failed to open mjpg stream: %s', str(e))
+        return None
+    return mjpg
+
+
+# Whether an input is an MJPG stream rather than a video file/webcam
+def is_mjpg(source):
+    return str(source).startswith(('http://', 'https://'))
+
+
+# Capture watchdog: close a failed or stalled input and open it again, None to try again later
+def reopen(source, options, old):
+    if old is not None:
+        if isinstance(old, sharkcv.MJPGReader):
+            old.stop()
+        else:
+            old.release()
+    if is_mjpg(source):
+        return open_mjpg(source)
+    in_video = open_video(source, options)
+    return in_video if in_video.isOpened() else None
+
+
+# Log how long each startup stage took with the first frame
+def log_startup():
+    startup.append(('first frame', time.time()))
+    stages = []
+    last = started
+    for name, finished in startup:
+        sharkcv.Profiler.record('startup.' + name.replace(' ', '_'), finished - last)
+        stages.append('%s %.0f ms' % (name, 1000 * (finished - last)))
+        last = finished
+    logging.info('First frame after %.0f ms: %s', 1000 * (last - started), ', '.join(stages))
+
+
+# Process several cameras on one set of module workers and exit
+if args.input_cameras is not None:
+    if args.output_video is not None or args.output_image is not None:
+        logging.error('Output files are not supported with multiple cameras')
+        sys.exit(1)
+    try:
+        if registry is None:
+            raise ValueError('no module registry')
+        configs = sharkcv.scheduler.cameras(registry)
+        for name in args.input_cameras:
+            if name not in configs:
+                raise ValueError('no [camera %s] in %s' % (name, registry))
+    except Exception, e:
+        logging.error('No cameras to open: %s', str(e))
+        sys.exit(1)
+
+    # Open every camera, its section's options over the command line's
+    cameras = []
+    for name in args.input_cameras:
+        config = configs[name]
+        options = dict(video_options)
+        options.update((key, value) for key, value in config.items() if key in options)
+        source = config['input']
+        if is_mjpg(source):
+            opened = open_mjpg(source)
+        else:
+            opened = open_video(source, options)
+            if not opened.isOpened():
+                opened = None
+        watchdog = args.capture_watchdog and (type(source) is int or is_mjpg(source))
+        if opened is None and not watchdog:
+            logging.error('Failed to open camera %s: %s', name, str(source))
+            sys.exit(1)
+        modfile = None
+        if 'module' in config:
+            try:
+                modfile = sharkcv.module.resolve(config['module'], entries)
+            except Exception, e:
+                logging.error('No module to load for camera %s: %s', name, str(e))
+                sys.exit(1)
+        logging.info('Camera %s: %s -> %s', name, str(source), modfile or 'stream only')
+        # Live cameras always go to their newest frame, files only with -cl
+        capture = sharkcv.Capture(opened, size=max(args.capture_buffers, args.workers + 3) + (1 if watchdog else 0),
+                                  latest=args.capture_latest or type(source) is int or is_mjpg(source),
+                                  reopen=functools.partial(reopen, source, options) if watchdog else None,
+                                  timeout=args.capture_stale)
+        cameras.append(sharkcv.Camera(name, capture, module=modfile, priority=config.get('priority', 0),
+                                      fps=config.get('fps')))
+    try:
+        # Each camera's stream shows one result
+        scheduler = sharkcv.Scheduler(cameras, workers=args.workers, reload=args.module_reload,
+                                      hold=len(cameras) if args.mjpg else 0)
+    except Exception, e:
+        logging.error('Import failed: %s', str(e))
+        sys.exit(1)
+    startup.append(('input', time.time()))
+
+    # One stream per camera at /name.mjpg
+    mjpg_server = None
+    if args.mjpg:
+        logging.debug('Starting MJPG server on port %d', args.mjpg_port)
+        mjpg_server = sharkcv.StreamServer(args.mjpg_port, title=os.path.splitext(__file__)[0],
+                                           jpeg={'subsampling': args.mjpg_subsampling, 'fast': args.mjpg_fast,
+                                                 'backend': args.mjpg_encoder},
+                                           streams=args.input_cameras)
+        mjpg_server.start()
+
+    # Each camera publishes to its own subtable and UDP port (the given one plus its index)
+    publishers = {}
+    for index, name in enumerate(args.input_cameras):
+        backends = []
+        if args.publish_udp is not None:
+            host, port = args.publish_udp.rsplit(':', 1)
+            backends.append(sharkcv.UDPBackend(host, int(port) + index, keyframe=args.publish_keyframe))
+        if args.publish_table is not None:
+            backends.append(sharkcv.NetworkTablesBackend(args.publish_table + '/' + name, args.publish_address))
+        if len(backends) > 0:
+            publishers[name] = sharkcv.Publisher(backends)
+            publishers[name].start()
+    startup.append(('outputs', time.time()))
+
+    scheduler.start()
+    time_start = time.time()
+    frames_start = [0] * len(cameras)
+    stale_time = time.time()
+    published = dict((camera.name, stale_time) for camera in cameras)
+    while True:
+        try:
+            processed = scheduler.next(0.1)
+        except Exception, e:
+            logging.error('Module exception: %s', str(e))
+            break
+
+        # Keep stream clients of cameras the watchdog is getting back on their last frame marked stale, checked on
+        # every pass since the other cameras' frames keep next() from ever timing out
+        if mjpg_server is not None and time.time() - stale_time >= args.capture_stale:
+            stale_time = time.time()
+            for camera in cameras:
+                if camera.capture.down and stale_time - published[camera.name] >= args.capture_stale:
+                    mjpg_server.publish_stale(camera.name)
+
+        if processed is None:
+            if scheduler.done:
+                break
+            continue
+        camera, frame, modret = processed
+        if startup is not None:
+            log_startup()
+            startup = None
+
+        # Modules can return (frame, results), or just results, to publish
+        results = None
+        if type(modret) is tuple and len(modret) == 2 and type(modret[0]) is sharkcv.Frame:
+            modret, results = modret
+        elif modret is not None and type(modret) is not sharkcv.Frame:
+            results = modret
+        if camera.name in publishers and results is not None:
+            try:
+                publishers[camera.name].publish(results, camera.frames - 1, frame.timestamp)
+            except Exception, e:
+                logging.error('Failed to publish results: %s', str(e))
+        sharkcv.Profiler.record('latency.' + camera.name, time.time() - frame.timestamp)
+
+        if mjpg_server is not None and type(modret) is sharkcv.Frame:
+            mjpg_server.publish(modret, camera.name)
+            published[camera.name] = time.time()
+
+        # Frames processed a second per camera
+        if sum(camera.frames for camera in cameras) - sum(frames_start) >= 100:
+            elapsed = time.time() - time_start
+            logging.info('FPS: %s', ', '.join('%s %.1f' % (camera.name, (camera.frames - frames_start[index]) / elapsed)
+                                               for index, camera in enumerate(cameras)))
+            time_start = time.time()
+            frames_start = [camera.frames for camera in cameras]
+
+    scheduler.stop()
+    for publisher in publishers.values():
+        publisher.stop()
+    if mjpg_server is not None:
+        mjpg_server.stop()
+    sys.exit(0)
 
 # Main image loop
 while True:
     # Open input video and set options
     in_video = None
     if args.input_video is not None:
-        logging.debug('Opening video: ' + str(args.input_video))
-        in_video = cv2.VideoCapture(args.input_video)
-        if in_video.isOpened():
-            # Get FPS from video file
-            if type(args.input_video) is not int:
-                args.video_fps = in_video.get(cv2.cv.CV_CAP_PROP_FPS)
-
-            # Set video options
-            if args.video_width is not None:
-                in_video.set(cv2.cv.CV_CAP_PROP_FRAME_WIDTH, args.video_width)
-            if args.video_height is not None:
-                in_video.set(cv2.cv.CV_CAP_PROP_FRAME_HEIGHT, args.video_height)
-            if args.video_fps is not None:
-                in_video.set(cv2.cv.CV_CAP_PROP_FPS, args.video_fps)
-
-            # Set webcam options
-            if type(args.input_video) is int:
-                if args.webcam_brightness is not None:
-                    in_video.set(cv2.cv.CV_CAP_PROP_BRIGHTNESS, args.webcam_brightness / 255.0)
-                if args.webcam_contrast is not None:
-                    in_video.set(cv2.cv.CV_CAP_PROP_CONTRAST, args.webcam_contrast / 255.0)
-                if args.webcam_exposure is not None:
-                    in_video.set(cv2.cv.CV_CAP_PROP_EXPOSURE, args.webcam_exposure / 255.0)
-                if args.webcam_gain is not None:
-                    in_video.set(cv2.cv.CV_CAP_PROP_GAIN, args.webcam_gain / 255.0)
-                if args.webcam_hue is not None:
-                    in_video.set(cv2.cv.CV_CAP_PROP_HUE, args.webcam_hue / 255.0)
-                if args.webcam_saturation is not None:
-                    in_video.set(cv2.cv.CV_CAP_PROP_SATURATION, args.webcam_saturation / 255.0)
-
-            logging.info('Opened video: %.fx%.f @ %.1f FPS', in_video.get(cv2.cv.CV_CAP_PROP_FRAME_WIDTH),
-                         in_video.get(cv2.cv.CV_CAP_PROP_FRAME_HEIGHT), args.video_fps)
+        in_video = open_video(args.input_video, video_options)
+
+    # Open input MJPG stream
+    mjpg = None
+    if args.input_mjpg is not None:
+        mjpg = open_mjpg(args.input_mjpg)
+    if startup is not None:
+        startup.append(('input', time.time()))
+
+    # Start threaded capture, the watchdog keeps trying webcams and streams that failed to open
+    capture = None
+    watchdog = args.capture_watchdog and (type(args.input_video) is int or args.input_mjpg is not None)
+    if args.capture_thread and ((in_video is not None and in_video.isOpened()) or mjpg is not None or watchdog):
+        logging.debug('Starting capture thread (%d buffers%s%s)', args.capture_buffers,
+                      ', latest only' if args.capture_latest else '', ', watchdog' if watchdog else '')
+        # Frames in flight to workers hold on to their capture buffers, the watchdog to the last frame
+        capture = sharkcv.Capture(mjpg if args.input_mjpg is not None else in_video,
+                                  size=max(args.capture_buffers, args.workers + 3) + (1 if watchdog else 0),
+                                  latest=args.capture_latest,
+                                  reopen=functools.partial(reopen, args.input_mjpg or args.input_video,
+                                                           video_options) if watchdog else None,
+                                  timeout=args.capture_stale)
+        capture.start()
 
     mjpg_server = None
     if args.mjpg:
-        mjpg_frame = None
-
-        class ThreadedTCPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
-            pass
-
-        class Streamer(BaseHTTPServer.BaseHTTPRequestHandler):
-            # Silence BaseHTTPServer console output
-            def log_message(self, fmt, *args):
-                return
-
-            def do_GET(self):
-                logging.debug('GET: ' + self.path)
-
-                # Serve HTML page
-                if self.path == '/':
-                    self.send_response(200)
-                    self.send_header('Content-type', 'text/html')
-                    self.end_headers()
-                    self.wfile.write('<html><head><title>'+os.path.splitext(__file__)[0]+'</title></head>')
-                    self.wfile.write('<body><img src="/stream.mjpg" style="width:100%;"/></body>')
-                    self.wfile.write('</html>')
-
-                # Serve MJPG stream
-                if self.path.endswith('.mjpg'):
-                    self.send_response(200)
-                    self.send_header('Content-type', 'multipart/x-mixed-replace; boundary=--jpgboundary')
-                    self.end_headers()
-                    while True:
-                        try:
-                            if mjpg_frame is not None:
-                                self.wfile.write('--jpgboundary\r\n')
-                                self.send_header('Content-type', 'image/jpeg')
-                                self.send_header('Content-length', str(len(mjpg_frame)))
-                                self.end_headers()
-                                self.wfile.write(bytearray(mjpg_frame))
-                                self.wfile.write('\r\n')
-                        except:
-                            pass
-                        time.sleep(1 / args.video_fps)
-
-        mjpg_server = ThreadedTCPServer(('', args.mjpg_port), Streamer)
-        mjpg_server.daemon_threads = True
-        mjpg_thread = threading.Thread(target=mjpg_server.serve_forever)
-        mjpg_thread.setDaemon(True)
-        mjpg_thread.start()
+        logging.debug('Starting MJPG server on port %d', args.mjpg_port)
+        mjpg_server = sharkcv.StreamServer(args.mjpg_port, title=os.path.splitext(__file__)[0],
+                                           jpeg={'subsampling': args.mjpg_subsampling, 'fast': args.mjpg_fast,
+                                                 'backend': args.mjpg_encoder})
+        logging.debug('MJPG encoder: %s', mjpg_server.encoder.backend)
+        mjpg_server.start()
+
+    # Start publishing results
+    publisher = None
+    backends = []
+    if args.publish_udp is not None:
+        host, port = args.publish_udp.rsplit(':', 1)
+        logging.debug('Publishing results to UDP %s:%s', host, port)
+        backends.append(sharkcv.UDPBackend(host, int(port), keyframe=args.publish_keyframe))
+    if args.publish_table is not None:
+        logging.debug('Publishing results to NetworkTable %s', args.publish_table)
+        backends.append(sharkcv.NetworkTablesBackend(args.publish_table, args.publish_address))
+    if len(backends) > 0:
+        publisher = sharkcv.Publisher(backends)
+        publisher.start()
+    frame_id = 0
+
+    # Start module workers, with shared buffers for the results writers queue (and the one being written) and the
+    # stream shows
+    pool = None
+    if args.workers > 0:
+        writers = len([output for output in (args.output_video, args.output_image) if output is not None])
+        pool = sharkcv.Pool(modfile, args.workers, reload=args.module_reload,
+                            hold=writers * (args.output_queue + 1) + (1 if args.mjpg else 0))
 
     # Prep input image(s)
     input_image_idx = 0
+    input_done = False
 
-    # Open input MJPG stream
-    mjpg = None
-    mjpg_bytes = ''
-    if args.input_mjpg is not None:
-        logging.debug('Opening mjpg stream: ' + args.input_mjpg)
-        mjpg = urllib2.urlopen(args.input_mjpg)
-
-    # Prep output video file
+    # Start output file writers (video is opened with the first frame written)
     out_video = None
-
-    # Set up FPS list and iterator
+    if args.output_video is not None:
+        output_video = datetime.now().strftime(args.output_video)
+        out_video = sharkcv.VideoWriter(output_video, video_options['fps'], size=args.output_queue,
+                                        policy=args.output_policy, every=args.output_every)
+        out_video.start()
+    out_image = None
+    if args.output_image is not None:
+        out_image = sharkcv.ImageWriter(size=args.output_queue, policy=args.output_policy, every=args.output_every)
+        out_image.start()
+
+    if startup is not None:
+        startup.append(('outputs', time.time()))
+
+    # Set up FPS/latency lists and iterator
     times = [0] * 25
+    latencies = [0] * len(times)
     time_idx = 0
     time_start = time.time()
 
@@ -220,56 +521,106 @@ while True:
     while True:
         # Get a frame to process
         frame = None
+        stage_start = time.time()
+
+        # Read input video from capture thread
+        if input_done:
+            pass
+        elif capture is not None:
+            frame = capture.read()
+            if frame is None:
+                if type(args.input_video) is int:
+                    logging.warning('Failed to read webcam frame')
+                input_done = True
+            elif capture.stale:
+                # The watchdog is getting the input back, keep stream clients on the last frame marked stale
+                if mjpg_server is not None:
+                    mjpg_server.publish_stale()
+                continue
 
         # Read input video
-        if in_video is not None and in_video.isOpened():
+        elif in_video is not None and in_video.isOpened():
             ret, frame = in_video.read()
-            if not ret:
+            if ret:
+                frame = sharkcv.Frame(frame, timestamp=time.time())
+            else:
                 if type(args.input_video) is int:
                     logging.warning('Failed to read webcam frame')
-                break
-            frame = sharkcv.Frame(frame)
+                frame = None
+                input_done = True
 
         # Read input image(s)
-        if type(args.input_image) is list:
+        if input_done:
+            pass
+        elif type(args.input_image) is list and input_image_idx >= len(args.input_image):
+            input_done = True
+        elif type(args.input_image) is list:
             if not os.path.exists(args.input_image[input_image_idx]):
                 logging.error('Input image does not exist: %s', args.input_image[input_image_idx])
                 sys.exit(1)
             logging.debug('Reading image: %s', args.input_image[input_image_idx])
-            frame = sharkcv.Frame(cv2.imread(args.input_image[input_image_idx], cv2.IMREAD_COLOR))
+            frame = sharkcv.Frame(cv2.imread(args.input_image[input_image_idx], cv2.IMREAD_COLOR),
+                                  timestamp=time.time())
             input_image_idx += 1
 
-        # Read input mjpg stream
-        if mjpg is not None:
-            while True:
-                mjpg_bytes += mjpg.read(1024)
-                a = mjpg_bytes.find('\xff\xd8')
-                b = mjpg_bytes.find('\xff\xd9')
-                if a != -1 and b != -1:
-                    jpg = mjpg_bytes[a:b + 2]
-                    mjpg_bytes = mjpg_bytes[b + 2:]
-                    frame = sharkcv.Frame(cv2.imdecode(np.fromstring(jpg, dtype=np.uint8), cv2.CV_LOAD_IMAGE_COLOR))
-                    break
+        sharkcv.Profiler.record('read', time.time() - stage_start)
 
-        if frame is None:
+        # Read input mjpg stream
+        if mjpg is not None and capture is None and not input_done:
+            stage_start = time.time()
+            ret, frame = mjpg.read()
+            sharkcv.Profiler.record('decode', time.time() - stage_start)
+            if ret:
+                frame = sharkcv.Frame(frame, timestamp=mjpg.timestamp)
+            else:
+                logging.warning('Failed to read mjpg frame')
+                frame = None
+                input_done = True
+
+        if frame is None and not input_done:
             logging.warning('Failed to get a frame')
-            break
+            input_done = True
 
         # Execute module file
         modret = None
+        stage_start = time.time()
         try:
-            modret = module(frame)
+            if pool is not None:
+                if frame is not None:
+                    pool.submit(frame)
+                # Keep every worker busy before waiting on the oldest frame
+                if not input_done and pool.pending < pool.workers:
+                    continue
+                if pool.pending == 0:
+                    break
+                frame, modret = pool.get()
+            else:
+                if input_done:
+                    break
+                modret = module(frame)
         except Exception, e:
             logging.error('Module exception: %s', str(e))
             sys.exit(1)
-
-        # Open output video file (delayed so frame width/height is known)
-        if args.output_video is not None and out_video is None and type(modret) is sharkcv.Frame:
-            output_video = datetime.now().strftime(args.output_video)
-            logging.debug('Opening output video: %s', output_video)
-            fourcc = cv2.cv.CV_FOURCC(*'DIVX')
-            out_video = cv2.VideoWriter(output_video, fourcc, args.video_fps, (int(frame.width), int(frame.height)))
-        # Write to output video
+        sharkcv.Profiler.record('module', time.time() - stage_start)
+
+        # Modules can return (frame, results), or just results, to publish
+        results = None
+        if type(modret) is tuple and len(modret) == 2 and type(modret[0]) is sharkcv.Frame:
+            modret, results = modret
+        elif modret is not None and type(modret) is not sharkcv.Frame:
+            results = modret
+        if publisher is not None and results is not None:
+            try:
+                publisher.publish(results, frame_id, frame.timestamp)
+            except Exception, e:
+                logging.error('Failed to publish results: %s', str(e))
+        frame_id += 1
+
+        latency = time.time() - frame.timestamp
+        sharkcv.Profiler.record('latency', latency)
+        stage_start = time.time()
+
+        # Write to output video (queued, written on the writer thread)
         if out_video is not None:
             # Write to output video
             if type(modret) is sharkcv.Frame:
@@ -278,42 +629,78 @@ while True:
                 frame.write_video(out_video)
 
         # Write to output image
-        if args.output_image is not None:
+        if out_image is not None:
             output_image = datetime.now().strftime(args.output_image)
-            logging.debug('Writing image: %s', output_image)
             if type(modret) is sharkcv.Frame:
-                modret.write_image(output_image)
+                modret.write_image(output_image, out_image)
             elif type(frame) is sharkcv.Frame and type(args.input_video) is int:
-                frame.write_image(output_image)
+                frame.write_image(output_image, out_image)
 
-        # Copy for MJPG stream
-        if mjpg_server is not None:
-            mjpg_frame = copy.deepcopy(modret)
-            mjpg_frame.color_bgr()
-            mjpg_frame = mjpg_frame.jpeg()
+        sharkcv.Profiler.record('write', time.time() - stage_start)
 
-        # Break loop if only one frame to process
-        if type(args.input_image) is list and input_image_idx >= len(args.input_image):
-            break
+        # Send to MJPG stream
+        if mjpg_server is not None and type(modret) is sharkcv.Frame:
+            stage_start = time.time()
+            mjpg_server.publish(modret)
+            sharkcv.Profiler.record('stream', time.time() - stage_start)
+
+        # Report how long each startup stage took, once the first frame is through
+        if startup is not None:
+            log_startup()
+            startup = None
 
         # Compute FPS information
         time_end = time.time()
         times[time_idx] = time_end - time_start
+        latencies[time_idx] = latency
         time_idx += 1
         if time_idx >= len(times):
-            logging.info('Average FPS: %.1f', 1 / (sum(times) / len(times)))
+            logging.info('Average FPS: %.1f, latency: %.1f ms%s', 1 / (sum(times) / len(times)),
+                         1000 * sum(latencies) / len(latencies),
+                         ', dropped: %d' % capture.dropped if capture is not None else '')
+            logging.debug('Frame allocations: %s', sharkcv.Frame.allocations(reset=True))
+            if capture is not None and capture.reconnects > 0:
+                logging.debug('Capture: %d reconnects, %.1f s down, %d stale frames', capture.reconnects,
+                              capture.downtime, capture.stale_frames)
+            for writer in (out_video, out_image):
+                if writer is not None:
+                    logging.debug('Output %s: %d queued, %d written, %d dropped', writer.name, writer.queued,
+                                  writer.written, writer.dropped)
             time_idx = 0
         if time_idx > 0 and time_idx % 5 == 0:
-            logging.debug('Average FPS: %.1f', 1 / (sum(times) / len(times)))
+            logging.debug('Average FPS: %.1f, latency: %.1f ms', 1 / (sum(times) / len(times)),
+                          1000 * sum(latencies[:time_idx]) / time_idx)
         time_start = time_end
 
+    # Stop module workers
+    if pool is not None:
+        pool.stop()
+
+    # Stop publishing results
+    if publisher is not None:
+        publisher.stop()
+
     # Release open MJPG stream
     if mjpg_server is not None:
-        mjpg_server.shutdown()
+        mjpg_server.stop()
 
-    # Release open output video
+    # Finish writing output files
     if out_video is not None:
-        out_video.release()
+        out_video.stop()
+    if out_image is not None:
+        out_image.stop()
+
+    # Stop capture thread, the watchdog may have reopened the input
+    if capture is not None:
+        capture.stop()
+        if args.input_mjpg is not None:
+            mjpg = capture.source
+        else:
+            in_video = capture.source
+
+    # Close input MJPG stream
+    if mjpg is not None:
+        mjpg.stop()
 
     # Release open input video
     if in_video is not None:
@@ -0,0 +1,134 @@
+#!/usr/bin/env python2
+'''
+MJPG input parsing benchmark
+
+Compares the old string-concatenating marker scan against sharkcv.MJPGParser on the same synthetic stream, then
+reads the stream through sharkcv.MJPGReader from a local stand-in HTTP server to check nothing is lost in transit.
+
+$ python benchmarks/mjpg_input.py [-n frames] [-W width] [-H height] [--no-length]
+'''
+
+import argparse
+import os
+import socket
+import sys
+import threading
+import time
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+import sharkcv
+
+
+# Build a multipart stream of synthetic JPEGs
+def make_stream(frames, width, height, content_length):
+    jpegs = []
+    for i in range(frames):
+        ndarray = np.zeros((height, width, 3), dtype=np.uint8)
+        cv2.circle(ndarray, ((i * 7) % width, height / 2), height / 4, (0, 255, 0), -1)
+        cv2.putText(ndarray, str(i), (10, height - 10), cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2)
+        jpegs.append(cv2.imencode('.jpeg', ndarray)[1].tostring())
+    parts = []
+    for jpeg in jpegs:
+        headers = '--jpgboundary\r\nContent-type: image/jpeg\r\n'
+        if content_length:
+            headers += 'Content-length: %d\r\n' % len(jpeg)
+        parts.append(headers + '\r\n' + jpeg + '\r\n')
+    return ''.join(parts), jpegs
+
+
+# The pre-MJPGParser algorithm from SharkCV.py
+def parse_old(stream, chunk):
+    found = 0
+    mjpg_bytes = ''
+    for i in range(0, len(stream), chunk):
+        mjpg_bytes += stream[i:i + chunk]
+        while True:
+            a = mjpg_bytes.find('\xff\xd8')
+            b = mjpg_bytes.find('\xff\xd9')
+            if a == -1 or b == -1:
+                break
+            mjpg_bytes = mjpg_bytes[b + 2:]
+            found += 1
+    return found
+
+
+def parse_new(stream, chunk):
+    parser = sharkcv.MJPGParser()
+    for i in range(0, len(stream), chunk):
+        parser.feed(stream[i:i + chunk])
+    return parser.frames
+
+
+# Stand-in for mjpg-streamer: serve the stream once to the first client
+def serve(stream, port_ready):
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    port_ready.append(listener.getsockname()[1])
+    client, _ = listener.accept()
+    client.recv(4096)
+    client.sendall('HTTP/1.0 200 OK\r\nContent-type: multipart/x-mixed-replace; boundary=--jpgboundary\r\n\r\n')
+    client.sendall(stream)
+    client.close()
+    listener.close()
+
+
+def report(name, seconds, frames, nbytes):
+    print '%-28s %8.1f MB/s %10.1f frames/s' % (name, nbytes / seconds / 1e6, frames / seconds)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog=__file__)
+    parser.add_argument('-n', dest='frames', type=int, default=300, help='frames (default: 300)')
+    parser.add_argument('-W', dest='width', type=int, default=640, help='width (default: 640)')
+    parser.add_argument('-H', dest='height', type=int, default=480, help='height (default: 480)')
+    parser.add_argument('--no-length', dest='content_length', action='store_false', default=True,
+                        help='leave out Content-length headers')
+    args = parser.parse_args()
+
+    stream, jpegs = make_stream(args.frames, args.width, args.height, args.content_length)
+    print '%d frames, %.1f KB average JPEG, %s' % (args.frames, len(stream) / 1024.0 / args.frames,
+                                                  'Content-length' if args.content_length else 'markers only')
+
+    for chunk in (1024, 65536):
+        start = time.time()
+        found = parse_old(stream, chunk)
+        report('old, %d byte reads' % chunk, time.time() - start, found, len(stream))
+        start = time.time()
+        found = parse_new(stream, chunk)
+        report('MJPGParser, %d byte reads' % chunk, time.time() - start, found, len(stream))
+        if found != len(jpegs):
+            print 'MJPGParser found %d of %d frames' % (found, len(jpegs))
+            sys.exit(1)
+
+    # End to end through a socket, the reader only keeps the newest frame so count what the parser saw
+    port = []
+    server = threading.Thread(target=serve, args=(stream, port))
+    server.setDaemon(True)
+    server.start()
+    while len(port) == 0:
+        time.sleep(0.01)
+    reader = sharkcv.MJPGReader('http://127.0.0.1:%d/stream.mjpg' % port[0])
+    start = time.time()
+    reader.start()
+    decoded = 0
+    while True:
+        ret, ndarray = reader.read()
+        if not ret:
+            break
+        decoded += 1
+    seconds = time.time() - start
+    reader.stop()
+    report('MJPGReader over HTTP', seconds, reader.parser.frames, reader.parser.bytes)
+    print '%d frames received, %d decoded, %d skipped as stale' % (reader.parser.frames, decoded,
+                                                                    reader.parser.frames - decoded)
+    if reader.parser.frames != len(jpegs):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,346 @@
+#!/usr/bin/env python2
+'''
+Frame/Contour pipeline benchmark
+
+Runs vision pipelines (the samples' GRIP pipelines without NetworkTables, and optionally your own modules) over
+synthetic target frames and recorded clips at several resolutions, without a camera. Measures end-to-end throughput
+and latency percentiles, per-operation times (through sharkcv.Profiler), peak memory and scratch pool allocations.
+
+Results can be saved as JSON and compared against a saved baseline, exiting non-zero on a regression:
+$ python benchmarks/pipelines.py -o baseline.json
+$ python benchmarks/pipelines.py --baseline baseline.json [--tolerance 0.15]
+
+$ python benchmarks/pipelines.py [-n frames] [-R repeats] [-r 320x240,640x480] [-p pipeline,...] [-i clip.avi|dir|'*.png' ...]
+                                 [-m module.py ...] [--lazy] [--no-synthetic] [-o results.json] [--baseline file]
+'''
+
+import argparse
+import glob
+import json
+import os
+import platform
+import resource
+import sys
+import time
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+import sharkcv
+import sharkcv.module
+
+# Results format, bumped when keys change meaning
+VERSION = 1
+
+# HLS ranges from samples/GRIP_2016_1.py and GRIP_2016_2.py
+RANGE_1 = ([63, 55, 168], [96, 161, 255])
+RANGE_2 = ([85, 144, 44], [130, 188, 101])
+
+IMAGE_EXTENSIONS = ('.bmp', '.jpeg', '.jpg', '.png', '.ppm', '.tif', '.tiff')
+
+
+# Contours of targets, the way the samples find them
+def detect_threshold(frame):
+    frame.color_hls()
+    mask = frame.threshold(*RANGE_1)
+    mask.contours_filter(area=(400, -1))
+    return mask.contours
+
+
+def detect_lut(frame):
+    mask = frame.threshold_lut('HLS', [RANGE_1])
+    mask.contours_filter(area=(400, -1))
+    return mask.contours
+
+
+def detect_pyramid(frame):
+    mask = frame.threshold_pyramid(RANGE_1[0], RANGE_1[1], color='HLS')
+    mask.contours_filter(area=(400, -1))
+    return mask.contours
+
+
+def detect_two(frame):
+    frame.color_hls()
+    mask = frame.threshold(*RANGE_2)
+    mask.bit_or(frame.threshold(*RANGE_1))
+    mask.dilate(size=11, iterations=2)
+    mask.contours_filter(area=(400, -1))
+    return mask.contours
+
+
+def detect_two_lut(frame):
+    mask = frame.threshold_lut('HLS', [RANGE_2, RANGE_1])
+    mask.dilate(size=11, iterations=2)
+    mask.contours_filter(area=(400, -1))
+    return mask.contours
+
+
+def tracked():
+    tracker = sharkcv.Tracker()
+    return lambda frame: tracker.update(frame, detect_lut)
+
+
+# Name to a function returning a fresh pipeline (so stateful ones start over for every run)
+PIPELINES = {
+    'threshold': lambda: detect_threshold,
+    'threshold_lut': lambda: detect_lut,
+    'threshold_pyramid': lambda: detect_pyramid,
+    'grip_2016_2': lambda: detect_two,
+    'grip_2016_2_lut': lambda: detect_two_lut,
+    'tracker': tracked,
+}
+
+
+# BGR color inside RANGE_1 (and outside RANGE_2)
+def target_color():
+    hls = np.array([[[80, 110, 220]]], dtype=np.uint8)
+    return tuple(int(c) for c in cv2.cvtColor(hls, cv2.COLOR_HLS2BGR)[0, 0])
+
+
+# Frames of two U shaped targets moving across a noisy background with clutter, same for the same seed
+def synthetic(width, height, count, seed=0):
+    random = np.random.RandomState(seed)
+    color = target_color()
+    scale = width / 320.0
+    clutter = [(random.randint(0, width), random.randint(0, height), random.randint(5, 40) * scale,
+                random.randint(5, 40) * scale, tuple(int(c) for c in random.randint(0, 256, 3)))
+               for _ in range(12)]
+    ndarrays = []
+    for i in range(count):
+        ndarray = random.normal(60, 20, (height, width, 3)).clip(0, 255).astype(np.uint8)
+        for x, y, w, h, c in clutter:
+            cv2.rectangle(ndarray, (x, y), (int(x + w), int(y + h)), c, -1)
+        for t, (start, speed) in enumerate(((0.2, 3), (0.6, -2))):
+            x = int((start * width + i * speed * scale) % (width - 50 * scale))
+            y = int(height * (0.3 + 0.3 * t))
+            w, h, thickness = int(40 * scale), int(30 * scale), max(int(6 * scale), 1)
+            cv2.rectangle(ndarray, (x, y), (x + thickness, y + h), color, -1)
+            cv2.rectangle(ndarray, (x + w - thickness, y), (x + w, y + h), color, -1)
+            cv2.rectangle(ndarray, (x, y + h - thickness), (x + w, y + h), color, -1)
+        ndarrays.append(ndarray)
+    return ndarrays
+
+
+# Frames from a video file, image file, directory of images or glob of images
+def recorded(path, count):
+    ndarrays = []
+    if os.path.isdir(path):
+        paths = sorted(p for p in glob.glob(os.path.join(path, '*')) if p.lower().endswith(IMAGE_EXTENSIONS))
+    elif os.path.isfile(path) and not path.lower().endswith(IMAGE_EXTENSIONS):
+        capture = cv2.VideoCapture(path)
+        while len(ndarrays) < count:
+            ret, ndarray = capture.read()
+            if not ret:
+                break
+            ndarrays.append(ndarray)
+        capture.release()
+        paths = []
+    else:
+        paths = sorted(glob.glob(path))
+    for p in paths[:count]:
+        ndarray = cv2.imread(p)
+        if ndarray is not None:
+            ndarrays.append(ndarray)
+    if len(ndarrays) == 0:
+        raise ValueError('No frames read from %s' % path)
+    return ndarrays
+
+
+def percentiles(samples):
+    samples = np.array(samples) * 1000
+    return {
+        'mean': float(samples.mean()),
+        'p50': float(np.percentile(samples, 50)),
+        'p95': float(np.percentile(samples, 95)),
+        'p99': float(np.percentile(samples, 99)),
+        'max': float(samples.max()),
+    }
+
+
+# Make sure lazy frames actually ran
+def finish(result):
+    if isinstance(result, sharkcv.Frame):
+        result.ndarray
+    elif result is not None and hasattr(result, '__len__'):
+        len(result)
+
+
+# Run a pipeline over ndarrays (cycling through them) after warming up caches and the scratch pool
+def run(pipeline, ndarrays, frames, warmup, lazy):
+    sharkcv.Frame.lazy = lazy
+    for i in range(warmup):
+        finish(pipeline(sharkcv.Frame(ndarrays[i % len(ndarrays)])))
+    sharkcv.Profiler.reset()
+    sharkcv.Frame.allocations(reset=True)
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    latencies = []
+    start = time.time()
+    for i in range(frames):
+        ndarray = ndarrays[i % len(ndarrays)]
+        frame_start = time.time()
+        finish(pipeline(sharkcv.Frame(ndarray)))
+        latencies.append(time.time() - frame_start)
+    seconds = time.time() - start
+    sharkcv.Frame.lazy = False
+    # Times nest, so per op totals add up to more than the latency
+    ops = {}
+    for name, stats in sharkcv.Profiler.stats().items():
+        stats['per_frame'] = stats['total'] / frames
+        ops[name] = stats
+    return {
+        'frames': frames,
+        'fps': frames / seconds,
+        'latency': percentiles(latencies),
+        'ops': ops,
+        # Kilobytes on Linux, peak of the whole process so far (runs go smallest resolution first)
+        'maxrss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'maxrss_growth': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - maxrss,
+        'allocations': sharkcv.Frame.allocations(reset=True),
+    }
+
+
+# List of (key, message) for results worse than the baseline by more than tolerance (a fraction)
+# Operations faster than min_ms per frame in the baseline are too noisy to compare
+def compare(results, baseline, tolerance, min_ms):
+    regressions = []
+    for key in sorted(results.keys()):
+        if key not in baseline:
+            continue
+        new, old = results[key], baseline[key]
+        for p in ('p50', 'p95'):
+            if new['latency'][p] > old['latency'][p] * (1 + tolerance):
+                regressions.append((key, 'latency %s %.3f ms -> %.3f ms' % (p, old['latency'][p],
+                                                                            new['latency'][p])))
+        if new['fps'] < old['fps'] / (1 + tolerance):
+            regressions.append((key, 'fps %.1f -> %.1f' % (old['fps'], new['fps'])))
+        for name in sorted(old['ops'].keys()):
+            if name not in new['ops'] or old['ops'][name]['per_frame'] < min_ms:
+                continue
+            before, after = old['ops'][name]['per_frame'], new['ops'][name]['per_frame']
+            if after > before * (1 + tolerance):
+                regressions.append((key, '%s %.3f ms/frame -> %.3f ms/frame' % (name, before, after)))
+        # Steady state should reuse scratch arrays, any new allocations are a leak in the pool
+        if sum(new['allocations'].values()) > sum(old['allocations'].values()):
+            regressions.append((key, 'allocations %s -> %s' % (old['allocations'], new['allocations'])))
+    return regressions
+
+
+def environment():
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'opencv': cv2.__version__,
+        'numpy': np.__version__,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+
+def resolution(text):
+    width, height = text.lower().split('x')
+    return int(width), int(height)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog=__file__)
+    parser.add_argument('-n', dest='frames', type=int, default=200, help='frames per run (default: 200)')
+    parser.add_argument('-w', dest='warmup', type=int, default=20, help='warmup frames per run (default: 20)')
+    parser.add_argument('-r', dest='resolutions', default='320x240,640x480,1280x960',
+                        help='comma separated resolutions (default: 320x240,640x480,1280x960)')
+    parser.add_argument('-p', dest='pipelines', default=','.join(sorted(PIPELINES.keys())),
+                        help='comma separated pipelines (default: all of %s)' % ', '.join(sorted(PIPELINES.keys())))
+    parser.add_argument('-m', dest='modules', action='append', default=[],
+                        help='module file to benchmark too, like SharkCV.py runs it (repeatable)')
+    parser.add_argument('-i', dest='inputs', action='append', default=[],
+                        help='video file, image directory or image glob to run on too (repeatable)')
+    parser.add_argument('-R', dest='repeats', type=int, default=3,
+                        help='runs of each pipeline, the one with the lowest median latency is kept (default: 3)')
+    parser.add_argument('-s', dest='synthetic', type=int, default=30,
+                        help='distinct synthetic frames (default: 30)')
+    parser.add_argument('--no-synthetic', dest='use_synthetic', action='store_false', default=True,
+                        help='only run on -i inputs')
+    parser.add_argument('--lazy', dest='lazy', action='store_true', default=False,
+                        help='also run every pipeline with lazy frames')
+    parser.add_argument('-o', dest='output', help='write results as JSON')
+    parser.add_argument('--baseline', dest='baseline', help='JSON results to compare against')
+    parser.add_argument('--tolerance', dest='tolerance', type=float, default=0.15,
+                        help='fraction slower than the baseline that counts as a regression (default: 0.15)')
+    parser.add_argument('--min-ms', dest='min_ms', type=float, default=0.05,
+                        help='ignore operations faster than this many ms per frame in the baseline (default: 0.05)')
+    parser.add_argument('--ops', dest='ops', action='store_true', default=False,
+                        help='print per-operation times of every run')
+    args = parser.parse_args()
+
+    pipelines = []
+    for name in args.pipelines.split(','):
+        if name not in PIPELINES:
+            parser.error('Unknown pipeline: %s' % name)
+        pipelines.append((name, PIPELINES[name]))
+    for modfile in args.modules:
+        function = sharkcv.module.load(modfile)
+        pipelines.append((os.path.basename(modfile), lambda function=function: function))
+
+    resolutions = sorted(resolution(r) for r in args.resolutions.split(','))
+    sources = []
+    if args.use_synthetic:
+        sources.append(('synthetic', None))
+    for path in args.inputs:
+        sources.append((os.path.basename(path.rstrip('/')) or path, recorded(path, args.frames)))
+
+    sharkcv.Profiler.enable()
+    results = {}
+    print '%-48s %8s %8s %8s %8s %8s %8s  %s' % ('run', 'fps', 'mean', 'p50', 'p95', 'p99', 'max', 'allocations')
+    for width, height in resolutions:
+        for source, ndarrays in sources:
+            if ndarrays is None:
+                frames = synthetic(width, height, args.synthetic)
+            else:
+                frames = [cv2.resize(ndarray, (width, height), interpolation=cv2.INTER_AREA)
+                          for ndarray in ndarrays]
+            for name, factory in pipelines:
+                for lazy in ((False, True) if args.lazy else (False,)):
+                    key = '%s/%s/%dx%d%s' % (name, source, width, height, '/lazy' if lazy else '')
+                    # Best of a few runs, so other load on the machine is less likely to look like a regression
+                    result = min((run(factory(), frames, args.frames, args.warmup, lazy)
+                                  for _ in range(args.repeats)), key=lambda result: result['latency']['p50'])
+                    result.update({'pipeline': name, 'input': source, 'width': width, 'height': height,
+                                   'lazy': lazy})
+                    results[key] = result
+                    latency = result['latency']
+                    print '%-48s %8.1f %8.3f %8.3f %8.3f %8.3f %8.3f  %s' % (
+                        key, result['fps'], latency['mean'], latency['p50'], latency['p95'], latency['p99'],
+                        latency['max'], sum(result['allocations'].values()))
+                    if args.ops:
+                        for op in sorted(result['ops'].keys(), key=lambda op: -result['ops'][op]['total']):
+                            stats = result['ops'][op]
+                            print '    %-44s %8.3f ms/frame %8.3f p50 %8.3f p95' % (
+                                op, stats['per_frame'], stats['p50'], stats['p95'])
+    print 'Peak memory: %d KB' % resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'version': VERSION, 'environment': environment(), 'results': results}, f, indent=1,
+                      sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('version') != VERSION:
+            print 'Baseline %s is format version %s, expected %d' % (args.baseline, baseline.get('version'), VERSION)
+            sys.exit(2)
+        if baseline['environment'].get('machine') != platform.machine():
+            print 'Warning: baseline is from a %s machine' % baseline['environment'].get('machine')
+        missing = [key for key in results.keys() if key not in baseline['results']]
+        if len(missing) > 0:
+            print 'Not in baseline: %s' % ', '.join(sorted(missing))
+        regressions = compare(results, baseline['results'], args.tolerance, args.min_ms)
+        for key, message in regressions:
+            print 'REGRESSION %s: %s' % (key, message)
+        if len(regressions) > 0:
+            sys.exit(1)
+        print 'No regressions against %s (tolerance %d%%)' % (args.baseline, args.tolerance * 100)
+
+
+if __name__ == '__main__':
+    main()
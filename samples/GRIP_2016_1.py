@@ -9,43 +9,49 @@ Including all OpenCV and NetworkTable processing this averages:
 - 23 FPS with PS3 PlayStation Eye (-vw 320 -vh 240)
 - 23 FPS with Microsoft LifeCam HD 3000 (-vw 320 -vh 240)
 - 8 FPS with generic Chinese webcam (-vw 320 -vh 240)
+
+Publish the ContoursReport with: python SharkCV.py -pn SharkCV/myContoursReport samples/GRIP_2016_1.py
 '''
 
-import copy
 import logging
 
-from networktables import NetworkTable
+import sharkcv
 
 logging.basicConfig(level=logging.DEBUG)
-NetworkTable.setIPAddress("127.0.0.1")
-NetworkTable.setClientMode()
-NetworkTable.initialize()
-cr = NetworkTable.getTable("SharkCV/myContoursReport")
-
 
-def GRIP_2016_1(frame):
-    # CV Resize
-    frame.resize(320, 240)
+# Follow targets between frames so each keeps its id, and only search near where they were
+# With --workers above 1 each worker only sees some of the frames, so they just detect (no ids)
+tracker = None
+if sharkcv.Pool.stride() == 1:
+    tracker = sharkcv.Tracker()
+else:
+    logging.warning('Tracking needs every frame, reporting untracked contours with %d workers', sharkcv.Pool.stride())
 
-    orig = copy.deepcopy(frame)
 
-    # HSL Threshold
-    frame.color_hls()
-    mask = frame.threshold([63, 55, 168], [96, 161, 255])
+def detect(frame):
+    # HSL Threshold (one lookup per pixel, no color conversion)
+    mask = frame.threshold_lut('HLS', [([63, 55, 168], [96, 161, 255])])
 
     # Find Contours (happens when contours are referenced)
 
     # Filter Contours
     mask.contours_filter(area=(400, -1))
+    return mask.contours
+
+
+def GRIP_2016_1(frame):
+    # CV Resize
+    frame.resize(320, 240)
+
+    orig = frame.copy()
+
+    if tracker is not None:
+        tracks = tracker.update(frame, detect)
+        frame.contours_draw(orig, contours=[track.contour for track in tracks])
+    else:
+        tracks = detect(frame)
+        frame.contours_draw(orig, contours=tracks)
 
-    # Publish ContoursReport
-    for idx, cnt in enumerate(mask.contours):
-        table = cr.getSubTable(str(idx))
-        table.putValue('area', cnt.area)
-        table.putValue('width', cnt.width)
-        table.putValue('height', cnt.height)
-        table.putValue('center_x', cnt.center_x)
-        table.putValue('center_y', cnt.center_y)
-
-    mask.contours_draw(orig)
-    return orig
+    # ContoursReport (id, x, y, width, height, area, center_x, center_y of every track, no id without tracking),
+    # published by SharkCV.py
+    return orig, tracks
@@ -1,2 +1,17 @@
+from sharkcv.buffer import *
+from sharkcv.capture import *
 from sharkcv.contour import *
 from sharkcv.frame import *
+from sharkcv.jpeg import *
+from sharkcv.mjpg import *
+from sharkcv.pool import *
+from sharkcv.profiler import *
+from sharkcv.publisher import *
+from sharkcv.scheduler import *
+from sharkcv.stream import *
+from sharkcv.tracker import *
+from sharkcv.writer import *
+import sharkcv.batch
+import sharkcv.lut
+import sharkcv.module
+import sharkcv.sweep
@@ -0,0 +1,245 @@
+import logging
+import os
+import signal
+import time
+
+import cv2
+import numpy as np
+
+import sharkcv
+
+IMAGE_EXTENSIONS = ('.bmp', '.jpeg', '.jpg', '.png', '.ppm', '.tif', '.tiff')
+VIDEO_EXTENSIONS = ('.avi', '.m4v', '.mjpeg', '.mjpg', '.mkv', '.mov', '.mp4', '.mpg', '.webm', '.wmv')
+
+# Contour properties written for each contour (or track) a module returns, same as the samples' ContoursReport
+CONTOUR_COLUMNS = ('x', 'y', 'width', 'height', 'area', 'center_x', 'center_y')
+# Columns every row starts with
+KEY_COLUMNS = ('source', 'frame', 'time', 'target')
+
+# Module loaded in each worker process, or the error loading it
+_module = None
+_error = None
+
+
+# Expand directories (recursively), globs and files into image and video files
+def files(paths):
+    images = []
+    videos = []
+    seen = set()
+    for path in paths:
+        if os.path.isdir(path):
+            found = []
+            for root, dirs, names in os.walk(path):
+                found.extend(os.path.join(root, name) for name in names)
+        elif os.path.exists(path):
+            found = [path]
+        else:
+            # Only imported for batch runs
+            import glob
+            found = glob.glob(path)
+            if len(found) == 0:
+                logging.warning('No files found: %s', path)
+        for file in sorted(found):
+            # Directories and globs can overlap
+            if file in seen:
+                continue
+            seen.add(file)
+            extension = os.path.splitext(file)[1].lower()
+            if extension in IMAGE_EXTENSIONS:
+                images.append(file)
+            elif extension in VIDEO_EXTENSIONS or (os.path.isfile(path) and file == path):
+                # Anything named directly that isn't an image is tried as a video
+                videos.append(file)
+    return images, videos
+
+
+# Split images and videos into tasks: ('images', [file, ...]) and ('video', file, first frame, frame count)
+# Videos are split into segments of chunk frames when their length is known
+def tasks(images, videos, chunk, workers):
+    tasks = []
+    # Enough tasks per worker to even out, few enough that each is worth sending
+    per_task = max(1, min(64, len(images) // (workers * 4)))
+    for i in range(0, len(images), per_task):
+        tasks.append(('images', images[i:i + per_task]))
+    for video in videos:
+        capture = cv2.VideoCapture(video)
+        if not capture.isOpened():
+            logging.warning('Failed to open video: %s', video)
+            continue
+        count = int(capture.get(cv2.cv.CV_CAP_PROP_FRAME_COUNT))
+        capture.release()
+        if count <= 0:
+            # Unknown length, one worker reads all of it
+            tasks.append(('video', video, 0, -1))
+            continue
+        for start in range(0, count, chunk):
+            tasks.append(('video', video, start, min(chunk, count - start)))
+    return tasks
+
+
+# Rows (dicts) of the results a module returned for a frame
+# Modules can return a Frame (no rows), (Frame, results) or results, where results are a dict, a sharkcv.ContourSet,
+# or a list of dicts, sharkcv.Contours or sharkcv.Tracks (one row each)
+def rows(modret):
+    if type(modret) is tuple and len(modret) == 2 and isinstance(modret[0], sharkcv.Frame):
+        modret = modret[1]
+    if modret is None or isinstance(modret, sharkcv.Frame):
+        return []
+    if isinstance(modret, (dict, sharkcv.Contour, sharkcv.Track)):
+        modret = [modret]
+    rows = []
+    for item in modret:
+        if isinstance(item, sharkcv.Track):
+            row = dict((name, getattr(item.contour, name)) for name in CONTOUR_COLUMNS)
+            row['id'] = item.id
+        elif isinstance(item, sharkcv.Contour):
+            row = dict((name, getattr(item, name)) for name in CONTOUR_COLUMNS)
+        elif isinstance(item, dict):
+            row = dict(item)
+        else:
+            raise TypeError('Can\'t collect %s results' % type(item).__name__)
+        rows.append(row)
+    return rows
+
+
+def _initialize(modfile, lazy):
+    global _module, _error
+    # Let the parent process handle Ctrl-C
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    sharkcv.Frame.lazy = lazy
+    try:
+        _module = sharkcv.module.load(modfile)
+    except Exception, e:
+        _error = 'Import failed: ' + str(e)
+
+
+# Run the module on one frame, returns its rows keyed by source and frame
+def _frame(source, index, seconds, ndarray):
+    try:
+        modret = _module(sharkcv.Frame(ndarray, timestamp=seconds))
+        results = rows(modret)
+    except Exception, e:
+        logging.warning('Module exception on %s frame %d: %s', source, index, str(e))
+        return None
+    for target, row in enumerate(results):
+        row.update({'source': source, 'frame': index, 'time': seconds, 'target': target})
+    return results
+
+
+# Yield (source, frame, time, ndarray) for every frame of a task, ndarray is None for unreadable images
+def frames(task):
+    if task[0] == 'images':
+        for file in task[1]:
+            ndarray = cv2.imread(file, cv2.IMREAD_COLOR)
+            if ndarray is None:
+                logging.warning('Failed to read image: %s', file)
+            yield file, 0, 0.0, ndarray
+    else:
+        _, video, start, count = task
+        capture = cv2.VideoCapture(video)
+        fps = capture.get(cv2.cv.CV_CAP_PROP_FPS)
+        if start > 0:
+            capture.set(cv2.cv.CV_CAP_PROP_POS_FRAMES, start)
+        index = start
+        while count < 0 or index < start + count:
+            ret, ndarray = capture.read()
+            if not ret:
+                break
+            yield video, index, index / fps if fps > 0 else 0.0, ndarray
+            index += 1
+        capture.release()
+
+
+# Worker process: run the module on every frame of a task, returns (frames, errors, rows)
+def _run(task):
+    if _error is not None:
+        return 'error', _error
+    count = 0
+    errors = 0
+    results = []
+    for source, index, seconds, ndarray in frames(task):
+        found = None
+        if ndarray is not None:
+            found = _frame(source, index, seconds, ndarray)
+            count += 1
+        if found is None:
+            errors += 1
+        else:
+            results.extend(found)
+    return 'ok', (count, errors, results)
+
+
+# Run a module file over directories, globs, images and videos on a pool of worker processes
+# Returns every result row, in (source, frame, target) order
+def run(modfile, paths, **kwargs):
+    # Only imported for batch runs
+    import multiprocessing
+
+    # Worker processes (default: one per core)
+    if 'workers' not in kwargs or kwargs['workers'] <= 0:
+        kwargs['workers'] = multiprocessing.cpu_count()
+    # Frames per video segment
+    if 'chunk' not in kwargs:
+        kwargs['chunk'] = 300
+    if 'lazy' not in kwargs:
+        kwargs['lazy'] = sharkcv.Frame.lazy
+    images, videos = files(paths)
+    work = tasks(images, videos, kwargs['chunk'], kwargs['workers'])
+    logging.info('Processing %d images and %d videos in %d tasks on %d workers', len(images), len(videos), len(work),
+                 kwargs['workers'])
+
+    pool = multiprocessing.Pool(kwargs['workers'], _initialize, (modfile, kwargs['lazy']))
+    results = []
+    count = 0
+    errors = 0
+    start = time.time()
+    try:
+        for done, (status, result) in enumerate(pool.imap_unordered(_run, work, 1)):
+            if status == 'error':
+                raise RuntimeError(result)
+            count += result[0]
+            errors += result[1]
+            results.extend(result[2])
+            logging.debug('Finished %d/%d tasks, %d frames', done + 1, len(work), count)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    seconds = time.time() - start
+    logging.info('Processed %d frames in %.1f s (%.1f FPS), %d errors, %d results', count, seconds,
+                 count / seconds if seconds > 0 else 0, errors, len(results))
+    results.sort(key=lambda row: (row['source'], row['frame'], row['target']))
+    return results
+
+
+# Column names of rows, key columns first
+def columns(rows, keys=KEY_COLUMNS):
+    names = set()
+    for row in rows:
+        names.update(row.keys())
+    return list(keys) + sorted(names - set(keys))
+
+
+# Write rows to a .csv file, or a .npz file of one array per column (missing numbers are NaN)
+def save(rows, filename, keys=KEY_COLUMNS):
+    names = columns(rows, keys)
+    if filename.lower().endswith('.npz'):
+        arrays = {}
+        for name in names:
+            values = [row.get(name) for row in rows]
+            if all(value is None or isinstance(value, (int, long, float, bool, np.number)) for value in values):
+                arrays[name] = np.array([np.nan if value is None else value for value in values], dtype=np.float64)
+            else:
+                arrays[name] = np.array(['' if value is None else str(value) for value in values])
+        np.savez_compressed(filename, **arrays)
+    else:
+        # Only imported for .csv output
+        import csv
+        with open(filename, 'wb') as f:
+            writer = csv.writer(f)
+            writer.writerow(names)
+            for row in rows:
+                writer.writerow(['' if row.get(name) is None else row.get(name) for name in names])
+    logging.info('Wrote %d results: %s', len(rows), filename)
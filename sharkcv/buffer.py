@@ -0,0 +1,115 @@
+import itertools
+import mmap
+import threading
+import time
+import weakref
+
+import numpy as np
+
+# Every live pool by id, forked processes inherit this along with the memory
+_pools = weakref.WeakValueDictionary()
+_pool_ids = itertools.count()
+
+
+# A fixed number of equally sized blocks in one anonymous shared mmap
+# Memory is shared with any process forked after the pool was created
+class BufferPool(object):
+    def __init__(self, nbytes, count):
+        self._nbytes = nbytes
+        self._count = count
+        self._mmap = mmap.mmap(-1, max(nbytes * count, 1))
+        self._used = [False] * count
+        self._cond = threading.Condition(threading.RLock())
+        self._id = next(_pool_ids)
+        _pools[self._id] = self
+
+    # Find a pool by id (e.g. from a forked worker process)
+    @staticmethod
+    def find(id):
+        return _pools.get(id)
+
+    @property
+    def id(self):
+        return self._id
+
+    @property
+    def nbytes(self):
+        return self._nbytes
+
+    @property
+    def count(self):
+        return self._count
+
+    @property
+    def free(self):
+        return self._used.count(False)
+
+    # Reserve a free block and return its index, waiting up to timeout seconds (None for forever)
+    def acquire(self, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while True:
+                for index in range(self._count):
+                    if not self._used[index]:
+                        self._used[index] = True
+                        return index
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self._cond.wait(remaining)
+
+    # Return a block to the pool
+    def release(self, index):
+        with self._cond:
+            self._used[index] = False
+            self._cond.notify_all()
+
+    # View a block as an ndarray without copying or reference counting
+    def view(self, index, shape, dtype):
+        dtype = np.dtype(dtype)
+        count = int(np.prod(shape))
+        if count * dtype.itemsize > self._nbytes:
+            raise ValueError('%d byte block too small for %s %s' % (self._nbytes, str(shape), dtype.str))
+        return np.frombuffer(self._mmap, dtype=dtype, count=count, offset=index * self._nbytes).reshape(shape)
+
+    # Wrap a reserved block in a Buffer that releases it when no longer referenced
+    def buffer(self, index, shape, dtype):
+        return Buffer(self.view(index, shape, dtype), self, index)
+
+
+# A reference counted ndarray, optionally backed by a BufferPool block
+# Starts with one reference owned by whoever created it
+class Buffer(object):
+    def __init__(self, ndarray, pool=None, index=None):
+        self._ndarray = ndarray
+        self._pool = pool
+        self._index = index
+        self._refs = 1
+        self._lock = threading.Lock()
+
+    @property
+    def ndarray(self):
+        return self._ndarray
+
+    @property
+    def pool(self):
+        return self._pool
+
+    @property
+    def index(self):
+        return self._index
+
+    @property
+    def refs(self):
+        return self._refs
+
+    def retain(self):
+        with self._lock:
+            self._refs += 1
+
+    def release(self):
+        with self._lock:
+            self._refs -= 1
+            released = self._refs == 0
+        if released and self._pool is not None:
+            self._pool.release(self._index)
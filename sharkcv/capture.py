@@ -0,0 +1,291 @@
+import collections
+import logging
+import threading
+import time
+
+import numpy as np
+
+import sharkcv
+
+
+# Identical frames in a row that count as a stalled source
+_REPEATS = 30
+
+# Seconds between attempts to reopen a source, doubling up to the backoff
+_RETRY = 0.1
+
+
+# Read frames from a source (cv2.VideoCapture or anything with a compatible read()) on a background thread into a
+# small pool of reused shared buffers
+# With reopen, a watchdog: a source that fails or stalls (keeps returning the same frame) is replaced with
+# reopen(old source), retrying with backoff, and read() returns the last frame again (see stale) while it's down
+# The source can start out as None to have the watchdog keep trying to open it
+class Capture(object):
+    def __init__(self, source, **kwargs):
+        if 'size' not in kwargs:
+            kwargs['size'] = 3
+        if 'latest' not in kwargs:
+            kwargs['latest'] = True
+        # Callable that closes the old source and returns a new one (or None to try again later)
+        if 'reopen' not in kwargs:
+            kwargs['reopen'] = None
+        # Seconds read() waits for a new frame before returning the last one again (watchdog only)
+        if 'timeout' not in kwargs:
+            kwargs['timeout'] = 1.0
+        # Longest wait between attempts to reopen the source
+        if 'backoff' not in kwargs:
+            kwargs['backoff'] = 5.0
+        self._source = source
+        # One buffer held by the consumer, one waiting, one being written
+        self._size = max(kwargs['size'], 3)
+        self._latest = kwargs['latest']
+        self._reopen = kwargs['reopen']
+        self._timeout = kwargs['timeout']
+        self._backoff = kwargs['backoff']
+        self._last = None
+        self._stale = False
+        self._down = None
+        self._reconnects = 0
+        self._downtime = 0.0
+        self._stale_frames = 0
+        self._pool = None
+        self._allocating = False
+        self._allocated = 0
+        self._ready = collections.deque()
+        self._cond = threading.Condition()
+        self._watchers = []
+        self._thread = None
+        self._running = False
+        self._frames = 0
+        self._dropped = 0
+
+    @property
+    def frames(self):
+        return self._frames
+
+    @property
+    def dropped(self):
+        return self._dropped
+
+    # Number of frames read into their own ndarray because the consumer held on to every buffer
+    @property
+    def allocated(self):
+        return self._allocated
+
+    @property
+    def running(self):
+        return self._running
+
+    # The current source, the watchdog may have replaced the one given
+    @property
+    def source(self):
+        return self._source
+
+    # Whether the last read() returned the previous frame again because the source is down
+    @property
+    def stale(self):
+        return self._stale
+
+    # Number of frames waiting for read()
+    @property
+    def ready(self):
+        return len(self._ready)
+
+    # Whether the watchdog is getting the source back
+    @property
+    def down(self):
+        return self._down is not None
+
+    # Number of times the watchdog reopened the source
+    @property
+    def reconnects(self):
+        return self._reconnects
+
+    # Seconds without new frames while the watchdog got the source back
+    @property
+    def downtime(self):
+        return self._downtime + (time.time() - self._down if self._down is not None else 0.0)
+
+    # Number of frames read() returned again because the source was down
+    @property
+    def stale_frames(self):
+        return self._stale_frames
+
+    def start(self):
+        if self._thread is None:
+            self._running = True
+            self._thread = threading.Thread(target=self.__run)
+            self._thread.setDaemon(True)
+            self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._ready.clear()
+            self._cond.notify_all()
+        self.__notify()
+        if self._thread is not None:
+            # The source's read() may block, don't wait forever on it
+            self._thread.join(1.0)
+            self._thread = None
+
+    # Also notify cond (a threading.Condition) whenever a frame is ready or the capture ends, e.g. so a
+    # sharkcv.Scheduler can wait on several captures at once
+    def watch(self, cond):
+        self._watchers.append(cond)
+
+    # Never called holding self._cond, a watcher may be about to read()
+    def __notify(self):
+        for cond in self._watchers:
+            with cond:
+                cond.notify_all()
+
+    # Reserve a pool buffer, in latest mode overwrite the oldest frame nobody has read yet
+    # Returns None when stopped, or when the consumer holds on to every buffer (the frame then gets its own ndarray)
+    def __acquire(self):
+        while self._running:
+            index = self._pool.acquire(0)
+            if index is not None:
+                self._allocating = False
+                return index
+            with self._cond:
+                if self._latest and len(self._ready) > 0:
+                    self._ready.popleft()
+                    self._dropped += 1
+                    continue
+                # Keep allocating until the consumer lets go of a buffer, read() wakes us up
+                if self._allocating:
+                    if len(self._ready) == 0:
+                        return None
+                    self._cond.wait(0.1)
+                    continue
+            index = self._pool.acquire(0.1)
+            if index is not None:
+                return index
+            # Frames waiting to be read free up buffers, frames the consumer kept never might
+            with self._cond:
+                if len(self._ready) == 0:
+                    if self._allocated == 0:
+                        logging.warning('Capture buffers are all held by the consumer, allocating frames '
+                                        '(keep fewer frames or raise size from %d)', self._size)
+                    self._allocating = True
+                    return None
+        return None
+
+    # Replace a failed or stalled source, waiting longer after each failed attempt
+    def __reconnect(self, reason):
+        if self._down is None:
+            self._down = self._last.timestamp if self._last is not None else time.time()
+        logging.warning('Capture %s, reopening', reason)
+        retry = 0.0
+        while self._running:
+            if retry > 0:
+                with self._cond:
+                    self._cond.wait(retry)
+                if not self._running:
+                    break
+            try:
+                source = self._reopen(self._source)
+            except Exception, e:
+                logging.debug('Capture reopen failed: %s', str(e))
+                source = None
+            if source is not None:
+                self._source = source
+                self._reconnects += 1
+                return
+            retry = min(max(retry * 2, _RETRY), self._backoff)
+
+    def __run(self):
+        shape = None
+        dtype = None
+        previous = None
+        repeats = 0
+        while self._running:
+            buffer = None
+            if self._pool is not None:
+                index = self.__acquire()
+                if not self._running:
+                    break
+                if index is not None:
+                    buffer = self._pool.buffer(index, shape, dtype)
+                else:
+                    self._allocated += 1
+
+            # Read outside of any lock so the consumer is never blocked by the camera
+            if self._source is None:
+                ret, ndarray = False, None
+            elif buffer is not None:
+                ret, ndarray = self._source.read(buffer.ndarray)
+            else:
+                ret, ndarray = self._source.read()
+            timestamp = time.time()
+
+            # A few pixels are enough to tell a frozen source from a live one
+            if ret and ndarray is not None and self._reopen is not None:
+                sample = ndarray[::16, ::16].copy()
+                repeats = repeats + 1 if previous is not None and np.array_equal(sample, previous) else 0
+                previous = sample
+
+            if not ret or ndarray is None or repeats >= _REPEATS:
+                if buffer is not None:
+                    buffer.release()
+                if self._reopen is not None:
+                    self.__reconnect('stalled' if repeats >= _REPEATS else 'read failed')
+                    previous = None
+                    repeats = 0
+                    continue
+                logging.debug('Capture read failed')
+                with self._cond:
+                    self._running = False
+                    self._cond.notify_all()
+                self.__notify()
+                break
+
+            if self._down is not None:
+                down = timestamp - self._down
+                logging.info('Capture back after %.1f s (%d reconnects)', down, self._reconnects)
+                sharkcv.Profiler.record('capture.down', down)
+                self._downtime += down
+                self._down = None
+
+            # The source allocated a new ndarray (first frame, or it changed size), size the pool to match
+            if buffer is not None and not np.may_share_memory(ndarray, buffer.ndarray):
+                buffer.release()
+                buffer = None
+            if buffer is None and (ndarray.shape != shape or ndarray.dtype != dtype):
+                shape = ndarray.shape
+                dtype = ndarray.dtype
+                self._pool = sharkcv.BufferPool(ndarray.nbytes, self._size)
+
+            frame = sharkcv.Frame(buffer if buffer is not None else ndarray, timestamp=timestamp)
+            with self._cond:
+                self._ready.append(frame)
+                self._frames += 1
+                self._cond.notify_all()
+            self.__notify()
+
+    # Return the next frame, or None when the source has failed/stopped
+    # The watchdog returns the last frame again (and sets stale) when there's no new one within the timeout
+    def read(self):
+        with self._cond:
+            deadline = time.time() + self._timeout
+            while len(self._ready) == 0 and self._running:
+                if self._reopen is not None and self._last is not None and time.time() >= deadline:
+                    self._stale = True
+                    self._stale_frames += 1
+                    return self._last.copy()
+                self._cond.wait(0.1)
+            if len(self._ready) == 0:
+                return None
+            self._stale = False
+            if self._latest:
+                frame = self._ready.pop()
+                self._dropped += len(self._ready)
+                self._ready.clear()
+            else:
+                frame = self._ready.popleft()
+            # A copy, modules change their frame in place
+            if self._reopen is not None:
+                self._last = frame.copy()
+            self._cond.notify_all()
+        return frame
@@ -2,77 +2,284 @@ import cv2
 import numpy as np
 
 
+# All of a frame's contours, with each property computed for every contour at once into a column
+class ContourSet(object):
+    # ndarrays are contours as returned by cv2.findContours()
+    def __init__(self, ndarrays):
+        self._ndarrays = list(ndarrays)
+        # Points of all contours end to end, and where each contour starts in them
+        self._points = None
+        self._starts = None
+        self._lengths = None
+        # Computed columns by property name
+        self._columns = {}
+
+    def __len__(self):
+        return len(self._ndarrays)
+
+    def __iter__(self):
+        for i in range(len(self._ndarrays)):
+            yield Contour(self._ndarrays[i], self, i)
+
+    # An int returns a sharkcv.Contour, a slice, index array or boolean mask returns a ContourSet
+    def __getitem__(self, key):
+        if isinstance(key, (int, long, np.integer)):
+            if key < 0:
+                key += len(self._ndarrays)
+            if key < 0 or key >= len(self._ndarrays):
+                raise IndexError('contour index out of range')
+            return Contour(self._ndarrays[key], self, key)
+        index = np.arange(len(self._ndarrays))[key]
+        contours = ContourSet([self._ndarrays[i] for i in index])
+        for name in self._columns:
+            contours._columns[name] = self._columns[name][index]
+        return contours
+
+    # Columns are also attributes, e.g. contours.area, so predicates written for a sharkcv.Contour work on a set
+    def __getattr__(self, name):
+        if name in _COLUMNS:
+            return self.column(name)
+        raise AttributeError('ContourSet has no attribute %r' % name)
+
+    @property
+    def ndarrays(self):
+        return self._ndarrays
+
+    # Return a property of every contour as an ndarray
+    def column(self, name):
+        if name not in self._columns:
+            if name not in _COLUMNS:
+                raise AttributeError('Contour has no property %r' % name)
+            if len(self._ndarrays) == 0:
+                self._columns[name] = np.empty(0)
+            else:
+                if self._points is None:
+                    self.__concatenate()
+                getattr(self, _COLUMNS[name])()
+        return self._columns[name]
+
+    def __concatenate(self):
+        self._lengths = np.array([len(ndarray) for ndarray in self._ndarrays])
+        self._starts = np.concatenate(([0], np.cumsum(self._lengths)[:-1]))
+        self._points = np.concatenate(self._ndarrays).reshape(-1, 2)
+
+    # Same as cv2.boundingRect()
+    def _bounding_rects(self):
+        x = self._points[:, 0]
+        y = self._points[:, 1]
+        self._columns['x'] = np.minimum.reduceat(x, self._starts)
+        self._columns['y'] = np.minimum.reduceat(y, self._starts)
+        self._columns['width'] = np.maximum.reduceat(x, self._starts) - self._columns['x'] + 1
+        self._columns['height'] = np.maximum.reduceat(y, self._starts) - self._columns['y'] + 1
+
+    def _centers(self):
+        self._columns['center_x'] = self.column('x') + self.column('width') / 2.0
+        self._columns['center_y'] = self.column('y') + self.column('height') / 2.0
+
+    # Polygon moments with the shoelace formula, same as cv2.moments() and cv2.contourArea()
+    def _moments(self):
+        x = self._points[:, 0].astype(np.float64)
+        y = self._points[:, 1].astype(np.float64)
+        # Index of the next point around each contour
+        following = np.arange(1, len(x) + 1)
+        following[self._starts + self._lengths - 1] = self._starts
+        x1 = x[following]
+        y1 = y[following]
+        cross = x * y1 - x1 * y
+        m00 = np.add.reduceat(cross, self._starts) / 2
+        m10 = np.add.reduceat((x + x1) * cross, self._starts) / 6
+        m01 = np.add.reduceat((y + y1) * cross, self._starts) / 6
+        # Same sign whichever way round the contour goes
+        sign = np.where(m00 < 0, -1.0, 1.0)
+        self._columns['m00'] = m00 * sign
+        self._columns['m10'] = m10 * sign
+        self._columns['m01'] = m01 * sign
+        self._columns['area'] = self._columns['m00']
+        # Degenerate (zero area) contours fall back to the bounding rect center
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self._columns['centroid_x'] = np.where(m00 != 0, m10 / m00, self.column('center_x'))
+            self._columns['centroid_y'] = np.where(m00 != 0, m01 / m00, self.column('center_y'))
+
+    # Angle of a least squares line through the points in degrees, same as cv2.fitLine() with CV_DIST_L2
+    def _angles(self):
+        x = self._points[:, 0].astype(np.float64)
+        y = self._points[:, 1].astype(np.float64)
+        mean_x = np.add.reduceat(x, self._starts) / self._lengths
+        mean_y = np.add.reduceat(y, self._starts) / self._lengths
+        dx2 = np.add.reduceat(x * x, self._starts) / self._lengths - mean_x * mean_x
+        dy2 = np.add.reduceat(y * y, self._starts) / self._lengths - mean_y * mean_y
+        dxy = np.add.reduceat(x * y, self._starts) / self._lengths - mean_x * mean_y
+        self._columns['angle'] = np.arctan2(2 * dxy, dx2 - dy2) / 2 * 180 / np.pi
+
+    # Width over height
+    def _aspect_ratios(self):
+        self._columns['aspect_ratio'] = self.column('width') / self.column('height').astype(np.float64)
+
+    # Area over bounding rect area
+    def _extents(self):
+        self._columns['extent'] = self.column('area') / (self.column('width') * self.column('height'))
+
+    # Area over convex hull area, the hulls are per contour
+    def _hulls(self):
+        hulls = [cv2.convexHull(ndarray) for ndarray in self._ndarrays]
+        self._columns['hull_area'] = np.array([cv2.contourArea(hull) for hull in hulls])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self._columns['solidity'] = np.where(self._columns['hull_area'] > 0,
+                                                 self.column('area') / self._columns['hull_area'], 0.0)
+
+    # There's no closed form for the minimum enclosing circle, so this one is per contour
+    def _radii(self):
+        self._columns['radius'] = np.array([cv2.minEnclosingCircle(ndarray)[1] for ndarray in self._ndarrays])
+
+    # Return the contours that pass every predicate
+    # Keyword predicates are (min, max) ranges of a property, None or a negative bound means no bound
+    # Positional predicates are callables given the set, returning a boolean ndarray, e.g. lambda c: c.width > c.height
+    # Ranges run cheapest property first and each one only computes its property for contours that are still left
+    def filter(self, *args, **kwargs):
+        contours = self
+        for prop in sorted(kwargs.keys(), key=self.__cost):
+            if len(contours) == 0:
+                break
+            range = kwargs[prop]
+            values = contours.column(prop)
+            keep = np.ones(len(contours), dtype=bool)
+            if range[0] is not None and range[0] >= 0:
+                keep &= values >= range[0]
+            if range[1] is not None and range[1] >= 0:
+                keep &= values <= range[1]
+            if not keep.all():
+                contours = contours[keep]
+        for predicate in args:
+            if len(contours) == 0:
+                break
+            keep = np.asarray(predicate(contours), dtype=bool)
+            if not keep.all():
+                contours = contours[keep]
+        return contours
+
+    # Relative cost of computing a property, zero once it's computed
+    def __cost(self, name):
+        if name in self._columns:
+            return 0
+        if name not in _COLUMNS:
+            raise AttributeError('Contour has no property %r' % name)
+        return _COSTS[_COLUMNS[name]]
+
+    # Return the contours sorted by a property
+    def sort(self, prop, descending=True):
+        values = self.column(prop)
+        # Stable, so equal contours keep their order like sorted()
+        return self[np.argsort(-values if descending else values, kind='mergesort')]
+
+
+# Method of ContourSet that computes each column
+_COLUMNS = {
+    'x': '_bounding_rects',
+    'y': '_bounding_rects',
+    'width': '_bounding_rects',
+    'height': '_bounding_rects',
+    'center_x': '_centers',
+    'center_y': '_centers',
+    'area': '_moments',
+    'm00': '_moments',
+    'm10': '_moments',
+    'm01': '_moments',
+    'centroid_x': '_moments',
+    'centroid_y': '_moments',
+    'aspect_ratio': '_aspect_ratios',
+    'extent': '_extents',
+    'hull_area': '_hulls',
+    'solidity': '_hulls',
+    'angle': '_angles',
+    'radius': '_radii',
+}
+
+# Relative cost of each column method, so filters can run the cheap ones first
+_COSTS = {
+    '_bounding_rects': 1,
+    '_centers': 2,
+    '_aspect_ratios': 2,
+    '_moments': 3,
+    '_extents': 4,
+    '_angles': 5,
+    '_hulls': 10,
+    '_radii': 10,
+}
+
+
+# A single contour, a view into the sharkcv.ContourSet it came from
 class Contour(object):
-    def __init__(self, ndarray):
+    def __init__(self, ndarray, contours=None, index=0):
         self._ndarray = ndarray
-        self._x = None
-        self._y = None
-        self._width = None
-        self._height = None
-        self._area = None
-        self._angle = None
-        self._radius = None
+        if contours is None:
+            contours = ContourSet([ndarray])
+            index = 0
+        self._contours = contours
+        self._index = index
+
+    def __value(self, name):
+        return self._contours.column(name)[self._index].item()
 
     @property
     def ndarray(self):
         return self._ndarray
 
-    def __bounding_rect(self):
-        self._x, self._y, self._width, self._height = cv2.boundingRect(self._ndarray)
-
-    def __line(self):
-        [vx, vy, _, _] = cv2.fitLine(self._ndarray, cv2.cv.CV_DIST_L2, 0, 0.01, 0.01)
-        self._angle = np.arctan2(vy, vx)[0] * 180 / np.pi
-
-    def __circle(self):
-        (_, _), self._radius = cv2.minEnclosingCircle(self._ndarray)
-
     @property
     def x(self):
-        if self._x is None:
-            self.__bounding_rect()
-        return self._x
+        return self.__value('x')
 
     @property
     def y(self):
-        if self._y is None:
-            self.__bounding_rect()
-        return self._y
+        return self.__value('y')
 
     @property
     def width(self):
-        if self._width is None:
-            self.__bounding_rect()
-        return self._width
+        return self.__value('width')
 
     @property
     def height(self):
-        if self._height is None:
-            self.__bounding_rect()
-        return self._height
+        return self.__value('height')
 
     @property
     def area(self):
-        if self._area is None:
-            self._area = cv2.contourArea(self._ndarray)
-        return self._area
+        return self.__value('area')
 
     @property
     def center_x(self):
-        return self.x + self.width / 2.0
+        return self.__value('center_x')
 
     @property
     def center_y(self):
-        return self.y + self.height / 2.0
+        return self.__value('center_y')
+
+    # Center of mass
+    @property
+    def centroid_x(self):
+        return self.__value('centroid_x')
+
+    @property
+    def centroid_y(self):
+        return self.__value('centroid_y')
+
+    # Width over height
+    @property
+    def aspect_ratio(self):
+        return self.__value('aspect_ratio')
+
+    # Area over bounding rect area
+    @property
+    def extent(self):
+        return self.__value('extent')
+
+    # Area over convex hull area
+    @property
+    def solidity(self):
+        return self.__value('solidity')
 
     @property
     def angle(self):
-        if self._angle is None:
-            self.__line()
-        return self._angle
+        return self.__value('angle')
 
     @property
     def radius(self):
-        if self._radius is None:
-            self.__circle()
-        return self._radius
+        return self.__value('radius')
@@ -1,37 +1,482 @@
+import functools
+import itertools
+import sys
+import threading
+
 import cv2
 import numpy as np
 
 import sharkcv
 
+# Conversions between these only move channels around, add alpha or drop it, so each channel comes out exactly as
+# it went in (which also makes them commute with resizing)
+_PERMUTATIONS = ('BGR', 'RGB', 'BGRA', 'RGBA')
+# Operations that can write their result over their source
+_INPLACE = ('morph', 'bit')
+
+# Free ndarrays to reuse as operation outputs, by (shape, dtype)
+_SCRATCH_SIZE = 4
+_scratch = {}
+# Number of ndarrays each operation had to allocate
+_allocations = {}
+_scratch_lock = threading.Lock()
+
+
+# Memoize a function of hashable arguments, evicting the least recently used result once there are size of them
+# With nbytes (a function returning a byte budget), ndarray results are also evicted to keep their total under it
+def _lru(size, nbytes=None):
+    def decorator(function):
+        cache = {}
+        # When each result was last used, hits only write here so they don't need the lock
+        used = {}
+        clock = itertools.count()
+        lock = threading.Lock()
+
+        @functools.wraps(function)
+        def wrapper(*args):
+            try:
+                result = cache[args]
+            except KeyError:
+                result = function(*args)
+                with lock:
+                    while len(cache) > 0 and (len(cache) >= size or nbytes is not None and
+                                              sum(value.nbytes for value in cache.values()) + result.nbytes > nbytes()):
+                        oldest = min(cache, key=used.get)
+                        del cache[oldest]
+                        used.pop(oldest, None)
+                    cache[args] = result
+            used[args] = next(clock)
+            return result
+        wrapper.cache = cache
+        return wrapper
+    return decorator
+
+
+# Structuring element for morphology operations
+@_lru(32)
+def _kernel(shape, size):
+    return cv2.getStructuringElement(shape, (size, size))
+
+
+# cv2.COLOR_* code converting between two colorspaces, or None if there isn't one
+@_lru(64)
+def _conversion(src_color, dst_color):
+    return getattr(cv2, 'COLOR_' + src_color + '2' + dst_color, None)
+
+
+# Lower/upper threshold bounds as ndarrays, from tuples
+@_lru(64)
+def _bounds(lower, upper):
+    return np.array(lower), np.array(upper)
+
+
+# Color lookup tables for Frame.threshold_lut(), ranges are tuples
+@_lru(8, nbytes=lambda: sharkcv.lut.MEMORY)
+def _lut(src_color, dst_color, ranges, bits):
+    return sharkcv.lut.table(src_color, dst_color, ranges, bits)
+
+
+# Name an operation after the Frame method it came from, to count its allocations under
+def _name(op):
+    if op[0] == 'color':
+        return 'color_' + op[2].lower()
+    if op[0] == 'morph':
+        return {cv2.MORPH_DILATE: 'dilate', cv2.MORPH_ERODE: 'erode', cv2.MORPH_OPEN: 'open',
+                cv2.MORPH_CLOSE: 'close'}[op[1]]
+    if op[0] == 'bit':
+        return 'bit_' + op[1].__name__.split('_')[-1]
+    return op[0]
+
+
+def _count(name):
+    with _scratch_lock:
+        _allocations[name] = _allocations.get(name, 0) + 1
+
+
+# Get a free ndarray from the scratch pool, or allocate one
+def _acquire(shape, dtype, name):
+    key = (shape, np.dtype(dtype).str)
+    with _scratch_lock:
+        free = _scratch.get(key)
+        if free:
+            return free.pop()
+        _allocations[name] = _allocations.get(name, 0) + 1
+    return np.empty(shape, dtype)
+
+
+# Hand an ndarray back to the scratch pool, only if nothing but the caller refers to it (not even a view)
+def _recycle(ndarray):
+    # The caller's reference, the call's, our argument and getrefcount()'s own
+    if ndarray is None or sys.getrefcount(ndarray) > 4 or not ndarray.flags.owndata:
+        return
+    key = (ndarray.shape, ndarray.dtype.str)
+    with _scratch_lock:
+        free = _scratch.setdefault(key, [])
+        if len(free) < _SCRATCH_SIZE:
+            free.append(ndarray)
+
+
+# Shape and dtype of an operation's result
+def _output(src, op):
+    if op[0] == 'color':
+        channels = {'GRAY': (), 'BGRA': (4,), 'RGBA': (4,)}.get(op[2], (3,))
+        return src.shape[:2] + channels, src.dtype
+    if op[0] == 'threshold':
+        return src.shape[:2], np.uint8
+    if op[0] == 'resize':
+        return (int(op[2]), int(op[1])) + src.shape[2:], src.dtype
+    if op[0] == 'warp':
+        return (int(op[3]), int(op[2])) + src.shape[2:], src.dtype
+    return src.shape, src.dtype
+
+
+# Run one operation into a scratch ndarray (or over src if inplace and the operation allows it)
+def _run(src, op, inplace=False):
+    if inplace and op[0] in _INPLACE:
+        dst = src
+    else:
+        shape, dtype = _output(src, op)
+        dst = _acquire(shape, dtype, _name(op))
+    result = _KERNELS[op[0]](src, dst, *op[1:])
+    if result is not dst:
+        # OpenCV couldn't use dst and allocated its own
+        _count(_name(op))
+        if dst is not src:
+            _recycle(dst)
+    return result
+
+
+# Operation kernels, each takes the source ndarray, an ndarray to write the result into (which may be the source
+# for _INPLACE operations), and the operation's arguments, and returns the result
+def _color(src, dst, src_color, dst_color):
+    return cv2.cvtColor(src, _conversion(src_color, dst_color), dst)
+
+
+def _threshold(src, dst, lower, upper):
+    lower, upper = _bounds(tuple(lower), tuple(upper))
+    return cv2.inRange(src, lower, upper, dst)
+
+
+def _resize(src, dst, width, height, downscale):
+    return cv2.resize(src, (int(width), int(height)), dst, interpolation=cv2.INTER_LINEAR)
+
+
+def _warp(src, dst, matrix, width, height):
+    return cv2.warpAffine(src, matrix, (int(width), int(height)), dst)
+
+
+def _blur(src, dst, size):
+    return cv2.blur(src, (size, size), dst)
+
+
+def _blur_gaussian(src, dst, size):
+    return cv2.GaussianBlur(src, (size, size), 0, dst)
+
+
+def _blur_median(src, dst, size):
+    return cv2.medianBlur(src, size, dst)
+
+
+def _morph(src, dst, op, shape, size, iterations):
+    kernel = _kernel(shape, size)
+    if op == cv2.MORPH_DILATE:
+        return cv2.dilate(src, kernel, dst, iterations=iterations, borderType=cv2.BORDER_CONSTANT)
+    if op == cv2.MORPH_ERODE:
+        return cv2.erode(src, kernel, dst, iterations=iterations, borderType=cv2.BORDER_CONSTANT)
+    return cv2.morphologyEx(src, op, kernel, dst, iterations=iterations)
+
+
+def _bit(src, dst, op, frame):
+    # bit_not has no other frame
+    if frame is None:
+        return op(src, dst=dst)
+    other = frame._ndarray
+    if dst.shape == other.shape and dst.dtype == other.dtype:
+        return op(src, other, dst)
+    return op(src, other)
+
+
+_KERNELS = {
+    'color': _color,
+    'threshold': _threshold,
+    'resize': _resize,
+    'warp': _warp,
+    'blur': _blur,
+    'blur_gaussian': _blur_gaussian,
+    'blur_median': _blur_median,
+    'morph': _morph,
+    'bit': _bit,
+}
+
+
+# Fuse and reorder a list of pending operations so fewer (and cheaper) kernels run
+def _optimize(ops):
+    ops = list(ops)
+    changed = True
+    while changed:
+        changed = False
+        for i in range(len(ops) - 1):
+            a, b = ops[i], ops[i + 1]
+
+            # Collapse color conversions through a lossless intermediate, e.g. BGR->RGB->HSV to BGR->HSV (but not
+            # BGRA->BGR->BGRA, which sets alpha to 255)
+            if a[0] == 'color' and b[0] == 'color' and a[1] in _PERMUTATIONS and a[2] in _PERMUTATIONS and \
+                    len(a[2]) >= len(a[1]):
+                if a[1] == b[2]:
+                    ops[i:i + 2] = []
+                    changed = True
+                elif _conversion(a[1], b[2]) is not None:
+                    ops[i:i + 2] = [('color', a[1], b[2])]
+                    changed = True
+
+            # Convert color after downscaling so fewer pixels get converted, only for conversions that leave channel
+            # values alone (e.g. not GRAY, which rounds differently before and after resizing)
+            elif a[0] == 'color' and b[0] == 'resize' and b[3] and a[1] in _PERMUTATIONS and a[2] in _PERMUTATIONS:
+                ops[i:i + 2] = [b, a]
+                changed = True
+
+            # Merge repeated dilates/erodes with the same kernel into more iterations of one call
+            elif a[0] == 'morph' and b[0] == 'morph' and a[1:4] == b[1:4] and \
+                    a[1] in (cv2.MORPH_DILATE, cv2.MORPH_ERODE):
+                ops[i:i + 2] = [('morph', a[1], a[2], a[3], a[4] + b[4])]
+                changed = True
+
+            # Erode then dilate with the same kernel is an open (and the reverse a close)
+            elif a[0] == 'morph' and b[0] == 'morph' and a[2:] == b[2:] and \
+                    (a[1], b[1]) in ((cv2.MORPH_ERODE, cv2.MORPH_DILATE), (cv2.MORPH_DILATE, cv2.MORPH_ERODE)):
+                op = cv2.MORPH_OPEN if a[1] == cv2.MORPH_ERODE else cv2.MORPH_CLOSE
+                ops[i:i + 2] = [('morph', op, a[2], a[3], a[4])]
+                changed = True
+
+            if changed:
+                break
+    return ops
+
+
+# Run a list of operations on an ndarray, the source is only written to if owned, and intermediates ping-pong
+# through the scratch pool
+def _execute(ndarray, ops, owned=False):
+    for op in _optimize(ops):
+        result = _run(ndarray, op, owned)
+        if result is not ndarray:
+            if owned:
+                _recycle(ndarray)
+            owned = True
+            ndarray = result
+    return ndarray
+
 
 class Frame(object):
+    # Record operations and run them only when pixels or contours are needed (default for new frames)
+    lazy = False
+
+    # ndarray can also be a sharkcv.Buffer, the frame takes over the caller's reference to it
     def __init__(self, ndarray, **kwargs):
-        self._ndarray = ndarray
+        self._buffer = None
+        # Whether the pixels came from the scratch pool (and can go back to it), rather than the caller
+        self._owned = False
+        if isinstance(ndarray, sharkcv.Buffer):
+            self._buffer = ndarray
+            ndarray = ndarray.ndarray
+        self.__array = ndarray
+        self._shape = ndarray.shape[:2] if ndarray is not None else None
         self._color = 'BGR'
         if 'color' in kwargs:
             self._color = kwargs['color']
+        self._timestamp = None
+        if 'timestamp' in kwargs:
+            self._timestamp = kwargs['timestamp']
+        self._lazy = Frame.lazy
+        if 'lazy' in kwargs:
+            self._lazy = kwargs['lazy']
+        # Pending operations, run on self._base's pixels (if set) or our own
+        self._base = None
+        self._ops = []
         self._contours = None
+        # Position of our top left pixel in the frame we're a roi() of
+        self._offset = (0, 0)
+
+    def __del__(self):
+        self.__drop()
+
+    # Number of ndarrays each operation has allocated, rather than reused from the scratch pool
+    @staticmethod
+    def allocations(reset=False):
+        with _scratch_lock:
+            allocations = dict(_allocations)
+            if reset:
+                _allocations.clear()
+        return allocations
+
+    # Pixels of this frame for reading, runs any pending operations
+    @property
+    def _ndarray(self):
+        if self._base is not None or len(self._ops) > 0:
+            self.__flush()
+        return self.__array
 
+    # Pixels of this frame, safe to write to (pixels shared with a copy() are copied first)
     @property
     def ndarray(self):
-        return self._ndarray
+        ndarray = self._ndarray
+        if self._buffer is not None and self._buffer.refs > 1:
+            copy = _acquire(ndarray.shape, ndarray.dtype, 'copy')
+            np.copyto(copy, ndarray)
+            self.__set(copy, True)
+        return self.__array
 
     @property
     def width(self):
-        return self.ndarray.shape[1]
+        return self._shape[1]
 
     @property
     def height(self):
-        return self.ndarray.shape[0]
+        return self._shape[0]
+
+    @property
+    def color(self):
+        return self._color
+
+    # Time (time.time()) the source frame was captured
+    @property
+    def timestamp(self):
+        return self._timestamp
+
+    # Position (x, y) of this frame in the full frame, if it's a roi()
+    @property
+    def offset(self):
+        return self._offset
+
+    # Let go of this frame's pixels, handing them back to the scratch pool if we were the last user
+    def __drop(self):
+        ndarray = self.__array
+        self.__array = None
+        if self._buffer is not None:
+            last = self._buffer.refs == 1
+            self._buffer.release()
+            self._buffer = None
+            if not last:
+                return
+        if self._owned:
+            _recycle(ndarray)
+
+    # Whether this frame's pixels are its alone to overwrite
+    def __writable(self):
+        # Our reference and getrefcount()'s own
+        return self._owned and self._buffer is None and sys.getrefcount(self.__array) <= 2
+
+    # Replace this frame's pixels, owned if they came from the scratch pool
+    def __set(self, ndarray, owned=False):
+        if ndarray is not self.__array:
+            self.__drop()
+        elif self._buffer is not None:
+            self._buffer.release()
+            self._buffer = None
+        self.__array = ndarray
+        self._owned = owned
+        self._shape = ndarray.shape[:2]
+
+    # Run an operation now, or record it for later in lazy mode
+    def __apply(self, *op):
+        if self._lazy:
+            self._ops.append(op)
+        else:
+            # Ask before taking our own reference to the pixels
+            inplace = self.__writable()
+            self.__set(_run(self._ndarray, op, inplace), True)
+        self._contours = None
+
+    # Run pending operations
+    def __flush(self):
+        if self._base is not None:
+            # Take a copy-on-write reference to the base's (now computed) pixels
+            self._base.__flush()
+            base = self._base.copy()
+            self._base = None
+            self.__set(base.__array, base._owned)
+            self._buffer = base._buffer
+            base.__array = None
+            base._buffer = None
+            base._owned = False
+        if len(self._ops) > 0:
+            ops = self._ops
+            self._ops = []
+            inplace = self.__writable()
+            ndarray = _execute(self.__array, ops, inplace)
+            if ndarray is not self.__array:
+                self.__set(ndarray, True)
+
+    # Return a frame standing for this frame's current pixels, to build other lazy frames on
+    def __share(self):
+        if len(self._ops) > 0:
+            # Move pending operations to a frame of their own so they only run once for everyone sharing them
+            node = sharkcv.Frame(None, color=self._color, timestamp=self._timestamp, lazy=True)
+            node.__array = self.__array
+            node._buffer = self._buffer
+            node._owned = self._owned
+            node._shape = self._shape
+            node._base = self._base
+            node._ops = self._ops
+            self.__array = None
+            self._buffer = None
+            self._owned = False
+            self._base = node
+            self._ops = []
+        if self._base is not None:
+            return self._base
+        return self.copy()
+
+    # Return a copy of this frame that shares pixels until either one is written to
+    def copy(self):
+        if self._base is not None or len(self._ops) > 0:
+            frame = sharkcv.Frame(None, color=self._color, timestamp=self._timestamp, lazy=self._lazy)
+            frame._shape = self._shape
+            frame._base = self.__share()
+        else:
+            if self._buffer is None:
+                self._buffer = sharkcv.Buffer(self.__array)
+            self._buffer.retain()
+            frame = sharkcv.Frame(self._buffer, color=self._color, timestamp=self._timestamp, lazy=self._lazy)
+            frame._owned = self._owned
+        # Contour sets are never changed, only replaced
+        frame._contours = self._contours
+        frame._offset = self._offset
+        return frame
+
+    # Return a frame of a region of this frame that shares its pixels (copy-on-write like copy())
+    # Contours found in it are in full frame coordinates, as long as it isn't resized, translated or rotated
+    def roi(self, x, y, width, height):
+        ndarray = self._ndarray
+        x0 = min(max(int(x), 0), self.width)
+        y0 = min(max(int(y), 0), self.height)
+        x1 = min(max(int(x + width), x0), self.width)
+        y1 = min(max(int(y + height), y0), self.height)
+        if self._buffer is None:
+            self._buffer = sharkcv.Buffer(ndarray)
+        self._buffer.retain()
+        frame = sharkcv.Frame(self._buffer, color=self._color, timestamp=self._timestamp, lazy=self._lazy)
+        frame.__array = ndarray[y0:y1, x0:x1]
+        frame._shape = frame.__array.shape[:2]
+        frame._offset = (self._offset[0] + x0, self._offset[1] + y0)
+        return frame
+
+    # copy.deepcopy() is copy-on-write too
+    def __deepcopy__(self, memo):
+        return self.copy()
 
     # Change the colorspace of this frame
     # http://docs.opencv.org/java/2.4.7/org/opencv/imgproc/Imgproc.html
     def __color(self, name):
         # Change colorspace only if different
         if name != self._color:
+            if _conversion(self._color, name) is None:
+                return False
+            if self._lazy:
+                self._ops.append(('color', self._color, name))
+                self._color = name
+                return True
             try:
-                imgproc = getattr(cv2, 'COLOR_' + self._color + '2' + name)
-                self._ndarray = cv2.cvtColor(self.ndarray, imgproc)
+                self.__set(_run(self._ndarray, ('color', self._color, name)), True)
                 self._color = name
             except:
                 return False
@@ -60,7 +505,74 @@ class Frame(object):
 
     # Return a mask frame of threshold-ed pixels
     def threshold(self, lower, upper):
-        return sharkcv.Frame(cv2.inRange(self.ndarray, np.array(lower), np.array(upper)))
+        if self._lazy:
+            frame = sharkcv.Frame(None, timestamp=self._timestamp, lazy=True)
+            frame._shape = self._shape
+            frame._base = self.__share()
+            frame._ops = [('threshold', lower, upper)]
+            frame._offset = self._offset
+            return frame
+        frame = sharkcv.Frame(_run(self._ndarray, ('threshold', lower, upper)), timestamp=self._timestamp)
+        frame._owned = True
+        frame._offset = self._offset
+        return frame
+
+    # Return a mask frame of threshold-ed pixels like threshold(), but only threshold the full resolution pixels
+    # around blobs found in every (2 ** levels)th pixel, color converts only those pixels too if color is given
+    # (e.g. 'HSV' to threshold a BGR frame in HSV without converting all of it)
+    # Targets narrower than about 2 ** levels pixels can be missed, padding is in full resolution pixels
+    def threshold_pyramid(self, lower, upper, levels=2, padding=8, color=None):
+        ndarray = self._ndarray
+        lower, upper = _bounds(tuple(lower), tuple(upper))
+        code = None
+        if color is not None and color != self._color:
+            code = _conversion(self._color, color)
+            if code is None:
+                raise ValueError('Can\'t convert %s to %s' % (self._color, color))
+        scale = 2 ** levels
+        small = ndarray[::scale, ::scale]
+        if code is not None:
+            small = cv2.cvtColor(small, code)
+        contours, hierarchy = cv2.findContours(cv2.inRange(small, lower, upper), cv2.RETR_EXTERNAL,
+                                               cv2.CHAIN_APPROX_SIMPLE)
+        mask = _acquire(ndarray.shape[:2], np.uint8, 'threshold_pyramid')
+        mask.fill(0)
+        for contour in contours:
+            x, y, width, height = cv2.boundingRect(contour)
+            x0 = max(x * scale - padding, 0)
+            y0 = max(y * scale - padding, 0)
+            x1 = min((x + width) * scale + padding, self.width)
+            y1 = min((y + height) * scale + padding, self.height)
+            region = ndarray[y0:y1, x0:x1]
+            if code is not None:
+                region = cv2.cvtColor(region, code)
+            mask[y0:y1, x0:x1] = cv2.inRange(region, lower, upper)
+        frame = sharkcv.Frame(mask, timestamp=self._timestamp)
+        frame._owned = True
+        frame._offset = self._offset
+        return frame
+
+    # Return a mask frame of pixels within any of the (lower, upper) ranges in another colorspace, e.g.
+    # threshold_lut('HLS', [([85, 144, 44], [130, 188, 101]), ([63, 55, 168], [96, 161, 255])])
+    # Each set of ranges is turned into a lookup table from this frame's pixels (built once and cached on disk), so
+    # thresholding is a single pass with no color conversion, bits < 8 uses smaller but approximate tables
+    def threshold_lut(self, colorspace, ranges, bits=8):
+        ndarray = self._ndarray
+        if ndarray.ndim != 3 or ndarray.shape[2] != 3 or ndarray.dtype != np.uint8:
+            raise ValueError('threshold_lut() needs a 3 channel 8 bit frame')
+        ranges = tuple((tuple(lower), tuple(upper)) for lower, upper in ranges)
+        lut = _lut(self._color, colorspace, ranges, bits)
+        mask = _acquire(ndarray.shape[:2], np.uint8, 'threshold_lut')
+        if bits == 8:
+            bgra = _acquire(ndarray.shape[:2] + (4,), np.uint8, 'threshold_lut')
+            sharkcv.lut.lookup(ndarray, lut, bits, mask, bgra)
+            _recycle(bgra)
+        else:
+            sharkcv.lut.lookup(ndarray, lut, bits, mask)
+        frame = sharkcv.Frame(mask, timestamp=self._timestamp)
+        frame._owned = True
+        frame._offset = self._offset
+        return frame
 
     # Resize this frame
     def resize(self, width, height):
@@ -70,99 +582,92 @@ class Frame(object):
             height = self.height * height
         # Resize only if different
         if width != self.width or height != self.height:
-            self._ndarray = cv2.resize(self.ndarray, (width, height), interpolation=cv2.INTER_LINEAR)
-            self._contours = None
+            downscale = width * height < self.width * self.height
+            self.__apply('resize', width, height, downscale)
+            self._shape = (int(height), int(width))
 
     # Move the frame while keeping same width/height
     def translate(self, x, y):
         if x != 0 or y != 0:
             matrix = np.float32([[1, 0, x], [0, 1, y]])
-            self._ndarray = cv2.warpAffine(self.ndarray, matrix, (self.width, self.height))
-            self._contours = None
+            self.__apply('warp', matrix, self.width, self.height)
 
     # Rotate the frame while keeping same width/height
     def rotate(self, deg):
         if deg != 0:
             matrix = cv2.getRotationMatrix2D((self.width / 2, self.height / 2), deg, 1)
-            self._ndarray = cv2.warpAffine(self.ndarray, matrix, (self.width, self.height))
-            self._contours = None
+            self.__apply('warp', matrix, self.width, self.height)
 
     # Blur this frame with a box filter
     def blur(self, size):
         if size > 0:
-            self._ndarray = cv2.blur(self.ndarray, (size, size))
-            self._contours = None
+            self.__apply('blur', size)
 
     # Blur this frame with a Gaussian kernel
     def blur_gaussian(self, size):
         if size > 0:
-            self._ndarray = cv2.GaussianBlur(self.ndarray, (size, size), 0)
-            self._contours = None
+            self.__apply('blur_gaussian', size)
 
     # Blur this frame with a median filter
     def blur_median(self, size):
         if size > 0:
-            self._ndarray = cv2.medianBlur(self.ndarray, size)
-            self._contours = None
+            self.__apply('blur_median', size)
 
-    # Write this frame to an image
-    def write_image(self, filename):
-        cv2.imwrite(filename, self.ndarray)
+    # Write this frame to an image, in the background if given a sharkcv.ImageWriter
+    def write_image(self, filename, image_writer=None):
+        if image_writer is not None:
+            return image_writer.write(self, filename)
+        cv2.imwrite(filename, self._ndarray)
 
-    # Write this frame to a video (VideoWriter)
+    # Write this frame to a video (cv2.VideoWriter, or sharkcv.VideoWriter to write in the background)
     def write_video(self, video_writer):
-        video_writer.write(self.ndarray)
-
-    # Return a JPEG of this frame
-    def jpeg(self):
-        _, buffer = cv2.imencode('.jpeg', self.ndarray)
-        return buffer
-
-    # Build an array of contours
+        if isinstance(video_writer, sharkcv.Writer):
+            return video_writer.write(self)
+        video_writer.write(self._ndarray)
+
+    # Return a JPEG (memoryview) of this frame, quality in [0,100] (default: the encoder's, 95)
+    # encoder is a sharkcv.JPEGEncoder (default: one per thread with default options)
+    def jpeg(self, quality=None, encoder=None):
+        if encoder is None:
+            encoder = sharkcv.JPEGEncoder.default()
+        return encoder.encode(self._ndarray, quality)
+
+    # Build a set of contours (sharkcv.ContourSet)
     @property
     def contours(self):
         if self._contours is None:
-            self._contours = []
+            contours = []
             try:
-                contours, hierarchy = cv2.findContours(self.ndarray, cv2.RETR_TREE, cv2.CHAIN_APPROX_TC89_KCOS)
-                for contour in contours:
-                    self._contours.append(sharkcv.Contour(contour))
+                # findContours() modifies its input in OpenCV 2.4, don't let it touch shared pixels
+                contours, hierarchy = cv2.findContours(self.ndarray, cv2.RETR_TREE, cv2.CHAIN_APPROX_TC89_KCOS,
+                                                       offset=self._offset)
             except:
                 pass
+            self._contours = sharkcv.ContourSet(contours)
         return self._contours
 
-    # Filter contours by any sharkcv.Contour property
-    def contours_filter(self, **kwargs):
-        for prop in kwargs.keys():
-            range = kwargs[prop]
-            i = 0
-            while i < len(self.contours):
-                value = getattr(self.contours[i], prop)
-                if range[0] is not None and range[0] >= 0:
-                    if value < range[0]:
-                        del self.contours[i]
-                        continue
-                if range[1] is not None and range[1] >= 0:
-                    if value > range[1]:
-                        del self.contours[i]
-                        continue
-                i += 1
+    # Filter contours by (min, max) ranges of any sharkcv.Contour property, or callables (see ContourSet.filter())
+    def contours_filter(self, *args, **kwargs):
+        self._contours = self.contours.filter(*args, **kwargs)
 
     # Sort contours by any sharkcv.Contour property
     def contours_sort(self, prop, descending=True):
-        self._contours = sorted(self.contours, key=lambda c: getattr(c, prop), reverse=descending)
+        self._contours = self.contours.sort(prop, descending)
 
-    # Draw this frame's contours onto another frame
+    # Draw this frame's contours (or kwargs['contours'], a sharkcv.ContourSet or list of sharkcv.Contour) onto
+    # another frame
     def contours_draw(self, frame, **kwargs):
+        if 'contours' not in kwargs:
+            kwargs['contours'] = self.contours
         if 'start' not in kwargs:
             kwargs['start'] = 0
         if 'end' not in kwargs:
-            kwargs['end'] = len(self.contours) - 1
+            kwargs['end'] = len(kwargs['contours']) - 1
         if 'color' not in kwargs:
             kwargs['color'] = (0, 255, 0)
         if 'width' not in kwargs:
             kwargs['width'] = 2
-        contours = [cnt.ndarray for cnt in self.contours][kwargs['start']:kwargs['end'] + 1]
+        contours = [contour.ndarray for contour in kwargs['contours']][kwargs['start']:kwargs['end'] + 1]
         if len(contours) > 0:
             cv2.drawContours(frame.ndarray, contours, -1, kwargs['color'], kwargs['width'])
             return True
@@ -177,9 +682,7 @@ class Frame(object):
         if 'iterations' not in kwargs:
             kwargs['iterations'] = 1
         if kwargs['size'] > 0 and kwargs['iterations'] > 0:
-            kernel = cv2.getStructuringElement(kwargs['shape'], (kwargs['size'], kwargs['size']))
-            self._ndarray = cv2.dilate(self.ndarray, kernel, kwargs['iterations'], borderType=cv2.BORDER_CONSTANT)
-            self._contours = None
+            self.__apply('morph', cv2.MORPH_DILATE, kwargs['shape'], kwargs['size'], kwargs['iterations'])
 
     # Erode this mask's white region
     def erode(self, **kwargs):
@@ -190,9 +693,7 @@ class Frame(object):
         if 'iterations' not in kwargs:
             kwargs['iterations'] = 1
         if kwargs['size'] > 0 and kwargs['iterations'] > 0:
-            kernel = cv2.getStructuringElement(kwargs['shape'], (kwargs['size'], kwargs['size']))
-            self._ndarray = cv2.erode(self.ndarray, kernel, kwargs['iterations'], borderType=cv2.BORDER_CONSTANT)
-            self._contours = None
+            self.__apply('morph', cv2.MORPH_ERODE, kwargs['shape'], kwargs['size'], kwargs['iterations'])
 
     # Erode/dilate this mask's white area
     def open(self, **kwargs):
@@ -201,9 +702,7 @@ class Frame(object):
         if 'size' not in kwargs:
             kwargs['size'] = 3
         if kwargs['size'] > 0:
-            kernel = cv2.getStructuringElement(kwargs['shape'], (kwargs['size'], kwargs['size']))
-            self._ndarray = cv2.morphologyEx(self.ndarray, cv2.MORPH_OPEN, kernel)
-            self._contours = None
+            self.__apply('morph', cv2.MORPH_OPEN, kwargs['shape'], kwargs['size'], 1)
 
     # Dilate/erode this mask's white area
     def close(self, **kwargs):
@@ -212,26 +711,20 @@ class Frame(object):
         if 'size' not in kwargs:
             kwargs['size'] = 3
         if kwargs['size'] > 0:
-            kernel = cv2.getStructuringElement(kwargs['shape'], (kwargs['size'], kwargs['size']))
-            self._ndarray = cv2.morphologyEx(self.ndarray, cv2.MORPH_CLOSE, kernel)
-            self._contours = None
+            self.__apply('morph', cv2.MORPH_CLOSE, kwargs['shape'], kwargs['size'], 1)
 
     # AND this frame with another frame
     def bit_and(self, frame):
-        self._ndarray = cv2.bitwise_and(self.ndarray, frame.ndarray)
-        self._contours = None
+        self.__apply('bit', cv2.bitwise_and, frame.__share() if self._lazy else frame)
 
     # OR this frame with another frame
     def bit_or(self, frame):
-        self._ndarray = cv2.bitwise_or(self.ndarray, frame.ndarray)
-        self._contours = None
+        self.__apply('bit', cv2.bitwise_or, frame.__share() if self._lazy else frame)
 
-    # NOT this frame with another frame
-    def bit_not(self, frame):
-        self._ndarray = cv2.bitwise_not(self.ndarray, frame.ndarray)
-        self._contours = None
+    # NOT this frame, frame is ignored (it used to be overwritten with the result)
+    def bit_not(self, frame=None):
+        self.__apply('bit', cv2.bitwise_not, None)
 
     # XOR this frame with another frame
     def bit_xor(self, frame):
-        self._ndarray = cv2.bitwise_xor(self.ndarray, frame.ndarray)
-        self._contours = None
+        self.__apply('bit', cv2.bitwise_xor, frame.__share() if self._lazy else frame)
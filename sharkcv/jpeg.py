@@ -0,0 +1,141 @@
+import logging
+import sys
+import threading
+
+import cv2
+
+# libjpeg-turbo through PyTurboJPEG is optional, OpenCV's encoder is used without it
+# Imported with the first encoder that could use it rather than with sharkcv
+turbojpeg = None
+
+BACKENDS = ('auto', 'turbo', 'opencv')
+SUBSAMPLING = ('444', '422', '420')
+
+# Output buffers kept for reuse per encoder
+_BUFFERS = 4
+
+# OpenCV 4.5.5 and up take a sampling factor, older versions always use 4:2:0
+_CV_SAMPLING = {'444': 0x111111, '422': 0x211111, '420': 0x221111}
+
+_local = threading.local()
+_turbo = None
+_turbo_lock = threading.Lock()
+
+
+# Load libjpeg-turbo once, None if it (or PyTurboJPEG) isn't installed
+def _load_turbo():
+    global _turbo, turbojpeg
+    with _turbo_lock:
+        if _turbo is None:
+            try:
+                import turbojpeg
+                _turbo = turbojpeg.TurboJPEG()
+            except Exception, e:
+                logging.debug('libjpeg-turbo not available: %s', str(e))
+                _turbo = False
+    return _turbo or None
+
+
+# Encode ndarrays to JPEG with libjpeg-turbo when it's installed, OpenCV otherwise
+# Returns a memoryview of the JPEG, written into one of a few reused buffers where the backend allows it (a buffer is
+# only reused once nothing refers to the memoryview from last time)
+class JPEGEncoder(object):
+    def __init__(self, **kwargs):
+        # Quality in [1,100] when encode() isn't given one (default: OpenCV's 95)
+        if 'quality' not in kwargs:
+            kwargs['quality'] = 95
+        # Chroma subsampling '444', '422' or '420' (default: 420, what OpenCV does)
+        if 'subsampling' not in kwargs:
+            kwargs['subsampling'] = '420'
+        # Faster, slightly less accurate DCT (libjpeg-turbo only)
+        if 'fast' not in kwargs:
+            kwargs['fast'] = False
+        if 'backend' not in kwargs:
+            kwargs['backend'] = 'auto'
+        if kwargs['subsampling'] not in SUBSAMPLING:
+            raise ValueError('Unknown JPEG subsampling: %s' % kwargs['subsampling'])
+        if kwargs['backend'] not in BACKENDS:
+            raise ValueError('Unknown JPEG backend: %s' % kwargs['backend'])
+        self._quality = kwargs['quality']
+        self._subsampling = kwargs['subsampling']
+        self._fast = kwargs['fast']
+        self._turbo = None
+        if kwargs['backend'] != 'opencv':
+            self._turbo = _load_turbo()
+            if self._turbo is None and kwargs['backend'] == 'turbo':
+                raise ValueError('libjpeg-turbo (PyTurboJPEG) is not installed')
+        self._buffers = []
+
+    # Encoder for the calling thread with default options, for Frame.jpeg()
+    @staticmethod
+    def default():
+        if not hasattr(_local, 'encoder'):
+            _local.encoder = JPEGEncoder()
+        return _local.encoder
+
+    # 'turbo' or 'opencv'
+    @property
+    def backend(self):
+        return 'turbo' if self._turbo is not None else 'opencv'
+
+    @property
+    def quality(self):
+        return self._quality
+
+    @property
+    def subsampling(self):
+        return self._subsampling
+
+    @property
+    def fast(self):
+        return self._fast
+
+    # Return a memoryview of a BGR, BGRA or grayscale ndarray as a JPEG
+    def encode(self, ndarray, quality=None):
+        if quality is None:
+            quality = self._quality
+        quality = int(quality)
+        if self._turbo is not None:
+            return self.__encode_turbo(ndarray, quality)
+        return self.__encode_cv(ndarray, quality)
+
+    def __encode_cv(self, ndarray, quality):
+        params = [cv2.IMWRITE_JPEG_QUALITY, quality]
+        if hasattr(cv2, 'IMWRITE_JPEG_SAMPLING_FACTOR'):
+            params += [cv2.IMWRITE_JPEG_SAMPLING_FACTOR, _CV_SAMPLING[self._subsampling]]
+        _, buffer = cv2.imencode('.jpeg', ndarray, params)
+        # imencode() always allocates, at least don't copy it again
+        return memoryview(buffer.reshape(-1))
+
+    def __encode_turbo(self, ndarray, quality):
+        if ndarray.ndim == 2 or ndarray.shape[2] == 1:
+            pixel_format, subsample = turbojpeg.TJPF_GRAY, turbojpeg.TJSAMP_GRAY
+            ndarray = ndarray.reshape(ndarray.shape[:2] + (1,))
+        else:
+            pixel_format = turbojpeg.TJPF_BGRA if ndarray.shape[2] == 4 else turbojpeg.TJPF_BGR
+            subsample = getattr(turbojpeg, 'TJSAMP_' + self._subsampling)
+        flags = turbojpeg.TJFLAG_FASTDCT if self._fast else 0
+        # libjpeg-turbo wants whole rows, roi() frames are views
+        if not ndarray.flags['C_CONTIGUOUS']:
+            ndarray = ndarray.copy()
+        # Older PyTurboJPEG can't encode into a given buffer
+        if not hasattr(self._turbo, 'buffer_size'):
+            return memoryview(self._turbo.encode(ndarray, quality=quality, pixel_format=pixel_format,
+                                                 jpeg_subsample=subsample, flags=flags))
+        buffer = self.__buffer(self._turbo.buffer_size(ndarray, subsample))
+        buffer, size = self._turbo.encode(ndarray, quality=quality, pixel_format=pixel_format,
+                                          jpeg_subsample=subsample, flags=flags, dst=buffer)
+        return memoryview(buffer)[:size]
+
+    # A bytearray of at least nbytes that nothing else refers to
+    def __buffer(self, nbytes):
+        for index in range(len(self._buffers)):
+            # The list's reference and getrefcount()'s own, anything more is a memoryview still in use
+            if sys.getrefcount(self._buffers[index]) <= 2:
+                if len(self._buffers[index]) < nbytes:
+                    self._buffers[index] = bytearray(nbytes)
+                return self._buffers[index]
+        buffer = bytearray(nbytes)
+        if len(self._buffers) < _BUFFERS:
+            self._buffers.append(buffer)
+        return buffer
@@ -0,0 +1,98 @@
+import hashlib
+import logging
+import os
+import tempfile
+
+import cv2
+import numpy as np
+
+# Where built tables are kept between runs
+CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache')),
+                         'sharkcv')
+
+# Most bytes of tables Frame.threshold_lut() keeps in memory (per process), the least recently used go first
+# A full 8 bit table is 16 MB, a 7 bit one 2 MB
+MEMORY = 32 << 20
+
+
+# Name a table by everything that changes its contents
+def _key(src_color, dst_color, ranges, bits):
+    return hashlib.sha1(repr((src_color, dst_color, ranges, bits, cv2.__version__))).hexdigest()
+
+
+# Build a table mapping every (quantized) 3 channel src_color pixel to 255 if it's within any of the (lower, upper)
+# ranges in dst_color, indexed by channels 2, 1, 0 from most to least significant bits
+def _build(src_color, dst_color, ranges, bits):
+    code = None
+    if dst_color != src_color:
+        code = getattr(cv2, 'COLOR_' + src_color + '2' + dst_color, None)
+        if code is None:
+            raise ValueError('Can\'t convert %s to %s' % (src_color, dst_color))
+    levels = 1 << bits
+    shift = 8 - bits
+    # Middle of the range of pixel values each level stands for
+    values = ((np.arange(levels) << shift) + ((1 << shift) >> 1)).astype(np.uint8)
+    bounds = [(np.array(lower), np.array(upper)) for lower, upper in ranges]
+    # One plane of channels 1 and 0 at a time keeps memory down
+    plane = np.empty((levels * levels, 1, 3), np.uint8)
+    plane[:, 0, 1] = np.repeat(values, levels)
+    plane[:, 0, 0] = np.tile(values, levels)
+    table = np.empty(levels ** 3, np.uint8)
+    for i in range(levels):
+        plane[:, 0, 2] = values[i]
+        converted = cv2.cvtColor(plane, code) if code is not None else plane
+        mask = np.zeros((levels * levels, 1), np.uint8)
+        for lower, upper in bounds:
+            cv2.bitwise_or(mask, cv2.inRange(converted, lower, upper), mask)
+        table[i * levels * levels:(i + 1) * levels * levels] = mask.ravel()
+    return table
+
+
+# Return the table for a set of ranges from the disk cache, or build (and save) it
+def table(src_color, dst_color, ranges, bits=8):
+    ranges = tuple((tuple(lower), tuple(upper)) for lower, upper in ranges)
+    key = _key(src_color, dst_color, ranges, bits)
+    filename = os.path.join(CACHE_DIR, 'lut-' + key + '.npy')
+    lut = None
+    if os.path.isfile(filename):
+        try:
+            # Saved as bits
+            lut = np.unpackbits(np.load(filename)) * np.uint8(255)
+            logging.debug('Loaded color lookup table: %s', filename)
+        except Exception, e:
+            logging.warning('Failed to load color lookup table %s: %s', filename, e)
+    if lut is None or len(lut) != 1 << (3 * bits):
+        logging.debug('Building color lookup table (%d bits): %s -> %s %s', bits, src_color, dst_color, ranges)
+        lut = _build(src_color, dst_color, ranges, bits)
+        try:
+            if not os.path.isdir(CACHE_DIR):
+                os.makedirs(CACHE_DIR)
+            # Write then rename so a half written file is never loaded
+            fd, temp = tempfile.mkstemp(dir=CACHE_DIR, suffix='.npy')
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, np.packbits(lut > 0))
+            os.rename(temp, filename)
+        except Exception, e:
+            logging.warning('Failed to save color lookup table %s: %s', filename, e)
+    return lut
+
+
+# Look up every pixel of a 3 channel uint8 ndarray in a table, into dst (a 2D uint8 ndarray)
+# bgra is scratch space (the shape of src with 4 channels) used for full 8 bit tables
+def lookup(src, lut, bits, dst, bgra=None):
+    if bits == 8:
+        # Pad pixels to 4 bytes so each one reads as a single little-endian uint32 index
+        if bgra is None:
+            bgra = np.empty(src.shape[:2] + (4,), np.uint8)
+        cv2.cvtColor(src, cv2.COLOR_BGR2BGRA, bgra)
+        index = bgra.view('<u4').reshape(src.shape[:2])
+        index &= 0xFFFFFF
+    else:
+        shift = 8 - bits
+        index = src[..., 2] >> shift
+        index = index.astype(np.int32)
+        index <<= bits
+        index |= src[..., 1] >> shift
+        index <<= bits
+        index |= src[..., 0] >> shift
+    return np.take(lut, index, out=dst)
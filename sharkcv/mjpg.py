@@ -0,0 +1,312 @@
+import logging
+import re
+import socket
+import threading
+import time
+import urlparse
+
+import cv2
+import numpy as np
+
+SOI = b'\xff\xd8'
+EOI = b'\xff\xd9'
+_content_length = re.compile(br'content-length:\s*(\d+)', re.IGNORECASE)
+_status = re.compile(br'HTTP/\d\.\d\s+(\d{3})\s*([^\r\n]*)')
+# Most bytes of response headers before giving up on a server
+_MAX_HEADERS = 1 << 16
+
+
+# Incremental parser for multipart MJPG streams
+# Uses each part's Content-Length when present and falls back to scanning for the EOI marker. Header segments are
+# skipped by their length so an EXIF thumbnail's EOI doesn't end the frame early, after that EOI can only appear as a
+# marker. Only the newest complete JPEG is kept.
+class MJPGParser(object):
+    def __init__(self, **kwargs):
+        if 'size' not in kwargs:
+            kwargs['size'] = 1 << 18
+        if 'max_size' not in kwargs:
+            kwargs['max_size'] = 1 << 24
+        self._max_size = kwargs['max_size']
+        self._buffer = bytearray(kwargs['size'])
+        self._view = memoryview(self._buffer)
+        # Unparsed data is self._buffer[self._start:self._end]
+        self._start = 0
+        self._end = 0
+        # Bytes still expected by Content-Length, or marker scan state
+        self._length = None
+        self._scanning = False
+        self._entropy = False
+        self._scan = 0
+        self._jpeg = None
+        self._frames = 0
+        self._dropped = 0
+        self._bytes = 0
+
+    @property
+    def frames(self):
+        return self._frames
+
+    @property
+    def dropped(self):
+        return self._dropped
+
+    @property
+    def bytes(self):
+        return self._bytes
+
+    # Return a writable memoryview of free buffer space, e.g. for socket.recv_into()
+    def space(self):
+        # Move unparsed data to the front once the buffer is half used up
+        if self._start > 0 and self._end > len(self._buffer) / 2:
+            length = self._end - self._start
+            self._buffer[:length] = self._buffer[self._start:self._end]
+            self._scan -= self._start
+            self._start = 0
+            self._end = length
+        # Grow when full, or throw everything away if a frame has gotten unreasonably large
+        if self._end == len(self._buffer):
+            if len(self._buffer) * 2 > self._max_size:
+                logging.warning('MJPG frame larger than %d bytes, discarding', self._max_size)
+                self.__reset()
+            else:
+                # Can't resize a bytearray with memoryviews of it around, copy instead
+                buffer = bytearray(len(self._buffer) * 2)
+                buffer[:self._end] = self._buffer[:self._end]
+                self._buffer = buffer
+                self._view = memoryview(self._buffer)
+        return self._view[self._end:]
+
+    # Parse n bytes written into space(), returns the number of complete JPEGs found
+    def commit(self, n):
+        self._end += n
+        self._bytes += n
+        return self.__parse()
+
+    # Parse a string of bytes, returns the number of complete JPEGs found
+    def feed(self, data):
+        found = 0
+        data = memoryview(data)
+        while len(data) > 0:
+            space = self.space()
+            n = min(len(space), len(data))
+            space[:n] = data[:n]
+            data = data[n:]
+            found += self.commit(n)
+        return found
+
+    # Return the newest complete JPEG (or None) and forget it
+    def pop(self):
+        jpeg = self._jpeg
+        self._jpeg = None
+        return jpeg
+
+    def __reset(self):
+        self._start = 0
+        self._end = 0
+        self._length = None
+        self._scanning = False
+
+    # Walk the marker segments in front of the entropy-coded data, returns False if more data is needed
+    def __segments(self):
+        buffer = self._buffer
+        while self._scan + 4 <= self._end:
+            if buffer[self._scan] != 0xff:
+                # Not a marker, fall back to a plain EOI search
+                self._entropy = True
+                return True
+            marker = buffer[self._scan + 1]
+            if marker == 0xff:
+                self._scan += 1
+            elif 0xd0 <= marker <= 0xd7 or marker == 0x01:
+                self._scan += 2
+            else:
+                self._scan += 2 + (buffer[self._scan + 2] << 8 | buffer[self._scan + 3])
+                if marker == 0xda:
+                    self._entropy = True
+                    return True
+        return False
+
+    def __parse(self):
+        found = None
+        count = 0
+        buffer = self._buffer
+        while True:
+            # Waiting on the rest of a Content-Length body
+            if self._length is not None:
+                if self._end - self._start < self._length:
+                    break
+                found = (self._start, self._start + self._length)
+                self._start += self._length
+                self._length = None
+                count += 1
+                continue
+
+            # Scanning for the EOI that closes the current JPEG
+            if self._scanning:
+                if not self._entropy and not self.__segments():
+                    break
+                eoi = buffer.find(EOI, min(self._scan, self._end), self._end)
+                if eoi == -1:
+                    self._scan = max(self._end - 1, self._scan)
+                    break
+                found = (self._start, eoi + 2)
+                self._start = eoi + 2
+                self._scanning = False
+                count += 1
+                continue
+
+            # Look for the start of the next JPEG, anything before it is part headers
+            soi = buffer.find(SOI, self._start, self._end)
+            if soi == -1:
+                # Keep the tail, it may hold headers or half of a marker
+                if self._end - self._start > 4096:
+                    self._start = self._end - 1
+                break
+            headers = buffer[self._start:soi]
+            self._start = soi
+            match = None
+            if headers.endswith(b'\r\n\r\n'):
+                for match in _content_length.finditer(headers):
+                    pass
+            if match is not None:
+                self._length = int(match.group(1))
+            else:
+                self._scanning = True
+                self._entropy = False
+                self._scan = soi + 2
+
+        if count > 0:
+            if self._jpeg is not None:
+                self._dropped += 1
+            self._dropped += count - 1
+            self._frames += count
+            self._jpeg = self._view[found[0]:found[1]].tobytes()
+        if self._start == self._end and self._length is None and not self._scanning:
+            self._start = 0
+            self._end = 0
+        return count
+
+
+# Read an MJPG stream over HTTP(S) on a background thread, keeping only the newest JPEG
+# start() raises if the server can't be reached or doesn't answer with a 2xx status
+# read() is compatible with cv2.VideoCapture.read() so it can be used as a sharkcv.Capture source
+class MJPGReader(object):
+    def __init__(self, url, **kwargs):
+        if 'timeout' not in kwargs:
+            kwargs['timeout'] = 5.0
+        self._url = url
+        self._timeout = kwargs['timeout']
+        self._parser = MJPGParser()
+        self._cond = threading.Condition()
+        self._jpeg = None
+        self._timestamp = None
+        self._thread = None
+        self._running = False
+        self._sock = None
+
+    @property
+    def parser(self):
+        return self._parser
+
+    # Time the newest JPEG finished arriving
+    @property
+    def timestamp(self):
+        return self._timestamp
+
+    def start(self):
+        url = urlparse.urlsplit(self._url)
+        if url.scheme not in ('http', 'https'):
+            raise ValueError('Not an HTTP(S) URL: %s' % self._url)
+        path = url.path or '/'
+        if url.query:
+            path += '?' + url.query
+        self._sock = socket.create_connection((url.hostname, url.port or (443 if url.scheme == 'https' else 80)),
+                                              self._timeout)
+        try:
+            if url.scheme == 'https':
+                # Only imported for https streams
+                import ssl
+                self._sock = ssl.create_default_context().wrap_socket(self._sock, server_hostname=url.hostname)
+            # The Host header never carries user:password@, credentials go in an Authorization header instead
+            host = '[' + url.hostname + ']' if ':' in url.hostname else url.hostname
+            if url.port is not None:
+                host += ':%d' % url.port
+            request = 'GET ' + path + ' HTTP/1.0\r\nHost: ' + host + '\r\n'
+            if url.username is not None:
+                # Only imported for streams with credentials
+                import base64
+                credentials = urlparse.unquote(url.username) + ':' + urlparse.unquote(url.password or '')
+                request += 'Authorization: Basic ' + base64.b64encode(credentials) + '\r\n'
+            self._sock.sendall(request + '\r\n')
+            self.__response()
+        except Exception:
+            self._sock.close()
+            self._sock = None
+            raise
+        self._running = True
+        self._thread = threading.Thread(target=self.__run)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        if self._sock is not None:
+            try:
+                self._sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            self._sock.close()
+        if self._thread is not None:
+            self._thread.join(1.0)
+            self._thread = None
+
+    # Read the response headers and check the status, whatever body came with them goes to the parser
+    def __response(self):
+        data = b''
+        while b'\r\n\r\n' not in data:
+            chunk = self._sock.recv(4096)
+            if len(chunk) == 0 or len(data) > _MAX_HEADERS:
+                raise IOError('No HTTP response from %s' % self._url)
+            data += chunk
+        headers, body = data.split(b'\r\n\r\n', 1)
+        match = _status.match(headers)
+        if match is None:
+            raise IOError('Bad HTTP response from %s: %r' % (self._url, headers.split(b'\r\n', 1)[0]))
+        if not 200 <= int(match.group(1)) < 300:
+            raise IOError('HTTP %s %s from %s' % (match.group(1), match.group(2).strip(), self._url))
+        if len(body) > 0 and self._parser.feed(body) > 0:
+            self._jpeg = self._parser.pop()
+            self._timestamp = time.time()
+
+    def __run(self):
+        while self._running:
+            try:
+                n = self._sock.recv_into(self._parser.space())
+            except socket.error, e:
+                if self._running:
+                    logging.warning('MJPG stream error: %s', str(e))
+                n = 0
+            if n == 0:
+                break
+            if self._parser.commit(n) > 0:
+                with self._cond:
+                    self._jpeg = self._parser.pop()
+                    self._timestamp = time.time()
+                    self._cond.notify_all()
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+
+    # Wait for and decode the newest JPEG, ndarray is ignored (imdecode can't decode into it)
+    def read(self, ndarray=None):
+        with self._cond:
+            while self._jpeg is None and self._running:
+                self._cond.wait(0.1)
+            jpeg = self._jpeg
+            self._jpeg = None
+        if jpeg is None:
+            return False, None
+        ndarray = cv2.imdecode(np.frombuffer(jpeg, dtype=np.uint8), cv2.IMREAD_COLOR)
+        return ndarray is not None, ndarray
@@ -0,0 +1,185 @@
+import ConfigParser
+import imp
+import importlib
+import logging
+import os
+import sys
+import time
+
+import sharkcv
+
+# Registry looked for next to SharkCV.py when none is given
+REGISTRY = 'modules.cfg'
+
+
+# Split a module entry point into what to import and the function name (None for the module's own name)
+# Entries are file.py, file.py:function or package.module:function
+def split(entry):
+    if ':' in entry and not os.path.exists(entry):
+        target, function = entry.rsplit(':', 1)
+        return target, function
+    return entry, None
+
+
+# Import a Python module file (or dotted module name) and return it
+def load_module(target):
+    if not os.path.exists(target) and not target.endswith('.py'):
+        return importlib.import_module(target)
+    # Add module's directory to Python's path
+    moddir = os.path.dirname(os.path.abspath(target))
+    if moddir not in sys.path:
+        sys.path.insert(0, moddir)
+    # Import the module's basename
+    modname = os.path.splitext(os.path.basename(target))[0]
+    return __import__(modname)
+
+
+# Import a module entry point and return its function, by default the one named after the module
+def load(entry):
+    target, function = split(entry)
+    if function is None:
+        function = os.path.splitext(os.path.basename(target))[0].split('.')[-1]
+    return getattr(load_module(target), function)
+
+
+# Read a registry file of named entry points, e.g.
+#   [modules]
+#   default = goal
+#   goal = samples/GRIP_2016_2.py
+#   intake = vision.intake:process
+# Files are relative to the registry file
+def registry(filename):
+    config = ConfigParser.RawConfigParser()
+    # Names are case sensitive
+    config.optionxform = str
+    if len(config.read(filename)) == 0:
+        raise IOError('Failed to read module registry: %s' % filename)
+    root = os.path.dirname(os.path.abspath(filename))
+    entries = {}
+    for name, entry in config.items('modules'):
+        target, function = split(entry)
+        path = os.path.join(root, target)
+        if os.path.exists(path):
+            entry = path if function is None else path + ':' + function
+        entries[name] = entry
+    return entries
+
+
+# Find the entry point for a name: a registry name (default if None), a file (with or without .py) or an entry itself
+# No directories are searched, so what runs is always what was asked for
+def resolve(name, entries=None):
+    entries = entries or {}
+    if name is None:
+        if 'default' not in entries:
+            raise ValueError('No module given and no default in the module registry')
+        name = entries['default']
+    # default can name another entry
+    if name in entries:
+        name = entries[name]
+    target, function = split(name)
+    if not os.path.exists(target) and os.path.exists(target + '.py'):
+        target += '.py'
+    if os.path.exists(target):
+        target = os.path.relpath(target)
+    return target if function is None else target + ':' + function
+
+
+# Source file of an imported module
+def _source(module):
+    filename = module.__file__
+    if filename.endswith(('.pyc', '.pyo')):
+        filename = filename[:-1]
+    return filename
+
+
+# Call a module entry point, re-importing its file between calls when it changes so capture, outputs and stream clients
+# stay up while it's edited
+# A new version is on trial until it gets through a frame: if it fails to import or raises, the last good version takes
+# over (and handles the frame) until the file changes again
+class Reloader(object):
+    def __init__(self, entry, **kwargs):
+        # Seconds between checks of the file
+        if 'interval' not in kwargs:
+            kwargs['interval'] = 0.5
+        self._interval = kwargs['interval']
+        self._target, self._function_name = split(entry)
+        module = load_module(self._target)
+        if self._function_name is None:
+            self._function_name = os.path.splitext(os.path.basename(self._target))[0].split('.')[-1]
+        self._filename = _source(module)
+        self._stat = self.__stat()
+        self._checked = time.time()
+        # Modules are kept with their functions, Python 2 clears a module's globals when it's freed
+        self._good = (module, getattr(module, self._function_name))
+        self._trial = None
+        self._reloads = 0
+        self._rollbacks = 0
+
+    @property
+    def filename(self):
+        return self._filename
+
+    # Number of new versions that got through a frame
+    @property
+    def reloads(self):
+        return self._reloads
+
+    # Number of new versions that failed and were rolled back
+    @property
+    def rollbacks(self):
+        return self._rollbacks
+
+    def __stat(self):
+        try:
+            stat = os.stat(self._filename)
+            return stat.st_mtime, stat.st_size
+        except OSError:
+            return None
+
+    # Import the file again as a new module if it changed, the old one is left as it was
+    def check(self):
+        now = time.time()
+        if now - self._checked < self._interval:
+            return
+        self._checked = now
+        stat = self.__stat()
+        if stat is None or stat == self._stat:
+            return
+        self._stat = stat
+        start = time.time()
+        old = self._good[0]
+        module = imp.new_module(old.__name__)
+        module.__file__ = self._filename
+        if getattr(old, '__package__', None) is not None:
+            module.__package__ = old.__package__
+        try:
+            with open(self._filename, 'rU') as f:
+                code = compile(f.read(), self._filename, 'exec')
+            exec code in module.__dict__
+            self._trial = (module, getattr(module, self._function_name))
+        except Exception, e:
+            logging.error('Reload of %s failed, keeping the last good version: %s', self._filename, str(e))
+            self._trial = None
+            self._rollbacks += 1
+            return
+        logging.info('Reloaded %s in %.0f ms', self._filename, 1000 * (time.time() - start))
+        sharkcv.Profiler.record('module.reload', time.time() - start)
+
+    def __call__(self, frame):
+        self.check()
+        if self._trial is None:
+            return self._good[1](frame)
+        # Frames can be changed in place, the last good version gets the frame as it came
+        original = frame.copy()
+        try:
+            modret = self._trial[1](frame)
+        except Exception, e:
+            logging.error('Reloaded %s raised, rolling back: %s', self._filename, str(e))
+            self._trial = None
+            self._rollbacks += 1
+            return self._good[1](original)
+        self._good = self._trial
+        self._trial = None
+        self._reloads += 1
+        sys.modules[self._good[0].__name__] = self._good[0]
+        return modret
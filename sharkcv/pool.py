@@ -0,0 +1,255 @@
+import logging
+import Queue
+import signal
+import threading
+
+import numpy as np
+
+import sharkcv
+
+# Worker processes taking turns on frames, set in workers
+_stride = 1
+
+
+# Return an ndarray described by Pool.__pack() or _worker()
+def _unpack(packed):
+    if packed[0] == 'shm':
+        _, pool, index, shape, dtype = packed
+        return sharkcv.BufferPool.find(pool).view(index, shape, dtype)
+    return packed[1]
+
+
+# Worker process: import the modules and run them on every frame that shows up
+def _worker(modfiles, outputs, tasks, results, reload, stride):
+    global _stride
+    # Let the parent process handle Ctrl-C
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _stride = stride
+    modules = {}
+    try:
+        for name, modfile in modfiles.items():
+            # Each worker reloads (and rolls back) on its own
+            modules[name] = sharkcv.module.Reloader(modfile) if reload else sharkcv.module.load(modfile)
+    except Exception, e:
+        results.put((None, ('error', 'Import failed: ' + str(e))))
+        return
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        seq, name, packed, output, color, timestamp = task
+        ndarray = _unpack(packed)
+        try:
+            modret = modules[name](sharkcv.Frame(ndarray, color=color, timestamp=timestamp))
+        except Exception, e:
+            results.put((seq, ('error', str(e))))
+            continue
+
+        # Contours and tracks go back as rows of values (see sharkcv.batch.rows()), (frame, results) as both
+        rows = None
+        if type(modret) is tuple and len(modret) == 2 and isinstance(modret[0], sharkcv.Frame):
+            modret, rows = modret[0], sharkcv.batch.rows(modret[1])
+        elif type(modret) is not sharkcv.Frame and modret is not None:
+            try:
+                modret = sharkcv.batch.rows(modret)
+            except TypeError:
+                pass
+
+        if type(modret) is not sharkcv.Frame:
+            results.put((seq, ('object', modret)))
+        elif modret._ndarray is ndarray:
+            # Module returned its input, no need to copy it anywhere
+            results.put((seq, ('frame', ('input',), modret.color, rows)))
+        elif output is not None and modret._ndarray.nbytes <= outputs.nbytes:
+            result = modret._ndarray
+            np.copyto(outputs.view(output, result.shape, result.dtype), result)
+            results.put((seq, ('frame', ('shm', outputs.id, output, result.shape, result.dtype.str), modret.color,
+                               rows)))
+        else:
+            results.put((seq, ('frame', ('pickle', modret._ndarray), modret.color, rows)))
+
+
+# Run a module on a pool of worker processes
+# Frames are passed through shared memory and results are returned in the order they were submitted
+# modfile can also be a dict of names to modules, for frames submitted under those names (see sharkcv.Scheduler)
+class Pool(object):
+    def __init__(self, modfile, workers, **kwargs):
+        # Reload the module in every worker when its file changes (see sharkcv.module.Reloader)
+        if 'reload' not in kwargs:
+            kwargs['reload'] = False
+        # Frames the caller keeps after get() (e.g. queued in a sharkcv.Writer or shown by a sharkcv.StreamServer),
+        # each one holds on to a shared buffer
+        if 'hold' not in kwargs:
+            kwargs['hold'] = 0
+        self._modfiles = modfile if isinstance(modfile, dict) else {None: modfile}
+        self._workers = max(workers, 1)
+        self._reload = kwargs['reload']
+        self._hold = max(kwargs['hold'], 0)
+        self._inputs = None
+        self._outputs = None
+        self._processes = []
+        self._tasks = None
+        self._results = None
+        self._received = None
+        self._watchers = []
+        self._submitted = {}
+        self._done = {}
+        self._seq_in = 0
+
+    @property
+    def workers(self):
+        return self._workers
+
+    # Number of worker processes taking turns on the frames a module sees, 1 outside of a Pool (every frame, in order)
+    # Modules that follow things across frames (e.g. sharkcv.Tracker) need 1
+    @staticmethod
+    def stride():
+        return _stride
+
+    # Number of frames submitted but not yet returned by get()
+    @property
+    def pending(self):
+        return len(self._submitted)
+
+    # Allocate shared buffers and fork the workers (delayed until the frame size is known)
+    def __start(self, nbytes):
+        # Only imported when the module runs in workers
+        import multiprocessing
+        # Every in-flight frame, the last one returned by get() and the ones the caller holds need a buffer
+        slots = self._workers + 2 + self._hold
+        logging.debug('Starting %d workers with %d shared %d byte buffers', self._workers, slots, nbytes)
+        self._inputs = sharkcv.BufferPool(nbytes, slots)
+        self._outputs = sharkcv.BufferPool(nbytes, slots)
+        self._tasks = multiprocessing.Queue()
+        self._results = multiprocessing.Queue()
+        for _ in range(self._workers):
+            process = multiprocessing.Process(target=_worker, args=(self._modfiles, self._outputs, self._tasks,
+                                                                    self._results, self._reload, self._workers))
+            process.daemon = True
+            process.start()
+            self._processes.append(process)
+        if len(self._watchers) > 0:
+            # Take results off the workers' queue as soon as they come back, so watchers hear about them
+            self._received = Queue.Queue()
+            thread = threading.Thread(target=self.__receive)
+            thread.setDaemon(True)
+            thread.start()
+
+    def __receive(self):
+        while len(self._processes) > 0:
+            try:
+                result = self._results.get(True, 1.0)
+            except Queue.Empty:
+                continue
+            self._received.put(result)
+            for cond in self._watchers:
+                with cond:
+                    cond.notify_all()
+
+    def stop(self):
+        for _ in self._processes:
+            self._tasks.put(None)
+        for process in self._processes:
+            process.join(1.0)
+            if process.is_alive():
+                process.terminate()
+        self._processes = []
+
+    # Also notify cond (a threading.Condition) whenever a worker returns a result, e.g. so a sharkcv.Scheduler can
+    # wait on its cameras and workers at once (before the first submit())
+    def watch(self, cond):
+        self._watchers.append(cond)
+
+    # Describe a frame's pixels so a worker can find them, copying them into shared memory only if needed
+    # Returns the description and a frame that keeps the pixels alive until the result comes back
+    def __pack(self, frame):
+        ndarray = frame._ndarray
+        buffer = frame._buffer
+        # Already in a pool the workers inherited (e.g. from sharkcv.Capture)
+        if buffer is not None and buffer.pool is not None and buffer.pool.id <= self._outputs.id:
+            return ('shm', buffer.pool.id, buffer.index, ndarray.shape, ndarray.dtype.str), frame.copy()
+        if ndarray.nbytes <= self._inputs.nbytes:
+            # Never wait for one, a frame held longer than expected shouldn't stall the caller
+            index = self._inputs.acquire(0)
+            if index is not None:
+                buffer = self._inputs.buffer(index, ndarray.shape, ndarray.dtype)
+                np.copyto(buffer.ndarray, ndarray)
+                packed = ('shm', self._inputs.id, index, ndarray.shape, ndarray.dtype.str)
+                return packed, sharkcv.Frame(buffer, color=frame.color, timestamp=frame.timestamp)
+        logging.debug('No shared buffer available, pickling frame')
+        return ('pickle', ndarray), frame.copy()
+
+    # Send a frame to the next free worker, to be run by the module of that name
+    def submit(self, frame, name=None):
+        if len(self._processes) == 0:
+            self.__start(frame._ndarray.nbytes)
+        packed, frame = self.__pack(frame)
+        # Without a free output buffer the worker pickles the result instead
+        output = self._outputs.acquire(0)
+        if output is None:
+            logging.debug('No shared buffer available, result will be pickled')
+        self._submitted[self._seq_in] = (frame, output, name)
+        self._tasks.put((self._seq_in, name, packed, output, frame.color, frame.timestamp))
+        self._seq_in += 1
+
+    # Wait for any worker to return a result, or just take the ones already back
+    def __collect(self, block=True):
+        results = self._received if self._received is not None else self._results
+        while True:
+            try:
+                seq, result = results.get(block, 1.0)
+            except Queue.Empty:
+                if not block:
+                    return
+                for process in self._processes:
+                    if not process.is_alive():
+                        raise RuntimeError('Worker process exited')
+                continue
+            if result[0] == 'error':
+                raise RuntimeError(result[1])
+            self._done[seq] = result
+            if block:
+                return
+
+    # Sequence number of the oldest frame submitted (under a name), None if there isn't one
+    def __next(self, name):
+        seqs = [seq for seq, submitted in self._submitted.items() if name is None or submitted[2] == name]
+        return min(seqs) if len(seqs) > 0 else None
+
+    # Number of frames submitted under a name but not yet returned by get()
+    def pending_for(self, name):
+        return len([submitted for submitted in self._submitted.values() if submitted[2] == name])
+
+    # Whether get() would return right away, without waiting on a worker
+    def ready(self, name=None):
+        self.__collect(False)
+        return self.__next(name) in self._done
+
+    # Return the next (input frame, module return) in submission order (of frames submitted under a name), module
+    # returns of (frame, results) come back with results as rows
+    def get(self, name=None):
+        seq = self.__next(name)
+        if seq is None:
+            raise RuntimeError('No frames submitted')
+        while seq not in self._done:
+            self.__collect()
+        result = self._done.pop(seq)
+        frame, output, _ = self._submitted.pop(seq)
+
+        modret = result[1] if result[0] == 'object' else None
+        if result[0] == 'frame':
+            packed, color = result[1], result[2]
+            if packed[0] == 'input':
+                modret = frame.copy()
+            elif packed[0] == 'shm':
+                modret = sharkcv.Frame(self._outputs.buffer(output, packed[3], packed[4]), color=color,
+                                       timestamp=frame.timestamp)
+                output = None
+            else:
+                modret = sharkcv.Frame(packed[1], color=color, timestamp=frame.timestamp)
+            if result[3] is not None:
+                modret = (modret, result[3])
+        if output is not None:
+            self._outputs.release(output)
+        return frame, modret
@@ -0,0 +1,162 @@
+import functools
+import math
+import threading
+import time
+import types
+
+import sharkcv
+
+# Histogram buckets per factor of e of microseconds, so percentiles are within about 2.5%
+_BUCKETS_PER_E = 20
+
+
+# Latency distribution of one stage, in log spaced buckets so recording is constant time and memory
+class _Histogram(object):
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._buckets = {}
+
+    def add(self, seconds):
+        micros = seconds * 1e6
+        bucket = int(math.log(micros) * _BUCKETS_PER_E) if micros > 1 else 0
+        self._buckets[bucket] = self._buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    # Seconds that p percent of samples took at most
+    def percentile(self, p):
+        target = self.count * p / 100.0
+        seen = 0
+        for bucket in sorted(self._buckets.keys()):
+            seen += self._buckets[bucket]
+            if seen >= target:
+                return min(math.exp((bucket + 0.5) / _BUCKETS_PER_E) / 1e6, self.max)
+        return self.max
+
+
+# Time stages of processing (main loop phases, and Frame/ContourSet operations once enabled)
+class Profiler(object):
+    _enabled = False
+    _instrumented = False
+    _stages = {}
+    _lock = threading.Lock()
+
+    # Start recording, and wrap Frame/ContourSet operations so they're timed too
+    @staticmethod
+    def enable():
+        if not Profiler._instrumented:
+            Profiler.__instrument()
+            Profiler._instrumented = True
+        Profiler._enabled = True
+
+    @staticmethod
+    def disable():
+        Profiler._enabled = False
+
+    @staticmethod
+    def enabled():
+        return Profiler._enabled
+
+    @staticmethod
+    def reset():
+        with Profiler._lock:
+            Profiler._stages = {}
+
+    # Record how long a stage took, does nothing unless enabled
+    @staticmethod
+    def record(name, seconds):
+        if not Profiler._enabled:
+            return
+        with Profiler._lock:
+            if name not in Profiler._stages:
+                Profiler._stages[name] = _Histogram()
+            Profiler._stages[name].add(seconds)
+
+    # Time a block of code: with Profiler.stage('name'): ...
+    @staticmethod
+    def stage(name):
+        return _Stage(name)
+
+    # Dict of stage name to count, total, mean, p50, p95, p99 and max (times in milliseconds)
+    @staticmethod
+    def stats():
+        stats = {}
+        with Profiler._lock:
+            for name, histogram in Profiler._stages.items():
+                stats[name] = {
+                    'count': histogram.count,
+                    'total': histogram.total * 1000,
+                    'mean': histogram.total * 1000 / histogram.count,
+                    'p50': histogram.percentile(50) * 1000,
+                    'p95': histogram.percentile(95) * 1000,
+                    'p99': histogram.percentile(99) * 1000,
+                    'max': histogram.max * 1000,
+                }
+        return stats
+
+    # Table of stats, most total time first
+    @staticmethod
+    def report():
+        stats = Profiler.stats()
+        lines = ['%-32s %8s %10s %8s %8s %8s %8s %8s' % ('stage', 'count', 'total ms', 'mean', 'p50', 'p95', 'p99',
+                                                          'max')]
+        for name in sorted(stats.keys(), key=lambda name: -stats[name]['total']):
+            s = stats[name]
+            lines.append('%-32s %8d %10.1f %8.3f %8.3f %8.3f %8.3f %8.3f' % (name, s['count'], s['total'], s['mean'],
+                                                                           s['p50'], s['p95'], s['p99'], s['max']))
+        return '\n'.join(lines)
+
+    # Wrap public Frame methods, the contours/ndarray properties, ContourSet filtering and column computations and
+    # every operation kernel (named after its Frame method, they run inside whatever flushed a lazy frame)
+    @staticmethod
+    def __instrument():
+        for name, member in sharkcv.Frame.__dict__.items():
+            if name.startswith('_'):
+                continue
+            if isinstance(member, types.FunctionType):
+                setattr(sharkcv.Frame, name, _timed(member, 'Frame.' + name))
+            elif isinstance(member, property) and name in ('contours', 'ndarray'):
+                setattr(sharkcv.Frame, name, property(_timed(member.fget, 'Frame.' + name)))
+        for name in ('filter', 'sort', '_bounding_rects', '_centers', '_moments', '_angles', '_aspect_ratios',
+                     '_extents', '_hulls', '_radii'):
+            setattr(sharkcv.ContourSet, name,
+                    _timed(sharkcv.ContourSet.__dict__[name], 'ContourSet.' + name.lstrip('_')))
+        run = sharkcv.frame._run
+
+        def timed_run(src, op, inplace=False):
+            start = time.time()
+            try:
+                return run(src, op, inplace)
+            finally:
+                Profiler.record('op.' + sharkcv.frame._name(op), time.time() - start)
+        sharkcv.frame._run = timed_run
+
+
+def _timed(function, name):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if not Profiler._enabled:
+            return function(*args, **kwargs)
+        start = time.time()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            Profiler.record(name, time.time() - start)
+    return wrapper
+
+
+class _Stage(object):
+    def __init__(self, name):
+        self._name = name
+        self._start = None
+
+    def __enter__(self):
+        self._start = time.time()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        Profiler.record(self._name, time.time() - self._start)
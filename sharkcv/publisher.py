@@ -0,0 +1,254 @@
+import logging
+import numbers
+import socket
+import struct
+import threading
+
+import numpy as np
+
+import sharkcv
+import sharkcv.batch
+
+# Record header: magic, version, flags, frame ID, capture timestamp, base frame ID (deltas), targets, fields
+_HEADER = struct.Struct('<4sBBIdIHB')
+_MAGIC = 'SCVR'
+_VERSION = 1
+_KEYFRAME = 1
+
+# Fields in this order first, the rest sorted
+_FIELDS = ('id',) + sharkcv.batch.CONTOUR_COLUMNS
+
+
+# Fields left out because they had values that aren't numbers, each is only warned about once
+_skipped = set()
+
+
+# Whether a value can be published, None counts as missing
+# NumPy's integers and floats are numbers.Number, its bools (e.g. from comparing ndarrays) aren't
+def _numeric(value):
+    return value is None or isinstance(value, (numbers.Number, np.bool_))
+
+
+# Turn a module's results (anything sharkcv.batch.rows() takes) into field names and a (targets, fields) float32 ndarray
+# Bools become 0/1, None a missing value (NaN), and fields with other values (e.g. string labels) are left out
+def results_table(results):
+    rows = sharkcv.batch.rows(results)
+    names = set()
+    for row in rows:
+        names.update(row.keys())
+    for row in rows:
+        for name, value in row.items():
+            if name in names and not _numeric(value):
+                names.discard(name)
+                if name not in _skipped:
+                    logging.warning('Not publishing result field %s, %s values are not numbers', name,
+                                    type(value).__name__)
+                    _skipped.add(name)
+    fields = [name for name in _FIELDS if name in names] + sorted(names - set(_FIELDS))
+    values = np.array([[row.get(name) if row.get(name) is not None else np.nan for name in fields] for row in rows],
+                      dtype=np.float32)
+    return tuple(fields), values.reshape(len(rows), len(fields))
+
+
+# Pack results into binary records, only sending the values that changed since the last record
+# A keyframe with every value (and the field names) is sent every keyframe records and whenever the targets or fields
+# change, so a receiver that missed a record catches up
+class Encoder(object):
+    def __init__(self, **kwargs):
+        if 'keyframe' not in kwargs:
+            kwargs['keyframe'] = 30
+        self._keyframe = max(kwargs['keyframe'], 1)
+        self._fields = None
+        self._values = None
+        self._frame_id = 0
+        self._since_keyframe = 0
+
+    def encode(self, frame_id, timestamp, fields, values):
+        keyframe = self._values is None or fields != self._fields or values.shape != self._values.shape or \
+            self._since_keyframe + 1 >= self._keyframe
+        parts = []
+        if keyframe:
+            parts.append(_HEADER.pack(_MAGIC, _VERSION, _KEYFRAME, frame_id, timestamp, 0, len(values), len(fields)))
+            for field in fields:
+                parts.append(struct.pack('<B', len(field)) + field)
+            parts.append(values.astype('<f4').tostring())
+            self._since_keyframe = 0
+        else:
+            parts.append(_HEADER.pack(_MAGIC, _VERSION, 0, frame_id, timestamp, self._frame_id, len(values),
+                                      len(fields)))
+            # Per target, a bit per field that changed followed by the changed values
+            changed = (values != self._values) & ~(np.isnan(values) & np.isnan(self._values))
+            masks = np.packbits(changed, axis=1)
+            for i in range(len(values)):
+                parts.append(masks[i].tostring())
+                parts.append(values[i][changed[i]].astype('<f4').tostring())
+            self._since_keyframe += 1
+        self._fields = fields
+        self._values = values.copy()
+        self._frame_id = frame_id
+        return ''.join(parts)
+
+
+# Unpack records from an Encoder, decode() returns (frame ID, timestamp, fields, values) or None for a delta whose
+# base record was missed (until the next keyframe)
+class Decoder(object):
+    def __init__(self):
+        self._fields = None
+        self._values = None
+        self._frame_id = None
+
+    def decode(self, data):
+        magic, version, flags, frame_id, timestamp, base, count, nfields = _HEADER.unpack_from(data)
+        if magic != _MAGIC or version != _VERSION:
+            raise ValueError('Not a SharkCV results record')
+        offset = _HEADER.size
+        if flags & _KEYFRAME:
+            fields = []
+            for _ in range(nfields):
+                length = ord(data[offset])
+                fields.append(data[offset + 1:offset + 1 + length])
+                offset += 1 + length
+            values = np.frombuffer(data, '<f4', count * nfields, offset).reshape(count, nfields).astype(np.float32)
+            self._fields = tuple(fields)
+        else:
+            if base != self._frame_id or self._values is None or self._values.shape != (count, nfields):
+                return None
+            values = self._values.copy()
+            mask_bytes = (nfields + 7) // 8
+            for i in range(count):
+                changed = np.unpackbits(np.frombuffer(data, np.uint8, mask_bytes, offset))[:nfields].astype(bool)
+                offset += mask_bytes
+                n = int(changed.sum())
+                values[i][changed] = np.frombuffer(data, '<f4', n, offset)
+                offset += 4 * n
+        self._values = values
+        self._frame_id = frame_id
+        return frame_id, timestamp, self._fields, values
+
+
+# Send records as UDP datagrams, e.g. to the robot or a local stand-in
+class UDPBackend(object):
+    def __init__(self, host='127.0.0.1', port=5801, **kwargs):
+        self._address = (host, port)
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._encoder = Encoder(**kwargs)
+
+    def send(self, frame_id, timestamp, fields, values):
+        self._socket.sendto(self._encoder.encode(frame_id, timestamp, fields, values), self._address)
+
+    def close(self):
+        self._socket.close()
+
+
+# Put results in a NetworkTable like GRIP's ContoursReport, one number array per field (only fields that changed are
+# put) plus frame and timestamp numbers
+# table is a NetworkTable or the name of one, connecting to address if given
+class NetworkTablesBackend(object):
+    def __init__(self, table, address=None):
+        if isinstance(table, basestring):
+            from networktables import NetworkTable
+            if address is not None:
+                try:
+                    NetworkTable.setIPAddress(address)
+                    NetworkTable.setClientMode()
+                    NetworkTable.initialize()
+                except Exception, e:
+                    # Already initialized, e.g. by the module
+                    logging.debug('NetworkTables not initialized: %s', str(e))
+            table = NetworkTable.getTable(table)
+        self._table = table
+        self._columns = {}
+
+    def send(self, frame_id, timestamp, fields, values):
+        # Fields that went away are emptied rather than left stale
+        for field in set(self._columns.keys()) - set(fields):
+            self.__put(field, [])
+            del self._columns[field]
+        for i, field in enumerate(fields):
+            column = values[:, i].tolist()
+            if self._columns.get(field) != column:
+                self.__put(field, column)
+                self._columns[field] = column
+        self._table.putNumber('frame', frame_id)
+        self._table.putNumber('timestamp', timestamp)
+
+    def __put(self, key, values):
+        if hasattr(self._table, 'putNumberArray'):
+            self._table.putNumberArray(key, values)
+        else:
+            self._table.putValue(key, values)
+
+    def close(self):
+        pass
+
+
+# Publish module results to backends on a background thread, only ever the newest results
+class Publisher(object):
+    def __init__(self, backends):
+        self._backends = list(backends)
+        self._cond = threading.Condition()
+        self._latest = None
+        self._thread = None
+        self._running = False
+        self._published = 0
+        self._skipped = 0
+        self._errors = 0
+
+    # Number of results sent
+    @property
+    def published(self):
+        return self._published
+
+    # Number of results replaced by newer ones before they were sent
+    @property
+    def skipped(self):
+        return self._skipped
+
+    @property
+    def errors(self):
+        return self._errors
+
+    def start(self):
+        if self._thread is None:
+            self._running = True
+            self._thread = threading.Thread(target=self.__run)
+            self._thread.setDaemon(True)
+            self._thread.start()
+
+    # Send the newest results if they haven't been, then stop the thread
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(1.0)
+            self._thread = None
+        for backend in self._backends:
+            backend.close()
+
+    # Hand over a frame's results (anything sharkcv.batch.rows() takes), packed on the calling thread
+    def publish(self, results, frame_id, timestamp):
+        fields, values = results_table(results)
+        with self._cond:
+            if self._latest is not None:
+                self._skipped += 1
+            self._latest = (frame_id, timestamp, fields, values)
+            self._cond.notify_all()
+
+    def __run(self):
+        while True:
+            with self._cond:
+                while self._running and self._latest is None:
+                    self._cond.wait()
+                if self._latest is None:
+                    break
+                latest = self._latest
+                self._latest = None
+            for backend in self._backends:
+                try:
+                    backend.send(*latest)
+                except Exception, e:
+                    if self._errors == 0:
+                        logging.warning('Failed to publish results: %s', str(e))
+                    self._errors += 1
+            self._published += 1
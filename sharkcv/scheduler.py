@@ -0,0 +1,213 @@
+import ConfigParser
+import threading
+import time
+
+import sharkcv
+
+# Camera options that are numbers, the rest are strings
+_INTEGERS = ('priority', 'width', 'height')
+_FLOATS = ('fps', 'brightness', 'contrast', 'exposure', 'gain', 'hue', 'saturation')
+
+
+# Read [camera name] sections from a registry file (see sharkcv.module.registry()), e.g.
+#   [camera goal]
+#   input = 0
+#   module = goal
+#   priority = 1
+#   fps = 30
+# input is a webcam number, video file or MJPG stream URL, module an entry point or registry name (none just streams
+# the camera), and width, height and webcam brightness, contrast, exposure, gain, hue and saturation set the camera up
+# Returns a dict of camera name to options
+def cameras(filename):
+    config = ConfigParser.RawConfigParser()
+    config.optionxform = str
+    if len(config.read(filename)) == 0:
+        raise IOError('Failed to read camera registry: %s' % filename)
+    cameras = {}
+    for section in config.sections():
+        if not section.startswith('camera '):
+            continue
+        options = {}
+        for key, value in config.items(section):
+            if key in _INTEGERS:
+                value = int(value)
+            elif key in _FLOATS:
+                value = float(value)
+            elif key == 'input' and value.lstrip('-').isdigit():
+                value = int(value)
+            options[key] = value
+        if 'input' not in options:
+            raise ValueError('No input for %s' % section)
+        cameras[section.split(None, 1)[1].strip()] = options
+    return cameras
+
+
+# One of several named inputs, with its own sharkcv.Capture thread and module (None just passes its frames through)
+class Camera(object):
+    def __init__(self, name, capture, **kwargs):
+        # Module entry point (see sharkcv.module.load())
+        if 'module' not in kwargs:
+            kwargs['module'] = None
+        # Higher priority cameras get their frames processed first
+        if 'priority' not in kwargs:
+            kwargs['priority'] = 0
+        # Most frames to process a second (default: all of them)
+        if 'fps' not in kwargs:
+            kwargs['fps'] = None
+        self._name = name
+        self._capture = capture
+        self._module = kwargs['module']
+        self._priority = kwargs['priority']
+        self._fps = kwargs['fps']
+        self._interval = 1.0 / kwargs['fps'] if kwargs['fps'] else 0.0
+        # Earliest time the next frame fits in the FPS budget, and when the last frame was taken
+        self._next = 0.0
+        self._taken = 0.0
+        self._frames = 0
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def capture(self):
+        return self._capture
+
+    @property
+    def module(self):
+        return self._module
+
+    @property
+    def priority(self):
+        return self._priority
+
+    @property
+    def fps(self):
+        return self._fps
+
+    # Number of frames processed
+    @property
+    def frames(self):
+        return self._frames
+
+
+# Process frames from several cameras on one set of module workers (or the calling thread), sharing them out by
+# priority and FPS budget: the next frame is always the newest one of the highest priority camera that is within its
+# budget (the one that waited longest, between equals), so lower priority cameras get what's left
+class Scheduler(object):
+    def __init__(self, cameras, **kwargs):
+        # Worker processes shared by every camera's module (default: 0, run modules on the calling thread)
+        if 'workers' not in kwargs:
+            kwargs['workers'] = 0
+        # Reload modules when their files change (see sharkcv.module.Reloader)
+        if 'reload' not in kwargs:
+            kwargs['reload'] = False
+        # Frames the caller keeps after next() (see sharkcv.Pool)
+        if 'hold' not in kwargs:
+            kwargs['hold'] = 0
+        self._cameras = sorted(cameras, key=lambda camera: -camera.priority)
+        self._pool = None
+        self._modules = {}
+        # Notified by the captures when they have a frame and by the pool when it has a result
+        self._cond = threading.Condition()
+        for camera in self._cameras:
+            camera.capture.watch(self._cond)
+        modfiles = dict((camera.name, camera.module) for camera in cameras if camera.module is not None)
+        if kwargs['workers'] > 0 and len(modfiles) > 0:
+            self._pool = sharkcv.Pool(modfiles, kwargs['workers'], reload=kwargs['reload'], hold=kwargs['hold'])
+            self._pool.watch(self._cond)
+        else:
+            for name, modfile in modfiles.items():
+                if kwargs['reload']:
+                    self._modules[name] = sharkcv.module.Reloader(modfile)
+                else:
+                    self._modules[name] = sharkcv.module.load(modfile)
+
+    @property
+    def cameras(self):
+        return list(self._cameras)
+
+    # Whether every camera's input has ended and every frame has been returned
+    @property
+    def done(self):
+        for camera in self._cameras:
+            if camera.capture.running or camera.capture.ready > 0:
+                return False
+        return self._pool is None or self._pool.pending == 0
+
+    def start(self):
+        for camera in self._cameras:
+            camera.capture.start()
+
+    def stop(self):
+        if self._pool is not None:
+            self._pool.stop()
+        for camera in self._cameras:
+            camera.capture.stop()
+
+    # The camera whose frame goes next, None if none has a frame within its budget
+    # Cameras with a module only count when there's a worker free for them
+    def __due(self, now, free=True):
+        due = None
+        for camera in self._cameras:
+            if camera.capture.ready == 0 or now < camera._next or (camera.module is not None and not free):
+                continue
+            if due is None:
+                due = camera
+            elif camera.priority < due.priority:
+                break
+            elif camera._taken < due._taken:
+                due = camera
+        return due
+
+    def __take(self, camera, now):
+        # Frames may come a little late, one interval of slack keeps the average rate at the budget
+        camera._next = max(camera._next, now - camera._interval) + camera._interval
+        camera._taken = now
+        return camera.capture.read()
+
+    # Seconds until the first camera with a frame waiting is back within its budget or the deadline, whichever is
+    # sooner, None if there's neither
+    def __wait(self, now, deadline):
+        wake = [camera._next for camera in self._cameras if camera.capture.ready > 0 and camera._next > now]
+        if deadline is not None:
+            wake.append(deadline)
+        return max(min(wake) - now, 0.0) if len(wake) > 0 else None
+
+    # Return (camera, input frame, module return) of the next processed frame, None if there isn't one within timeout
+    # seconds or every input has ended
+    def next(self, timeout=None):
+        deadline = time.time() + timeout if timeout is not None else None
+        while True:
+            with self._cond:
+                now = time.time()
+                if self._pool is not None:
+                    # Keep every worker busy
+                    camera = self.__due(now, self._pool.pending < self._pool.workers)
+                    while camera is not None:
+                        frame = self.__take(camera, now)
+                        if camera.module is None:
+                            camera._frames += 1
+                            return camera, frame, frame
+                        self._pool.submit(frame, camera.name)
+                        camera = self.__due(now, self._pool.pending < self._pool.workers)
+                    # Hand back results, highest priority first
+                    for camera in self._cameras:
+                        if camera.module is not None and self._pool.pending_for(camera.name) > 0 and \
+                                self._pool.ready(camera.name):
+                            frame, modret = self._pool.get(camera.name)
+                            camera._frames += 1
+                            return camera, frame, modret
+                else:
+                    camera = self.__due(now)
+                    if camera is not None:
+                        frame = self.__take(camera, now)
+                        break
+                if (deadline is not None and now >= deadline) or self.done:
+                    return None
+                # Checked and waited on under the lock, so a frame or result that comes in between isn't missed
+                self._cond.wait(self.__wait(now, deadline))
+        # Outside of the lock, so captures aren't held up by the module
+        modret = self._modules[camera.name](frame) if camera.module is not None else frame
+        camera._frames += 1
+        return camera, frame, modret
@@ -0,0 +1,403 @@
+import errno
+import logging
+import os
+import select
+import socket
+import threading
+import time
+import urlparse
+
+import cv2
+
+import sharkcv
+
+BOUNDARY = '--jpgboundary'
+
+# Stream served at /stream.mjpg (and any other .mjpg path that isn't a stream's name)
+DEFAULT_STREAM = 'stream'
+
+# Automatic quality moves in steps so clients share as many encoded variants as possible
+AUTO_QUALITY_STEP = 10
+AUTO_QUALITY_MIN = 20
+AUTO_QUALITY_START = 80
+# Frames a client has to keep up with before automatic quality goes back up
+AUTO_QUALITY_FRAMES = 30
+
+
+# One connected HTTP client
+class _Client(object):
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        self.request = ''
+        self.streaming = False
+        self.close_after_send = False
+        # Buffers waiting to be sent and how far into the first one we are
+        self.pending = []
+        self.offset = 0
+        # Stream the client asked for and the sequence number of the last frame queued from it
+        self.stream = None
+        self.seq = 0
+        self.behind = False
+        self.kept_up = 0
+        # Stream options from the query string
+        self.quality = None
+        self.max_quality = None
+        self.width = None
+        self.height = None
+        self.interval = 0
+        self.auto = False
+        self.next_time = 0
+
+    # Parse /stream.mjpg?q=40&w=160&h=120&fps=10&auto=1
+    def options(self, query):
+        query = urlparse.parse_qs(query)
+
+        def number(key, low, high):
+            try:
+                return min(max(int(float(query[key][0])), low), high)
+            except (KeyError, ValueError):
+                return None
+
+        self.quality = number('q', 1, 100)
+        self.width = number('w', 1, 10000)
+        self.height = number('h', 1, 10000)
+        fps = number('fps', 1, 1000)
+        self.interval = 1.0 / fps if fps is not None else 0
+        self.auto = query.get('auto', ['0'])[0] not in ('0', '')
+        if self.auto:
+            self.max_quality = self.quality if self.quality is not None else 100
+            self.quality = min(AUTO_QUALITY_START, self.max_quality)
+
+    # Lower quality when the client couldn't finish the last frame before a new one, raise it when it keeps up
+    def adapt(self):
+        if not self.auto:
+            return
+        if self.behind:
+            self.quality = max(self.quality - AUTO_QUALITY_STEP, min(AUTO_QUALITY_MIN, self.max_quality))
+            self.kept_up = 0
+        else:
+            self.kept_up += 1
+            if self.kept_up >= AUTO_QUALITY_FRAMES:
+                self.quality = min(self.quality + AUTO_QUALITY_STEP, self.max_quality)
+                self.kept_up = 0
+        self.behind = False
+
+    def queue(self, data):
+        self.pending.append(data)
+
+    # Send as much as the socket will take without blocking, returns False when the client is gone
+    def send(self):
+        while len(self.pending) > 0:
+            try:
+                sent = self.sock.send(memoryview(self.pending[0])[self.offset:])
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return True
+                return False
+            self.offset += sent
+            if self.offset < len(self.pending[0]):
+                return True
+            self.pending.pop(0)
+            self.offset = 0
+        return not self.close_after_send
+
+
+# Newest frame published under one name and its encoded JPEG variants
+class _Stream(object):
+    def __init__(self):
+        self.frame = None
+        self.stale = False
+        self.seq = 0
+        self.jpegs = {}
+        self.jpegs_seq = 0
+
+
+# Single-threaded MJPG HTTP server
+# Each published frame is encoded at most once per (quality, size) variant, clients are woken when a new frame shows
+# up and slow clients skip straight to the newest frame instead of queueing old ones
+# Several streams can be served at once, each at /name.mjpg
+class StreamServer(object):
+    def __init__(self, port, **kwargs):
+        if 'title' not in kwargs:
+            kwargs['title'] = 'SharkCV'
+        # JPEG options for sharkcv.JPEGEncoder (subsampling, fast, backend)
+        if 'jpeg' not in kwargs:
+            kwargs['jpeg'] = {}
+        # Names of the streams, the first one is also served at /stream.mjpg
+        if 'streams' not in kwargs:
+            kwargs['streams'] = [DEFAULT_STREAM]
+        self._port = port
+        self._title = kwargs['title']
+        self._encoder = sharkcv.JPEGEncoder(**kwargs['jpeg'])
+        self._listener = None
+        self._clients = {}
+        self._lock = threading.Lock()
+        self._names = list(kwargs['streams'])
+        self._streams = dict((name, _Stream()) for name in self._names)
+        self._wake_r, self._wake_w = None, None
+        self._thread = None
+        self._running = False
+
+    @property
+    def encoder(self):
+        return self._encoder
+
+    @property
+    def clients(self):
+        return len([client for client in self._clients.values() if client.streaming])
+
+    @property
+    def streams(self):
+        return list(self._names)
+
+    def start(self):
+        self._listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._listener.bind(('', self._port))
+        self._listener.listen(5)
+        self._listener.setblocking(0)
+        # The server thread's select() also watches this pipe, so publish() can wake it up
+        self._wake_r, self._wake_w = os.pipe()
+        self._running = True
+        self._thread = threading.Thread(target=self.__run)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        self.__wake()
+        if self._thread is not None:
+            self._thread.join(1.0)
+            self._thread = None
+        for client in self._clients.values():
+            self.__close(client)
+        if self._listener is not None:
+            self._listener.close()
+            self._listener = None
+        if self._wake_r is not None:
+            for fd in (self._wake_r, self._wake_w):
+                try:
+                    os.close(fd)
+                except OSError:
+                    pass
+            self._wake_r, self._wake_w = None, None
+
+    # Hand a new frame to the server, it's encoded on the server thread only if a client wants it
+    def publish(self, frame, name=None):
+        stream = self._streams[name or self._names[0]]
+        # Convert and run pending operations on our copy now, the server thread only ever reads stream.frame
+        frame = frame.copy()
+        frame.color_bgr()
+        frame._ndarray
+        with self._lock:
+            stream.frame = frame
+            stream.stale = False
+            stream.seq += 1
+        self.__wake()
+
+    # Send the newest frame again with a red border and STALE on it, e.g. while the camera is reconnecting
+    def publish_stale(self, name=None):
+        stream = self._streams[name or self._names[0]]
+        with self._lock:
+            frame = stream.frame
+            stale = stream.stale
+        if frame is None:
+            return
+        if not stale:
+            frame = frame.copy()
+            frame.color_bgr()
+            ndarray = frame.ndarray
+            cv2.rectangle(ndarray, (0, 0), (frame.width - 1, frame.height - 1), (0, 0, 255), 4)
+            cv2.putText(ndarray, 'STALE', (8, 24), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 0, 255), 2)
+        with self._lock:
+            stream.frame = frame
+            stream.stale = True
+            stream.seq += 1
+        self.__wake()
+
+    def __wake(self):
+        if self._wake_w is None:
+            return
+        try:
+            os.write(self._wake_w, 'x')
+        except OSError:
+            pass
+
+    # Return the sequence number and JPEG of the newest frame for a client, encoding it if no client with the same
+    # options has yet
+    def __jpeg(self, client):
+        stream = self._streams[client.stream]
+        with self._lock:
+            frame = stream.frame
+            seq = stream.seq
+        if frame is None:
+            return seq, None
+        if stream.jpegs_seq != seq:
+            stream.jpegs = {}
+            stream.jpegs_seq = seq
+
+        # Fill in a missing width/height from the frame's aspect ratio
+        width, height = client.width, client.height
+        if width is not None and height is None:
+            height = int(round(width * frame.height / float(frame.width)))
+        if height is not None and width is None:
+            width = int(round(height * frame.width / float(frame.height)))
+        if width == frame.width and height == frame.height:
+            width, height = None, None
+
+        variant = (client.quality, width, height)
+        if variant not in stream.jpegs:
+            start = time.time()
+            if width is not None:
+                # A copy() would change stream.frame's sharing state, resize a frame of its own over the same pixels
+                resized = sharkcv.Frame(frame._ndarray, lazy=False)
+                resized.resize(width, height)
+                stream.jpegs[variant] = resized.jpeg(client.quality, self._encoder)
+            else:
+                stream.jpegs[variant] = frame.jpeg(client.quality, self._encoder)
+            sharkcv.Profiler.record('encode', time.time() - start)
+        return seq, stream.jpegs[variant]
+
+    def __close(self, client):
+        logging.debug('MJPG client disconnected: %s', client.address[0])
+        self._clients.pop(client.sock, None)
+        try:
+            client.sock.close()
+        except socket.error:
+            pass
+
+    def __accept(self):
+        try:
+            sock, address = self._listener.accept()
+        except socket.error:
+            return
+        sock.setblocking(0)
+        self._clients[sock] = _Client(sock, address)
+
+    # Read from a client, returns False when it hung up
+    def __read(self, client):
+        try:
+            data = client.sock.recv(4096)
+        except socket.error, e:
+            return e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK)
+        if len(data) == 0:
+            return False
+        # Streaming clients have nothing more to say
+        if client.streaming or client.close_after_send:
+            return True
+        client.request += data
+        if '\r\n\r\n' in client.request:
+            self.__respond(client)
+        elif len(client.request) > 8192:
+            return False
+        return True
+
+    def __respond(self, client):
+        path = client.request.split('\r\n', 1)[0].split(' ')
+        path = path[1] if len(path) > 1 else '/'
+        logging.debug('GET: %s', path)
+        client.request = ''
+
+        # Serve HTML page of every stream
+        if path == '/':
+            width = 100 // len(self._names)
+            body = '<html><head><title>' + self._title + '</title></head><body>' + \
+                   ''.join('<img src="/%s.mjpg" style="width:%d%%;"/>' % (name, width) for name in self._names) + \
+                   '</body></html>'
+            client.queue('HTTP/1.0 200 OK\r\nContent-type: text/html\r\nContent-length: %d\r\n\r\n' % len(body) + body)
+            client.close_after_send = True
+
+        # Serve MJPG stream
+        elif urlparse.urlsplit(path).path.endswith('.mjpg'):
+            logging.debug('MJPG client connected: %s', client.address[0])
+            client.options(urlparse.urlsplit(path).query)
+            name = os.path.splitext(os.path.basename(urlparse.urlsplit(path).path))[0]
+            client.stream = name if name in self._streams else self._names[0]
+            client.queue('HTTP/1.0 200 OK\r\nCache-Control: no-cache\r\nConnection: close\r\n' +
+                         'Content-type: multipart/x-mixed-replace; boundary=' + BOUNDARY + '\r\n\r\n')
+            client.streaming = True
+            client.seq = 0
+
+        # Serve stage timings (see sharkcv.Profiler)
+        elif urlparse.urlsplit(path).path == '/stats':
+            # Only imported once stats are asked for
+            import json
+            streams = {}
+            for name, stream in self._streams.items():
+                clients = [other for other in self._clients.values() if other.streaming and other.stream == name]
+                streams[name] = {'stale': stream.stale, 'clients': len(clients)}
+            body = json.dumps({'profiling': sharkcv.Profiler.enabled(), 'clients': self.clients,
+                               'stale': any(stream.stale for stream in self._streams.values()), 'streams': streams,
+                               'stages': sharkcv.Profiler.stats()})
+            client.queue('HTTP/1.0 200 OK\r\nCache-Control: no-cache\r\nContent-type: application/json\r\n' +
+                         'Content-length: %d\r\n\r\n' % len(body) + body)
+            client.close_after_send = True
+
+        else:
+            client.queue('HTTP/1.0 404 Not Found\r\nContent-length: 0\r\n\r\n')
+            client.close_after_send = True
+
+    def __run(self):
+        while self._running:
+            # Give idle streaming clients the newest frame of their stream
+            now = time.time()
+            timeout = 1.0
+            for client in self._clients.values():
+                if not client.streaming or client.seq == self._streams[client.stream].seq:
+                    continue
+                if len(client.pending) > 0:
+                    client.behind = True
+                    continue
+                if now < client.next_time:
+                    timeout = min(timeout, client.next_time - now)
+                    continue
+                # A frame that fails to encode only costs its clients, not the server thread
+                try:
+                    client.adapt()
+                    client.seq, jpeg = self.__jpeg(client)
+                except Exception, e:
+                    logging.error('MJPG stream to %s failed: %s', client.address[0], str(e))
+                    self.__close(client)
+                    continue
+                if jpeg is None:
+                    continue
+                client.queue(BOUNDARY + '\r\nContent-type: image/jpeg\r\nContent-length: %d\r\n\r\n' % len(jpeg))
+                client.queue(jpeg)
+                client.queue('\r\n')
+                client.next_time = now + client.interval
+
+            rlist = [self._listener, self._wake_r] + [client.sock for client in self._clients.values()]
+            wlist = [client.sock for client in self._clients.values() if len(client.pending) > 0]
+            try:
+                readable, writable, _ = select.select(rlist, wlist, [], timeout)
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            for sock in readable:
+                if sock is self._listener:
+                    self.__accept()
+                elif sock == self._wake_r:
+                    os.read(self._wake_r, 4096)
+                elif sock in self._clients:
+                    client = self._clients[sock]
+                    try:
+                        ok = self.__read(client)
+                    except Exception, e:
+                        logging.error('MJPG request from %s failed: %s', client.address[0], str(e))
+                        ok = False
+                    if not ok:
+                        self.__close(client)
+
+            for sock in writable:
+                if sock in self._clients:
+                    client = self._clients[sock]
+                    try:
+                        ok = client.send()
+                    except Exception, e:
+                        logging.error('MJPG send to %s failed: %s', client.address[0], str(e))
+                        ok = False
+                    if not ok:
+                        self.__close(client)
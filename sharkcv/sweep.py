@@ -0,0 +1,193 @@
+import itertools
+import logging
+import signal
+import time
+
+import numpy as np
+
+import sharkcv
+
+# Pipeline steps and score function loaded in each worker process, or the error loading them
+_steps = None
+_score = None
+_error = None
+
+
+# Values to try for one argument of a pipeline step
+class Grid(object):
+    def __init__(self, *values):
+        if len(values) == 0:
+            raise ValueError('Grid needs at least one value')
+        self._values = values
+
+    @property
+    def values(self):
+        return self._values
+
+    def __repr__(self):
+        return 'Grid' + repr(self._values)
+
+
+# Every concrete way to call a step ('method', arg, ..., {'kwarg': value}), trying every combination of its Grid
+# arguments. Returns the method name and a list of (args, kwargs, [(column, value) of the Grid arguments])
+def _bindings(step, label):
+    name = step[0]
+    args = list(step[1:])
+    kwargs = {}
+    if len(args) > 0 and isinstance(args[-1], dict):
+        kwargs = dict(args.pop())
+    slots = [(i, arg) for i, arg in enumerate(args) if isinstance(arg, Grid)] + \
+            [(key, kwargs[key]) for key in sorted(kwargs.keys()) if isinstance(kwargs[key], Grid)]
+    bindings = []
+    for values in itertools.product(*[grid.values for _, grid in slots]):
+        bound_args = list(args)
+        bound_kwargs = dict(kwargs)
+        columns = []
+        for (slot, _), value in zip(slots, values):
+            if isinstance(slot, int):
+                bound_args[slot] = value
+            else:
+                bound_kwargs[slot] = value
+            columns.append(('%s.%s' % (label, slot), value))
+        bindings.append((bound_args, bound_kwargs, columns))
+    return name, bindings
+
+
+# Bindings of every step of a pipeline, steps are labelled by method name (and number when it's used more than once)
+def steps(pipeline):
+    names = [step[0] for step in pipeline]
+    steps = []
+    for i, step in enumerate(pipeline):
+        label = step[0]
+        if names.count(label) > 1:
+            label += str(names[:i + 1].count(label))
+        steps.append(_bindings(step, label))
+    return steps
+
+
+# Dict of Grid argument column to value for every combination, in the order scores are kept
+def combinations(steps):
+    combinations = []
+    for chosen in itertools.product(*[bindings for _, bindings in steps]):
+        combination = {}
+        for _, _, columns in chosen:
+            combination.update(columns)
+        combinations.append(combination)
+    return combinations
+
+
+# Run the steps from i on on a frame, scoring every combination below it into scores
+# Each step runs once per distinct prefix: a frame is copied (copy-on-write) for each binding of a step with more than
+# one, so the steps before it are shared by all of them
+def _evaluate(frame, steps, i, index, strides, scores, source):
+    if i == len(steps):
+        try:
+            scores[index] = _score(frame, source)
+        except Exception, e:
+            logging.debug('Score failed on %s: %s', source, str(e))
+        return
+    name, bindings = steps[i]
+    # Find contours before copying so every copy shares them
+    if len(bindings) > 1 and name.startswith('contours'):
+        frame.contours
+    for b, (args, kwargs, _) in enumerate(bindings):
+        current = frame.copy() if len(bindings) > 1 else frame
+        try:
+            ret = getattr(current, name)(*args, **kwargs)
+        except Exception, e:
+            logging.debug('%s%s failed on %s: %s', name, tuple(args), source, str(e))
+            continue
+        # Operations like threshold() return a new frame, the rest change the frame
+        if isinstance(ret, sharkcv.Frame):
+            current = ret
+        _evaluate(current, steps, i + 1, index + b * strides[i], strides, scores, source)
+
+
+def _initialize(specfile):
+    global _steps, _score, _error
+    # Let the parent process handle Ctrl-C
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # Prefixes are only shared if they actually run
+    sharkcv.Frame.lazy = False
+    try:
+        spec = sharkcv.module.load_module(specfile)
+        _steps = steps(spec.pipeline)
+        _score = spec.score
+    except Exception, e:
+        _error = 'Import failed: ' + str(e)
+
+
+# Worker process: score every combination on every frame of a task, returns (frames, score sums, score counts)
+def _run(task):
+    if _error is not None:
+        return 'error', _error
+    sizes = [len(bindings) for _, bindings in _steps]
+    strides = [int(np.prod(sizes[i + 1:])) for i in range(len(sizes))]
+    sums = np.zeros(int(np.prod(sizes)))
+    counts = np.zeros(len(sums), dtype=np.int64)
+    count = 0
+    for source, index, seconds, ndarray in sharkcv.batch.frames(task):
+        if ndarray is None:
+            continue
+        scores = np.full(len(sums), np.nan)
+        _evaluate(sharkcv.Frame(ndarray, timestamp=seconds), _steps, 0, 0, strides, scores, source)
+        scored = ~np.isnan(scores)
+        sums[scored] += scores[scored]
+        counts += scored
+        count += 1
+    return 'ok', (count, sums, counts)
+
+
+# Score every combination of Grid arguments of a sweep file's pipeline over directories, globs, images and videos on
+# a pool of worker processes
+# The sweep file has a pipeline, a list of Frame method steps ('method', arg, ..., {'kwarg': value}) where any argument
+# can be a Grid of values to try, and score(frame, source) returning how good the final frame is (higher is better)
+# Returns dicts of rank, mean score and the Grid arguments, best first
+def run(specfile, paths, **kwargs):
+    # Only imported for sweeps
+    import multiprocessing
+
+    # Worker processes (default: one per core)
+    if 'workers' not in kwargs or kwargs['workers'] <= 0:
+        kwargs['workers'] = multiprocessing.cpu_count()
+    # Frames per video segment
+    if 'chunk' not in kwargs:
+        kwargs['chunk'] = 300
+    spec = sharkcv.module.load_module(specfile)
+    combos = combinations(steps(spec.pipeline))
+    images, videos = sharkcv.batch.files(paths)
+    work = sharkcv.batch.tasks(images, videos, kwargs['chunk'], kwargs['workers'])
+    logging.info('Sweeping %d combinations over %d images and %d videos in %d tasks on %d workers', len(combos),
+                 len(images), len(videos), len(work), kwargs['workers'])
+
+    pool = multiprocessing.Pool(kwargs['workers'], _initialize, (specfile,))
+    sums = np.zeros(len(combos))
+    counts = np.zeros(len(combos), dtype=np.int64)
+    count = 0
+    start = time.time()
+    try:
+        for done, (status, result) in enumerate(pool.imap_unordered(_run, work, 1)):
+            if status == 'error':
+                raise RuntimeError(result)
+            count += result[0]
+            sums += result[1]
+            counts += result[2]
+            logging.debug('Finished %d/%d tasks, %d frames', done + 1, len(work), count)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    seconds = time.time() - start
+    logging.info('Scored %d combinations on %d frames in %.1f s (%.0f combinations/s)', len(combos), count, seconds,
+                 len(combos) * count / seconds if seconds > 0 else 0)
+
+    # Combinations that failed on every frame go last
+    means = np.where(counts > 0, sums / np.maximum(counts, 1), -np.inf)
+    ranking = []
+    for rank, i in enumerate(np.argsort(-means, kind='mergesort')):
+        row = dict(combos[i])
+        row.update({'rank': rank + 1, 'score': float(means[i]), 'frames': int(counts[i])})
+        ranking.append(row)
+    return ranking
@@ -0,0 +1,183 @@
+import itertools
+
+import numpy as np
+
+import sharkcv
+
+
+# A target followed across frames
+class Track(object):
+    def __init__(self, id, contour):
+        self._id = id
+        self._contour = contour
+        self._x = contour.center_x
+        self._y = contour.center_y
+        # Pixels moved per frame
+        self._velocity_x = 0.0
+        self._velocity_y = 0.0
+        self._hits = 1
+        self._misses = 0
+
+    # Same for as long as the target is tracked, so results can be published under it
+    @property
+    def id(self):
+        return self._id
+
+    # Latest sharkcv.Contour of the target
+    @property
+    def contour(self):
+        return self._contour
+
+    @property
+    def x(self):
+        return self._x
+
+    @property
+    def y(self):
+        return self._y
+
+    @property
+    def velocity_x(self):
+        return self._velocity_x
+
+    @property
+    def velocity_y(self):
+        return self._velocity_y
+
+    # Where the target should be in the next frame (constant velocity)
+    @property
+    def predicted_x(self):
+        return self._x + self._velocity_x * (self._misses + 1)
+
+    @property
+    def predicted_y(self):
+        return self._y + self._velocity_y * (self._misses + 1)
+
+    # Number of frames the target was found in
+    @property
+    def hits(self):
+        return self._hits
+
+    # Number of frames in a row the target wasn't found in
+    @property
+    def misses(self):
+        return self._misses
+
+    def _hit(self, contour, smoothing):
+        frames = self._misses + 1
+        velocity_x = (contour.center_x - self._x) / frames
+        velocity_y = (contour.center_y - self._y) / frames
+        if self._hits == 1:
+            self._velocity_x, self._velocity_y = velocity_x, velocity_y
+        else:
+            self._velocity_x += (velocity_x - self._velocity_x) * smoothing
+            self._velocity_y += (velocity_y - self._velocity_y) * smoothing
+        self._contour = contour
+        self._x = contour.center_x
+        self._y = contour.center_y
+        self._hits += 1
+        self._misses = 0
+
+    def _miss(self):
+        self._misses += 1
+
+
+# Follow targets across frames, only searching around where they're predicted to be
+class Tracker(object):
+    def __init__(self, **kwargs):
+        # Furthest (in pixels) a target can be from its prediction and still match
+        if 'distance' not in kwargs:
+            kwargs['distance'] = 50
+        # Frames a target can go unseen before its track is dropped
+        if 'misses' not in kwargs:
+            kwargs['misses'] = 5
+        # Search the full frame every this many frames, to find new targets
+        if 'reacquire' not in kwargs:
+            kwargs['reacquire'] = 30
+        # Search window around a prediction, in target sizes and extra pixels
+        if 'window' not in kwargs:
+            kwargs['window'] = 1.0
+        if 'padding' not in kwargs:
+            kwargs['padding'] = 16
+        # How much a new velocity measurement moves the estimate, in [0,1]
+        if 'smoothing' not in kwargs:
+            kwargs['smoothing'] = 0.5
+        self._options = kwargs
+        self._ids = itertools.count(1)
+        self._tracks = []
+        self._frames = 0
+        self._full = True
+
+    @property
+    def tracks(self):
+        return self._tracks
+
+    # Whether the last update() searched the full frame
+    @property
+    def full(self):
+        return self._full
+
+    # Search windows (x, y, width, height) for the next frame, or None to search the full frame
+    def windows(self):
+        if len(self._tracks) == 0 or self._frames % self._options['reacquire'] == 0 or \
+                any(track.misses > 0 for track in self._tracks):
+            return None
+        windows = []
+        for track in self._tracks:
+            contour = track.contour
+            half_width = contour.width * self._options['window'] + abs(track.velocity_x) + self._options['padding']
+            half_height = contour.height * self._options['window'] + abs(track.velocity_y) + self._options['padding']
+            windows.append((int(track.predicted_x - half_width), int(track.predicted_y - half_height),
+                            int(2 * half_width), int(2 * half_height)))
+        return windows
+
+    # Find targets in a frame and update tracks with them
+    # detect(frame) returns a sharkcv.ContourSet, and is given either a copy of the full frame or roi() windows of it
+    def update(self, frame, detect):
+        windows = self.windows()
+        self._full = windows is None
+        if self._full:
+            contours = detect(frame.copy())
+        else:
+            ndarrays = []
+            seen = set()
+            for window in windows:
+                for contour in detect(frame.roi(*window)):
+                    # Windows can overlap and find the same contour
+                    key = (contour.x, contour.y, contour.width, contour.height)
+                    if key not in seen:
+                        seen.add(key)
+                        ndarrays.append(contour.ndarray)
+            contours = sharkcv.ContourSet(ndarrays)
+        self._frames += 1
+        self.__associate(contours)
+        return self._tracks
+
+    # Match contours to tracks, closest to predictions first
+    def __associate(self, contours):
+        matched = set()
+        if len(self._tracks) > 0 and len(contours) > 0:
+            predicted = np.array([(track.predicted_x, track.predicted_y) for track in self._tracks])
+            distances = np.hypot(predicted[:, 0:1] - contours.column('center_x'),
+                                 predicted[:, 1:2] - contours.column('center_y'))
+            hit = set()
+            for index in np.argsort(distances, axis=None):
+                t, c = np.unravel_index(index, distances.shape)
+                if distances[t, c] > self._options['distance']:
+                    break
+                if t in hit or c in matched:
+                    continue
+                self._tracks[t]._hit(contours[int(c)], self._options['smoothing'])
+                hit.add(t)
+                matched.add(c)
+            for t in range(len(self._tracks)):
+                if t not in hit:
+                    self._tracks[t]._miss()
+        else:
+            for track in self._tracks:
+                track._miss()
+        self._tracks = [track for track in self._tracks if track.misses <= self._options['misses']]
+        # Anything left over is a new target
+        for c in range(len(contours)):
+            if c not in matched:
+                self._tracks.append(Track(next(self._ids), contours[c]))
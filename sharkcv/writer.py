@@ -0,0 +1,179 @@
+import collections
+import logging
+import threading
+import time
+
+import cv2
+
+import sharkcv
+
+POLICIES = ('drop', 'block', 'sample')
+
+
+# Write frames on a background thread from a bounded queue, so encoding and slow storage don't hold up processing
+# function(frame, *args) writes each frame (with the arguments given to write()) on the writer thread
+# When the queue is full the policy decides what happens to a new frame:
+# - 'drop': throw away the oldest queued frame to make room
+# - 'block': wait for room
+# - 'sample': keep only every Nth new frame (waiting for room for it) until the queue has room again
+class Writer(object):
+    def __init__(self, function, **kwargs):
+        # Called on the writer thread after the last frame
+        if 'close' not in kwargs:
+            kwargs['close'] = None
+        if 'size' not in kwargs:
+            kwargs['size'] = 4
+        if 'policy' not in kwargs:
+            kwargs['policy'] = 'drop'
+        if 'every' not in kwargs:
+            kwargs['every'] = 2
+        if 'name' not in kwargs:
+            kwargs['name'] = 'writer'
+        if kwargs['policy'] not in POLICIES:
+            raise ValueError('Unknown writer policy: %s' % kwargs['policy'])
+        self._function = function
+        self._close = kwargs['close']
+        self._size = max(kwargs['size'], 1)
+        self._policy = kwargs['policy']
+        self._every = max(kwargs['every'], 1)
+        self._name = kwargs['name']
+        self._queue = collections.deque()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._running = False
+        # Frames offered while the queue was full, for sampling
+        self._overflow = 0
+        self._written = 0
+        self._dropped = 0
+        self._errors = 0
+
+    @property
+    def name(self):
+        return self._name
+
+    # Number of frames waiting to be written
+    @property
+    def queued(self):
+        return len(self._queue)
+
+    @property
+    def written(self):
+        return self._written
+
+    # Number of frames thrown away because the queue was full
+    @property
+    def dropped(self):
+        return self._dropped
+
+    # Number of frames that failed to write
+    @property
+    def errors(self):
+        return self._errors
+
+    @property
+    def running(self):
+        return self._running
+
+    def start(self):
+        if self._thread is None:
+            self._running = True
+            self._thread = threading.Thread(target=self.__run)
+            self._thread.setDaemon(True)
+            self._thread.start()
+
+    # Write everything still queued, then stop the thread
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    # Queue a frame (and arguments for the write function), return whether it was queued
+    # The frame is copied (copy-on-write) so the caller can keep changing it
+    def write(self, frame, *args):
+        with self._cond:
+            if not self._running:
+                return False
+            if len(self._queue) >= self._size:
+                self._overflow += 1
+                if self._policy == 'drop':
+                    self._queue.popleft()
+                    self._dropped += 1
+                elif self._policy == 'sample' and self._overflow % self._every != 0:
+                    self._dropped += 1
+                    return False
+                while self._running and len(self._queue) >= self._size:
+                    self._cond.wait()
+                if not self._running:
+                    return False
+            else:
+                self._overflow = 0
+            self._queue.append((frame.copy(), args))
+            self._cond.notify_all()
+        return True
+
+    def __run(self):
+        while True:
+            with self._cond:
+                while self._running and len(self._queue) == 0:
+                    self._cond.wait()
+                if len(self._queue) == 0:
+                    break
+                frame, args = self._queue.popleft()
+                # Room for a blocked write()
+                self._cond.notify_all()
+            start = time.time()
+            try:
+                self._function(frame, *args)
+                self._written += 1
+            except Exception, e:
+                logging.warning('Failed to write %s: %s', self._name, str(e))
+                self._errors += 1
+            sharkcv.Profiler.record(self._name, time.time() - start)
+            frame = None
+        if self._close is not None:
+            self._close()
+
+
+# Write frames to a video file, opened (with the first frame's size) on the writer thread
+class VideoWriter(Writer):
+    def __init__(self, filename, fps, **kwargs):
+        if 'fourcc' not in kwargs:
+            kwargs['fourcc'] = 'DIVX'
+        if 'name' not in kwargs:
+            kwargs['name'] = 'write_video'
+        super(VideoWriter, self).__init__(self.__write, close=self.__close, **kwargs)
+        self._filename = filename
+        self._fps = fps
+        self._fourcc = kwargs['fourcc']
+        self._video = None
+
+    @property
+    def filename(self):
+        return self._filename
+
+    def __write(self, frame):
+        if self._video is None:
+            logging.debug('Opening output video: %s', self._filename)
+            self._video = cv2.VideoWriter(self._filename, cv2.cv.CV_FOURCC(*self._fourcc), self._fps,
+                                          (int(frame.width), int(frame.height)))
+        frame.write_video(self._video)
+
+    def __close(self):
+        if self._video is not None:
+            self._video.release()
+            self._video = None
+
+
+# Write frames to image files, write(frame, filename)
+class ImageWriter(Writer):
+    def __init__(self, **kwargs):
+        if 'name' not in kwargs:
+            kwargs['name'] = 'write_image'
+        super(ImageWriter, self).__init__(self.__write, **kwargs)
+
+    def __write(self, frame, filename):
+        logging.debug('Writing image: %s', filename)
+        frame.write_image(filename)